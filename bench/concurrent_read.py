@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench.concurrent_read -- Concurrent reads through KiFuse
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read files through KiFuse from several threads, with every block read
+taking as long as a remote fetch would, and report the time it takes
+compared to reading them from one thread.
+
+Usage: bench/concurrent_read.py [number of files] [threads] [fetch delay]"""
+
+import os
+import sys
+import stat
+import time
+import tempfile
+import threading
+from dulwich.repo import MemoryRepo
+from dulwich.objects import Blob
+from ki.objects import Record, File
+from ki.utils import RWLock
+from ki.fs import KiFuse
+from ki.usage import Usage
+from ki.cache import ChunkCache
+
+
+class SlowRepo(MemoryRepo):
+    """A repository where getting a blob the first time takes as long as
+    fetching it from a remote."""
+
+    def __init__(self, delay):
+        MemoryRepo.__init__(self)
+        self.delay = delay
+        self.usage = Usage(self, os.path.join(tempfile.mkdtemp(), "usage"))
+        self.cache = ChunkCache(self, os.path.join(tempfile.mkdtemp(), "chunks"))
+        self.fetched = set()
+
+    def fetch_sha1s(self, sha1s):
+        missing = [ sha1 for sha1 in sha1s if sha1 not in self.fetched ]
+        if missing:
+            time.sleep(self.delay)
+            self.fetched.update(missing)
+
+    def __getitem__(self, name):
+        obj = MemoryRepo.__getitem__(self, name)
+        if isinstance(obj, Blob) and not obj.data.startswith('{'):
+            self.fetch_sha1s([ name ])
+        return obj
+
+
+class BenchBox(object):
+    """The part of a Box that KiFuse needs."""
+
+    is_writable = False
+
+    def __init__(self, storage, record):
+        self.storage = storage
+        self.record = record
+        self.head_lock = threading.RLock()
+        self.tree_lock = RWLock()
+
+    @property
+    def root(self):
+        return self.record.root
+
+    def Commit(self):
+        pass
+
+
+def make_box(nfiles, delay):
+    storage = SlowRepo(delay)
+    record = Record(storage)
+    for i in xrange(nfiles):
+        f = File(storage)
+        f[0] = "file %d content" % i
+        record.root["file%d" % i] = (stat.S_IFREG | 0644, f)
+    return BenchBox(storage, Record(storage, record.store()))
+
+
+def read_all(nfiles, nthreads, delay):
+    """Read nfiles files from nthreads threads. Return the time it took."""
+    fs = KiFuse(make_box(nfiles, delay))
+    paths = [ "/file%d" % i for i in xrange(nfiles) ]
+
+    def reader(paths):
+        for path in paths:
+            fd = fs('open', path, 0)
+            fs('read', path, 4096, 0, fd)
+            fs('release', path, fd)
+
+    threads = [ threading.Thread(target=reader, args=(paths[i::nthreads],)) \
+                    for i in xrange(nthreads) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nthreads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+
+    serial = read_all(nfiles, 1, delay)
+    parallel = read_all(nfiles, nthreads, delay)
+
+    print "Files: %d, fetch delay: %.3fs" % (nfiles, delay)
+    print "1 thread: %.2fs" % serial
+    print "%d threads: %.2fs" % (nthreads, parallel)
+    print "Speedup: %.1fx" % (serial / parallel)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench.memory -- Memory used by the in-memory object graph
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Build a tree of files in a memory repository, load every entry the way a
+mounted box does, and report how many bytes of RSS each cached entry costs.
+
+If a git revision is given, the same is done with the ki package of that
+revision, and both numbers are reported.
+
+Usage: bench/memory.py [number of files] [files per directory] [revision]"""
+
+import os
+import sys
+import gc
+import json
+import stat
+import shutil
+import hashlib
+import resource
+import tempfile
+import subprocess
+from dulwich.repo import MemoryRepo
+from dulwich.objects import Blob, Tree
+from ki.objects import Directory
+
+
+def rss():
+    """Return the resident set size of this process, in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # ru_maxrss is in kilobytes, and only grows
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_tree(repo, nfiles, per_directory):
+    """Store a tree of nfiles files, per_directory files per subdirectory.
+    Return the tree sha."""
+    root = Tree()
+    for d in xrange((nfiles + per_directory - 1) // per_directory):
+        tree = Tree()
+        for f in xrange(d * per_directory, min(nfiles, (d + 1) * per_directory)):
+            desc = Blob.from_string(json.dumps(
+                    { "blocks": [ (4096, hashlib.sha1(str(f)).hexdigest()) ] }))
+            repo.object_store.add_object(desc)
+            tree.add("file%d" % f, stat.S_IFREG | 0644, desc.id)
+        repo.object_store.add_object(tree)
+        root.add("dir%d" % d, stat.S_IFDIR, tree.id)
+    repo.object_store.add_object(root)
+    return root.id
+
+
+def load_tree(repo, sha):
+    """Load every entry of the tree sha into a Directory, as lookups do."""
+    root = Directory(repo, sha)
+    for name, mode in list(root):
+        directory = root[name].item
+        for child, mode in list(directory):
+            directory[child].item.blocks
+    return root
+
+
+def measure(nfiles, per_directory):
+    """Return the number of bytes of RSS each cached entry costs."""
+    repo = MemoryRepo()
+    sha = build_tree(repo, nfiles, per_directory)
+    gc.collect()
+    before = rss()
+    root = load_tree(repo, sha)
+    gc.collect()
+    after = rss()
+    del root
+    return float(after - before) / nfiles
+
+
+def measure_revision(revision, nfiles, per_directory):
+    """Return the number of bytes of RSS each cached entry costs with the ki
+    package of the git revision."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        archive = subprocess.Popen([ "git", "archive", revision, "ki" ], stdout=subprocess.PIPE)
+        subprocess.check_call([ "tar", "-x", "-C", tmpdir ], stdin=archive.stdout)
+        if archive.wait() != 0:
+            raise RuntimeError("Unable to read ki at revision %s" % revision)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([ tmpdir ] + [ path for path in [ env.get("PYTHONPATH") ]
+                                                            if path ])
+        output = subprocess.Popen([ sys.executable, os.path.abspath(__file__),
+                                    str(nfiles), str(per_directory) ],
+                                  stdout=subprocess.PIPE, env=env).communicate()[0]
+        return float(output.splitlines()[-1].split(":")[1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    per_directory = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    revision = sys.argv[3] if len(sys.argv) > 3 else None
+
+    print "Files: %d, directories: %d" % (nfiles, (nfiles + per_directory - 1) // per_directory)
+    if revision is not None:
+        print "Bytes per cached entry at %s: %.1f" % (
+            revision, measure_revision(revision, nfiles, per_directory))
+    print "Bytes per cached entry: %.1f" % measure(nfiles, per_directory)
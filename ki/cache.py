@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.cache -- Evictable local chunks
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import anydbm
+import threading
+from dulwich.objects import hex_to_sha
+from .pack import write_pack_data
+
+
+class ChunkCache(object):
+    """The index of the chunks of a storage, telling which ones are local,
+    when they were last read, and which ones were evicted and are only on
+    the remotes. Evicted chunks get fetched again when they are read.
+
+    Reads are only noted in memory, and written to the index by save()."""
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.lock = threading.Lock()
+        self._index = anydbm.open(path, "c")
+        # sha -> time of the reads not saved yet
+        self._reads = {}
+
+    def _get(self, sha):
+        """Return the (local, last read time, size) of sha in the index, or
+        None if it is not in the index."""
+        try:
+            value = self._index[sha]
+        except KeyError:
+            return None
+        where, read_time, size = value.split()
+        return where == "local", float(read_time), int(size)
+
+    def _set(self, sha, local, read_time, size):
+        self._index[sha] = "%s %f %d" % (local and "local" or "remote", read_time, size)
+
+    def add(self, sha, size):
+        """Note that the chunk sha of size bytes is now local."""
+        with self.lock:
+            self._set(sha, True, self._reads.pop(sha, time.time()), size)
+
+    def read(self, sha):
+        """Note that sha was read."""
+        with self.lock:
+            self._reads[sha] = time.time()
+
+    def evicted(self, sha):
+        """Return whether the chunk sha was evicted."""
+        with self.lock:
+            entry = self._get(sha)
+        return entry is not None and not entry[0]
+
+    def save(self):
+        """Write the reads noted to the index."""
+        with self.lock:
+            reads, self._reads = self._reads, {}
+            for sha, read_time in reads.iteritems():
+                entry = self._get(sha)
+                # Only chunks are indexed
+                if entry is not None:
+                    self._set(sha, entry[0], read_time, entry[2])
+            if hasattr(self._index, "sync"):
+                self._index.sync()
+
+    def close(self):
+        """Save and close the index."""
+        self.save()
+        with self.lock:
+            self._index.close()
+
+    def evict(self, nbytes, evictable):
+        """Evict the chunks read the longest ago among the ones for which
+        evictable returns True, until at least nbytes got freed.
+        Return the number of chunks and of bytes evicted."""
+        self.save()
+        object_store = self.storage.object_store
+        candidates = []
+        with self.lock:
+            for sha in self.storage.refs.as_dict("refs/blobs").itervalues():
+                entry = self._get(sha)
+                if entry is None:
+                    # Stored before the index existed
+                    try:
+                        entry = True, 0, len(object_store.get_raw(sha)[1])
+                    except KeyError:
+                        continue
+                candidates.append((entry[1], entry[2], sha))
+        candidates.sort()
+        victims = {}
+        freed = 0
+        for read_time, size, sha in candidates:
+            if freed >= nbytes:
+                break
+            if evictable(sha):
+                victims[sha] = size
+                freed += size
+        if victims:
+            self._remove(victims)
+        return len(victims), freed
+
+    def _remove(self, victims):
+        """Remove the chunks of the dict victims, sha -> size, from the
+        storage."""
+        object_store = self.storage.object_store
+        # Unreference them first: a chunk referenced but missing would
+        # get pushed
+        for sha, size in victims.iteritems():
+            del self.storage.refs["refs/blobs/%s" % sha]
+            self.storage.usage.remove_chunk(size)
+            with self.lock:
+                self._set(sha, False, 0, size)
+        for pack in list(object_store.packs):
+            packed = [ sha for sha in victims if sha in pack ]
+            if packed:
+                self._rewrite_pack(pack, set(packed))
+                # Do not rely on the mtime of the pack directory to forget it
+                object_store._pack_cache = None
+        for sha in victims:
+            if object_store.contains_loose(sha):
+                os.remove(object_store._get_shafile_path(sha))
+        self.storage.usage.save()
+        with self.lock:
+            if hasattr(self._index, "sync"):
+                self._index.sync()
+
+    def _rewrite_pack(self, pack, victims):
+        """Replace pack by a pack of its objects but victims."""
+        object_store = self.storage.object_store
+        keep = [ sha for sha in pack if sha not in victims ]
+        # Readers still using the old pack keep reading it once removed,
+        # if it is open
+        pack.index
+        pack.data
+        if keep:
+            def records():
+                for sha in keep:
+                    type_num, raw = pack.get_raw(sha)
+                    yield type_num, hex_to_sha(sha), None, raw
+            f, commit, abort = object_store.add_pack()
+            try:
+                write_pack_data(f, len(keep), records())
+            except:
+                abort()
+                raise
+            commit()
+        os.remove(pack._data_path)
+        os.remove(pack._idx_path)
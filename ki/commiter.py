@@ -19,11 +19,114 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .utils import *
+import time
+import traceback
 
 
-class TimeCommiter(RepeatTimer):
-    """A commiter that commit every N seconds."""
+class CommitScheduler(threading.Thread):
+    """Commit a box when one of these happens first:
+    - no change for idle seconds;
+    - more than max_dirty_bytes bytes written since the last commit;
+    - more than max_dirty_entries entries changed since the last commit;
+    - the oldest uncommitted change is max_age seconds old;
+    - somebody asked to hurry, e.g. because memory is getting short."""
 
-    def __init__(self, box, time):
-        super(TimeCommiter, self).__init__(time, box.Commit)
+    def __init__(self, box, idle=2, max_age=300,
+                 max_dirty_bytes=64 * 1024 * 1024, max_dirty_entries=10000):
+        super(CommitScheduler, self).__init__(name="Commit scheduler of %s" % box.box_name)
         self.daemon = True
+        self.box = box
+        self.idle = idle
+        self.max_age = max_age
+        self.max_dirty_bytes = max_dirty_bytes
+        self.max_dirty_entries = max_dirty_entries
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._reset()
+        # Statistics
+        self.start_time = time.time()
+        self.commits = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+
+    def _reset(self):
+        self.dirty_bytes = 0
+        self.dirty_entries = 0
+        self.first_change = None
+        self.last_change = None
+        self.hurried = False
+
+    def touch(self, nbytes=0, entries=0):
+        """Record a change of nbytes bytes of data and entries entries."""
+        with self._cond:
+            now = time.time()
+            if self.first_change is None:
+                self.first_change = now
+                # Wake up the scheduler so it starts counting
+                self._cond.notify()
+            self.last_change = now
+            self.dirty_bytes += nbytes
+            self.dirty_entries += entries
+            if self.dirty_bytes >= self.max_dirty_bytes \
+                    or self.dirty_entries >= self.max_dirty_entries:
+                self._cond.notify()
+
+    def hurry(self):
+        """Commit the pending changes as soon as possible."""
+        with self._cond:
+            self.hurried = True
+            self._cond.notify()
+
+    def committed(self, latency):
+        """Called by the box once it committed, which took latency seconds."""
+        with self._cond:
+            self._reset()
+            self.commits += 1
+            self.total_latency += latency
+            self.last_latency = latency
+
+    def _time_to_commit(self, now):
+        """Return the number of seconds before the next commit is due, or
+        None if there is nothing to commit."""
+        if self.first_change is None:
+            return None
+        if self.hurried \
+                or self.dirty_bytes >= self.max_dirty_bytes \
+                or self.dirty_entries >= self.max_dirty_entries:
+            return 0
+        return max(0, min(self.last_change + self.idle,
+                          self.first_change + self.max_age) - now)
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                delay = self._time_to_commit(time.time())
+                if delay != 0:
+                    self._cond.wait(delay)
+                    continue
+            try:
+                self.box.Commit()
+            except Exception:
+                traceback.print_exc()
+                # Do not retry right away
+                with self._cond:
+                    self._cond.wait(self.idle)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    @property
+    def stats(self):
+        """Return a dict of statistics about commits."""
+        with self._cond:
+            uptime = time.time() - self.start_time
+            return { "commits": self.commits,
+                     "commits_per_minute": self.commits * 60.0 / uptime if uptime else 0.0,
+                     "average_latency": self.total_latency / self.commits if self.commits else 0.0,
+                     "last_latency": self.last_latency,
+                     "dirty_bytes": self.dirty_bytes,
+                     "dirty_entries": self.dirty_entries }
@@ -42,11 +42,12 @@ class Config(FileBlock):
             self._config = self._default_config
             self._update(self._update_id)
         else:
-            self._config = json.load(self)
+            self._config = json.loads(str(self))
 
     def load_json(self, value):
         """Load JSON data."""
         self._config = json.loads(value)
+        self.mark_dirty()
         self.store()
 
     def __getitem__(self, key):
@@ -54,6 +55,7 @@ class Config(FileBlock):
 
     def __setitem__(self, key, value):
         self._config[key] = value
+        self.mark_dirty()
         self.store()
 
     def _update(self, operation_type):
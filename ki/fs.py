@@ -24,10 +24,19 @@ import os
 import stat
 import time
 import posix
+import threading
+import contextlib
+import weakref
+import itertools
 from decorator import decorator
+import dulwich.diff_tree as diff_tree
+from dulwich.object_store import tree_lookup_path
 
-from .objects import NotDirectory, NoChild, Directory, File, Symlink, DirectoryEntry, FetchError
-from .utils import Path
+from .objects import NotDirectory, NoChild, Storable, Directory, File, Symlink, DirectoryEntry, FetchError, read_chunks
+from .utils import LRUCache
+
+# The inode number libfuse gives to entries whose inode it does not know
+FUSE_UNKNOWN_INO = 0xffffffff
 
 @decorator
 def rw(func, self, *args, **kw):
@@ -37,23 +46,307 @@ def rw(func, self, *args, **kw):
     return func(self, *args, **kw)
 
 class FDStore(dict):
-    """File descriptor storage."""
+    """File descriptor storage.
+    Values are (generation, DirectoryEntry) tuples: an entry is only valid
+    if its generation is the current one."""
+
+    def __init__(self):
+        super(FDStore, self).__init__()
+        self.lock = threading.Lock()
+        self.generation = 0
+        # Numbers of closed fds, to be reused
+        self._free = []
+        self._next = 0
+
+    def add(self, entry):
+        """Store entry, and return its fd."""
+        with self.lock:
+            try:
+                fd = self._free.pop()
+            except IndexError:
+                fd = self._next
+                self._next += 1
+            self[fd] = (self.generation, entry)
+            return fd
+
+    def remove(self, fd):
+        """Forget fd."""
+        with self.lock:
+            if self.pop(fd, None) is not None:
+                self._free.append(fd)
+
+    def update_entry(self, fd, generation, entry):
+        """Set the entry of fd, if it is still open."""
+        with self.lock:
+            if fd in self:
+                self[fd] = (generation, entry)
 
     def reset(self):
-        """Set all values to None."""
-        for k in self.iterkeys():
-            self[k] = None
+        """Invalidate all entries.
+        They will be looked up again on their next use."""
+        with self.lock:
+            self.generation += 1
+
+
+class InodeTable(object):
+    """Map paths to inode numbers.
+    A path gets one when it is looked up, and keeps it until it is removed
+    or renamed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._inodes = { '/': 1 }
+        self._next = 2
+
+    def __getitem__(self, path):
+        with self.lock:
+            try:
+                return self._inodes[path]
+            except KeyError:
+                ino = self._inodes[path] = self._next
+                self._next += 1
+                return ino
+
+    def get(self, path, default=None):
+        """Return the inode of path, or default if it has none yet."""
+        return self._inodes.get(path, default)
+
+    def __contains__(self, path):
+        return path in self._inodes
+
+    def __len__(self):
+        return len(self._inodes)
+
+    def _paths(self, path, recursive):
+        if not recursive:
+            return [ path ]
+        prefix = path.rstrip('/') + '/'
+        return [ path ] + [ p for p in self._inodes if p.startswith(prefix) ]
+
+    def discard(self, path, recursive=False):
+        """Forget the inode of path.
+        If recursive is True, also forget the inodes below path."""
+        with self.lock:
+            for p in self._paths(path, recursive):
+                if p != '/':
+                    self._inodes.pop(p, None)
+
+    def rename(self, old, new):
+        """Move the inodes of old and below to new."""
+        with self.lock:
+            for p in self._paths(new, True):
+                self._inodes.pop(p, None)
+            for p in self._paths(old, True):
+                try:
+                    self._inodes[new + p[len(old):]] = self._inodes.pop(p)
+                except KeyError:
+                    pass
 
 
 class KiFuse(fuse.Operations):
-    """The Ki file system."""
+    """The Ki file system.
+
+    Operations can be called from several threads at once. They all hold
+    the box tree lock shared, so a commit never sees a tree being
+    modified, and they lock the File or Directory they read or modify."""
 
-    def __init__(self, box):
+    # Operations doing their own locking
+    _unlocked_operations = ('init', 'destroy', 'fsync', 'fsyncdir', 'statfs')
+
+    def __init__(self, box, dentries_size=65536, negative_dentries_size=8192,
+                 locks=64, write_backpressure=1.0, fetch_errno=errno.EIO):
         self.start_time = time.time()
         self.box = box
         self.fds = FDStore()
+        # Objects are locked using one of these locks, picked by object id
+        self._locks = [ threading.RLock() for i in xrange(locks) ]
+        # Path -> DirectoryEntry cache, and paths known not to exist
+        self.dentries = LRUCache(dentries_size)
+        self.negative_dentries = LRUCache(negative_dentries_size)
+        # Attributes returned by readdir, for the getattr calls that follow
+        self.attrs = LRUCache(dentries_size)
+        # Bumped each time the caches above lose entries: a lookup started
+        # before must not fill them with what it found, it may be stale
+        self._dentries_epoch = 0
+        self._dentries_lock = threading.Lock()
+        # fh -> (offset, entry, entries) to resume readdir where it stopped
+        self._readdir_cursors = {}
+        # The root directory the dentries have been resolved from
+        self._dentries_root = None
+        self.inodes = InodeTable()
+        # Time at which the head changes modified paths: this is their
+        # mtime until they are modified locally, so kernel caches based
+        # on mtime only drop what changed.
+        self.changed_at = LRUCache(dentries_size)
+        # The struct fuse we run in, to invalidate kernel caches
+        self._handle = None
+        # Whether we are replaying the journal
+        self._replaying = False
+        # Files written since their data got spilled, by id
+        self._dirty_files = weakref.WeakValueDictionary()
+        # How long a write waits for a commit when there is too much dirty data
+        self.write_backpressure = write_backpressure
+        # The error of operations needing data no remote could send
+        self.fetch_errno = fetch_errno
         super(KiFuse, self).__init__()
 
+    def __call__(self, op, *args):
+        if op in self._unlocked_operations:
+            return super(KiFuse, self).__call__(op, *args)
+        if op == "write" and self.box.is_writable and self.box.dirty_budget.over_hard:
+            # Slow writers down until a commit catches up. This must not
+            # hold the tree lock, or the commit could not run.
+            self.box.commit_scheduler.hurry()
+            self.box.dirty_budget.wait(self.write_backpressure)
+        with self.box.tree_lock.shared():
+            return super(KiFuse, self).__call__(op, *args)
+
+    @contextlib.contextmanager
+    def _locked(self, *objects):
+        """Lock objects for the duration of the block."""
+        # Always lock in the same order to avoid dead locks. Objects are
+        # aligned in memory, so drop the low bits of their id.
+        locks = sorted(set([ (id(obj) >> 4) % len(self._locks) for obj in objects ]))
+        for lock in locks:
+            self._locks[lock].acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                self._locks[lock].release()
+
+    def flush_dentries(self):
+        """Empty the lookup caches."""
+        with self._dentries_lock:
+            self._dentries_epoch += 1
+            self.dentries.clear()
+            self.negative_dentries.clear()
+            self.attrs.clear()
+
+    def _cache(self, cache, path, value, epoch):
+        """Set path to value in cache, unless the caches lost entries since
+        epoch, when the lookup of value started."""
+        with self._dentries_lock:
+            if epoch == self._dentries_epoch:
+                cache[path] = value
+
+    def init(self, path):
+        self._handle = fuse.fuse_get_handle()
+
+    def head_changed(self, old_tree, new_tree):
+        """Drop what we know about the previous head.
+        old_tree and new_tree are the sha of the old and new root trees.
+        Only the paths that disappeared lose their inode number, and only
+        the changed paths get invalidated in the kernel."""
+        self.fds.reset()
+        self.flush_dentries()
+        removed = set()
+        changed = set()
+        for change in diff_tree.tree_changes(self.box.storage.object_store, old_tree, new_tree):
+            if change.type == diff_tree.CHANGE_DELETE:
+                removed.add(change.old.path)
+            for entry in (change.old, change.new):
+                path = entry.path
+                # The directories above it changed too
+                while path is not None and "/" + path not in changed:
+                    changed.add("/" + path)
+                    path = os.path.dirname(path) if path else None
+        now = time.time()
+        for path in changed:
+            self.changed_at[path] = now
+        if self._handle is not None and fuse.fuse_can_invalidate():
+            # The kernel may wait for operations blocked on the tree lock
+            # we hold while invalidating, so do not wait for it.
+            invalidator = threading.Thread(target=self._invalidate_kernel,
+                                           args=(changed,))
+            invalidator.daemon = True
+            invalidator.start()
+        # Deleted directories are not reported, only the files they had
+        checked = set()
+        for path in removed:
+            self.inodes.discard("/" + path)
+            parent = os.path.dirname(path)
+            while parent and parent not in checked:
+                checked.add(parent)
+                try:
+                    tree_lookup_path(self.box.storage.object_store.__getitem__, new_tree, parent)
+                except KeyError:
+                    self.inodes.discard("/" + parent)
+                parent = os.path.dirname(parent)
+
+    def _changed(self, op, data="", nbytes=0, entries=1, **args):
+        """Log a change in the journal, and tell the commit scheduler
+        about it. This is called with the objects changed still locked,
+        so changes get logged in the order they were made."""
+        if not self._replaying:
+            self.box.journal.append(op, data, **args)
+        self.box.commit_scheduler.touch(nbytes, entries)
+
+    def replay(self, journal):
+        """Apply the operations logged in journal.
+        The operations logged before a record the head holds are skipped:
+        they got committed, but we stopped before the journal got reset.
+        Operations which cannot be applied are skipped too."""
+        committed = 0
+        for index, (args, data) in enumerate(journal):
+            if args["op"] == "commit" and self.box.holds_record(args["sha"]):
+                committed = index + 1
+        self._replaying = True
+        try:
+            for args, data in itertools.islice(journal, committed, None):
+                op = args.pop("op")
+                if op == "commit":
+                    continue
+                try:
+                    if op in ("create", "mkdir", "symlink"):
+                        try:
+                            self._get_child(args.get("path") or args["target"])
+                        except fuse.FuseOSError:
+                            pass
+                        else:
+                            # Already there
+                            continue
+                    if op == "write":
+                        self.write(args["path"], data, args["offset"])
+                    elif op == "create":
+                        self.release(args["path"], self.create(args["path"], args["mode"]))
+                    elif op == "mkdir":
+                        self.mkdir(args["path"], args["mode"])
+                    elif op == "symlink":
+                        self.symlink(args["target"], args["source"])
+                    elif op == "copy_file_range":
+                        self.copy_file_range(args["path_in"], None, args["offset_in"],
+                                             args["path_out"], None, args["offset_out"],
+                                             args["length"])
+                    else:
+                        getattr(self, op)(**args)
+                except (EnvironmentError, FetchError) as e:
+                    print "> Cannot replay %s %s: %s" % (op, args, e)
+        finally:
+            self._replaying = False
+
+    def _invalidate_kernel(self, paths):
+        for path in paths:
+            fuse.fuse_invalidate_path(self._handle, path)
+
+    def _invalidate(self, path, recursive=False):
+        """Drop path from the lookup caches.
+        If recursive is True, also drop everything below path."""
+        with self._dentries_lock:
+            self._dentries_epoch += 1
+            for cache in (self.dentries, self.negative_dentries, self.attrs):
+                cache.discard(path)
+                if recursive:
+                    prefix = path.rstrip('/') + '/'
+                    for key in [ k for k in cache.keys() if k.startswith(prefix) ]:
+                        cache.discard(key)
+
+    def _invalidate_attrs(self, path):
+        """Drop the attributes of path from the lookup caches."""
+        with self._dentries_lock:
+            self._dentries_epoch += 1
+            self.attrs.discard(path)
+
     def access(self, path, amode):
         try:
             (mode, child) = self._get_child(path)
@@ -67,6 +360,28 @@ class KiFuse(fuse.Operations):
                 raise fuse.FuseOSError(errno.EACCES)
 
     def getattr(self, path, fh=None):
+        s = self.attrs.get(path)
+        if s is not None:
+            # Computed by readdir, which is usually followed by a getattr
+            # on every entry: use it once.
+            self.attrs.discard(path)
+            s['st_ino'] = self.inodes[path]
+            return s
+        try:
+            (mode, child) = self._resolve(path, fh)
+        except FetchError as e:
+            return self._stat(path, e.mode, 0)
+        if isinstance(child, File):
+            size = child.size
+        else:
+            size = len(child)
+        return self._stat(path, mode, size, getattr(child, "mtime", None))
+
+    def _stat(self, path, mode, size, mtime=None, listed=False):
+        """Return the attributes of path.
+        If listed is True, path is only listed by readdir: it gets no inode
+        number if it has none yet, so listing a directory does not make
+        the inode table grow."""
         s = {}
         # Special case: for the root directory, there's no object at all, so
         # we return the start time as the ctime
@@ -74,17 +389,10 @@ class KiFuse(fuse.Operations):
             s['st_ctime'] = self.start_time
         else:
             s['st_ctime'] = self.box.record.commit_time
-        try:
-            (mode, child) = self._resolve(path, fh)
-        except FetchError as e:
-            s['st_size'] = 0
-            mode = e.mode
-        else:
-            s['st_size'] = len(child)
-            try:
-                s['st_mtime'] = child.mtime
-            except AttributeError:
-                s['st_mtime']= s['st_ctime']
+        s['st_size'] = size
+        if mtime is None:
+            mtime = self.changed_at.get(path, self.start_time)
+        s['st_mtime'] = mtime
         if stat.S_ISDIR(mode):
             # Directories have no mode, so set one by default
             # XXX This mode should be a config option?
@@ -94,8 +402,13 @@ class KiFuse(fuse.Operations):
                      | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP
                      | stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH)
         s['st_mode'] = mode
-        s['st_ino'] = 0
+        if listed:
+            s['st_ino'] = self.inodes.get(path, FUSE_UNKNOWN_INO)
+        else:
+            s['st_ino'] = self.inodes[path]
         s['st_dev'] = 0
+        # There is no hard link. For directories, 1 tells find and fts that
+        # the number of subdirectories is unknown.
         s['st_nlink'] = 1
         s['st_uid'] = os.getuid()
         s['st_gid'] = os.getgid()
@@ -105,76 +418,132 @@ class KiFuse(fuse.Operations):
 
     def to_fd(self, mode, item):
         """Return a fd for item."""
-        # Collect all fd number
-        with self.box.head_lock:
-            k = self.fds.keys()
-            k.sort()
-            try:
-                fd = k[-1] + 1
-            except IndexError:
-                fd = 0
-            self.fds[fd] = DirectoryEntry(mode, item)
-            return fd
+        return self.fds.add(DirectoryEntry(mode, item))
 
     def opendir(self, path):
         try:
             entry = self._get_child(path)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
+            raise fuse.FuseOSError(self.fetch_errno)
         if not isinstance(entry.item, Directory):
             raise fuse.FuseOSError(errno.ENOTDIR)
         return self.to_fd(*entry)
 
-    def readdir(self, path, fh=None):
-        yield '.'
-        yield '..'
-        for path, mode in self._resolve(path, fh, Directory).item:
-            yield path
-
-    def release(self, path, fh):
+    def readdir(self, path, fh=None, offset=0):
+        directory = self._resolve(path, fh, Directory).item
         try:
-            del self.fds[fh]
+            (cursor_offset, entry, entries) = self._readdir_cursors.pop(fh)
         except KeyError:
-            pass
+            cursor_offset = None
+        if cursor_offset != offset:
+            # Not where we stopped last time: restart from there
+            entry = None
+            entries = itertools.islice(self._readdir_entries(path, directory), offset, None)
+        return self._readdir_from(fh, offset, entry, entries)
+
+    def _readdir_from(self, fh, offset, entry, entries):
+        """Yield (name, attrs, offset) for entry then entries."""
+        if entry is not None:
+            entries_left = itertools.chain([ entry ], entries)
+        else:
+            entries_left = entries
+        for entry in entries_left:
+            # If the kernel buffer is full, the next readdir call restarts
+            # at that entry.
+            self._readdir_cursors[fh] = (offset, entry, entries)
+            offset += 1
+            yield entry[0], entry[1], offset
+        self._readdir_cursors.pop(fh, None)
+
+    def _readdir_entries(self, path, directory):
+        """Yield (name, attrs) for each entry of directory at path."""
+        prefix = path.rstrip('/') + '/'
+        yield '.', { 'st_mode': stat.S_IFDIR, 'st_ino': self.inodes[path] }
+        yield '..', { 'st_mode': stat.S_IFDIR }
+        for name, mode, child in directory.iterentries():
+            # This runs outside of the operation, so lock the tree, but
+            # not while suspended: the rest may never be read
+            with self.box.tree_lock.shared():
+                attrs = self._entry_attrs(prefix + name, mode, child)
+            yield name, attrs
+
+    def _entry_attrs(self, path, mode, child):
+        """Return the attributes of a directory entry.
+        child is a Storable or the sha of the entry."""
+        epoch = self._dentries_epoch
+        mtime = None
+        if isinstance(child, File):
+            size = child.size
+            mtime = getattr(child, "mtime", None)
+        elif not isinstance(child, Storable) and stat.S_ISREG(mode):
+            try:
+                size = sum([ size for size, sha in read_chunks(self.box.storage, child) ])
+            except FetchError:
+                size = None
+        else:
+            # Getting the size would mean loading the object
+            size = None
+        if size is None:
+            return { 'st_mode': mode, 'st_ino': self.inodes.get(path, FUSE_UNKNOWN_INO) }
+        s = self._stat(path, mode, size, mtime, listed=True)
+        self._cache(self.attrs, path, s, epoch)
+        return s
 
-        # Commit as soon as no more fds are opened
-        if not self.fds:
-            self.box.Commit()
+    def release(self, path, fh):
+        self.fds.remove(fh)
 
-    releasedir = release
+    def releasedir(self, path, fh):
+        self._readdir_cursors.pop(fh, None)
+        self.release(path, fh)
 
     def open(self, path, flags):
         try:
             entry = self._get_child(path, File)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
+            raise fuse.FuseOSError(self.fetch_errno)
 
         if not self.box.is_writable and flags & (os.O_WRONLY | os.O_RDWR):
             raise fuse.FuseOSError(errno.EROFS)
 
         return self.to_fd(*entry)
 
-    @rw
-    def unlink(self, path):
-        path = Path(path)
-        (directory_mode, directory) = self._get_child(path[:-1])
+    def _get_parent(self, path):
+        """Get the directory containing path."""
+        try:
+            (mode, directory) = self._get_child(os.path.dirname(path))
+        except FetchError:
+            raise fuse.FuseOSError(self.fetch_errno)
         if not isinstance(directory, Directory):
             raise fuse.FuseOSError(errno.ENOTDIR)
-        try:
-            del directory[path[-1]]
-        except NoChild:
-            raise fuse.FuseOSError(errno.ENOENT)
+        return directory
 
-    rmdir = unlink
+    @rw
+    def unlink(self, path):
+        directory = self._get_parent(path)
+        with self._locked(directory):
+            try:
+                del directory[os.path.basename(path)]
+            except NoChild:
+                raise fuse.FuseOSError(errno.ENOENT)
+            self._invalidate(path)
+            self.inodes.discard(path)
+            self._changed("unlink", path=path)
+
+    def rmdir(self, path):
+        self.unlink(path)
+        self._invalidate(path, recursive=True)
+        self.inodes.discard(path, recursive=True)
 
     @rw
     def _create(self, path, mode, obj):
-        try:
-            self.box.root[path] = (mode, obj)
-        except NoChild:
-            raise fuse.FuseOSError(errno.ENOENT)
-        except NotDirectory:
-            raise fuse.FuseOSError(errno.ENOTDIR)
+        directory = self._get_parent(path)
+        with self._locked(directory):
+            directory[os.path.basename(path)] = (mode, obj)
+            self._invalidate(path)
+            if isinstance(obj, Directory):
+                self._changed("mkdir", path=path, mode=stat.S_IMODE(mode))
+            else:
+                self._changed("create", path=path, mode=mode)
 
         return self.to_fd(mode, obj)
 
@@ -192,22 +561,35 @@ class KiFuse(fuse.Operations):
 
     @rw
     def rename(self, old, new):
-        try:
-            self.box.root[new] = self.box.root[old]
-            del self.box.root[old]
-        except NotDirectory:
-            raise fuse.FuseOSError(errno.ENOTDIR)
-        except NoChild:
-            raise fuse.FuseOSError(errno.ENOENT)
+        old_directory = self._get_parent(old)
+        new_directory = self._get_parent(new)
+        with self._locked(old_directory, new_directory):
+            try:
+                new_directory[os.path.basename(new)] = old_directory[os.path.basename(old)]
+                del old_directory[os.path.basename(old)]
+                self.inodes.rename(old, new)
+            except NotDirectory:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+            except NoChild:
+                raise fuse.FuseOSError(errno.ENOENT)
+            finally:
+                self._invalidate(old, recursive=True)
+                self._invalidate(new, recursive=True)
+            self._changed("rename", old=old, new=new)
 
     @rw
     def chmod(self, path, mode):
-        try:
-            self.box.root[path] = (mode, self.box.root[path].item)
-        except NotDirectory:
-            raise fuse.FuseOSError(errno.ENOTDIR)
-        except NoChild:
-            raise fuse.FuseOSError(errno.ENOENT)
+        directory = self._get_parent(path)
+        name = os.path.basename(path)
+        with self._locked(directory):
+            try:
+                directory[name] = (mode, directory[name].item)
+            except NotDirectory:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+            except NoChild:
+                raise fuse.FuseOSError(errno.ENOENT)
+            self._invalidate(path)
+            self._changed("chmod", path=path, mode=mode)
 
     @rw
     def link(self, target, source):
@@ -217,12 +599,24 @@ class KiFuse(fuse.Operations):
     def _get_child(self, path, cls=None):
         """Get the mode and child of path.
         Also check that child is instance of cls."""
-        try:
-            entry = self.box.root[path]
-        except NotDirectory:
-            raise fuse.FuseOSError(errno.ENOTDIR)
-        except NoChild:
+        root = self.box.root
+        # A new root means a new record: everything cached is stale.
+        if root is not self._dentries_root:
+            self.flush_dentries()
+            self._dentries_root = root
+        if path in self.negative_dentries:
             raise fuse.FuseOSError(errno.ENOENT)
+        entry = self.dentries.get(path)
+        if entry is None:
+            epoch = self._dentries_epoch
+            try:
+                entry = root[path]
+            except NotDirectory:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+            except NoChild:
+                self._cache(self.negative_dentries, path, True, epoch)
+                raise fuse.FuseOSError(errno.ENOENT)
+            self._cache(self.dentries, path, entry, epoch)
         if cls is not None and not isinstance(entry.item, cls):
             raise fuse.FuseOSError(errno.EINVAL)
         return entry
@@ -231,54 +625,120 @@ class KiFuse(fuse.Operations):
         """Resolve a file based on fh or path."""
         if fh is None:
             return self._get_child(path, cls)
-        with self.box.head_lock:
-            value = self.fds[fh]
-            if value == None:
-                # That can happens if self.fds has been cleared by a commit in
-                # the meantime.
-                return self._get_child(path, cls)
-            return value
+        with self.fds.lock:
+            generation = self.fds.generation
+            try:
+                (fd_generation, entry) = self.fds[fh]
+            except KeyError:
+                fd_generation = None
+        if fd_generation == generation:
+            return entry
+        # The head changed since fh got its entry: look it up in the new
+        # tree, once.
+        entry = self._get_child(path, cls)
+        self.fds.update_entry(fh, generation, entry)
+        return entry
 
     def read(self, path, size, offset, fh=None):
+        # Blocks are loaded as they are read, so this can fetch too
         try:
             (mode, child) = self._resolve(path, fh, File)
+            with self._locked(child):
+                unloaded = child.unloaded_blocks(offset, offset + size)
+            # Fetch without holding the lock, which other objects share
+            child.storage.fetch_sha1s(unloaded)
+            with self._locked(child):
+                return child[offset:offset + size]
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        return child[offset:offset + size]
+            raise fuse.FuseOSError(self.fetch_errno)
 
     @rw
     def write(self, path, data, offset, fh=None):
         try:
             (mode, child) = self._resolve(path, fh, File)
+            with self._locked(child):
+                child[offset] = data
+                self._changed("write", data, len(data), 0, path=path, offset=offset)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        child[offset] = data
+            raise fuse.FuseOSError(self.fetch_errno)
+        self._dirty_files[id(child)] = child
+        self.box.dirty_budget.charge(len(data))
+        if self.box.dirty_budget.over_soft:
+            self._spill()
+        self._invalidate_attrs(path)
         return len(data)
 
+    def _spill(self):
+        """Move the dirty data of the files written to the staging area of
+        the box, and commit it soon."""
+        spilled = 0
+        for key in self._dirty_files.keys():
+            f = self._dirty_files.pop(key, None)
+            if f is not None:
+                with self._locked(f):
+                    spilled += f.spill(self.box.staging)
+        self.box.dirty_budget.spilled(spilled)
+        self.box.commit_scheduler.hurry()
+
     @rw
     def truncate(self, path, length, fh=None):
         try:
             (mode, child) = self._resolve(path, fh, File)
+            with self._locked(child):
+                child.truncate(length)
+                self._changed("truncate", path=path, length=length)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        del child[length:]
+            raise fuse.FuseOSError(self.fetch_errno)
+        self._invalidate_attrs(path)
 
     @rw
-    def symlink(self, target, source):
-        target = Path(target)
+    def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out,
+                        offset_out, length, flags=0):
+        """Copy length bytes of path_in to path_out. The blocks of path_in
+        are shared with path_out rather than read and written again."""
         try:
-            (target_directory_mode, target_directory) = self._get_child(target[:-1])
+            (mode, src) = self._resolve(path_in, fh_in, File)
+            (mode, dst) = self._resolve(path_out, fh_out, File)
+            with self._locked(src, dst):
+                copied = dst.copy_range(src, offset_in, offset_out, length)
+                self._changed("copy_file_range", path_in=path_in, offset_in=offset_in,
+                              path_out=path_out, offset_out=offset_out, length=length)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        if not isinstance(target_directory, Directory):
-            raise fuse.FuseOSError(errno.ENOTDIR)
-        target_directory[target[-1]] = (stat.S_IFLNK, Symlink(self.box.storage, target=source))
+            raise fuse.FuseOSError(self.fetch_errno)
+        self._invalidate_attrs(path_out)
+        return copied
+
+    @rw
+    def copy(self, source, target):
+        """Make target a copy of the file source, sharing its blocks.
+        Return the number of bytes copied."""
+        try:
+            (mode, src) = self._get_child(source, File)
+        except FetchError:
+            raise fuse.FuseOSError(self.fetch_errno)
+        try:
+            self._get_child(target, File)
+        except fuse.FuseOSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.release(target, self.create(target, mode))
+        else:
+            self.truncate(target, 0)
+        return self.copy_file_range(source, None, 0, target, None, 0, src.size)
+
+    @rw
+    def symlink(self, target, source):
+        target_directory = self._get_parent(target)
+        with self._locked(target_directory):
+            target_directory[os.path.basename(target)] = (stat.S_IFLNK, Symlink(self.box.storage, target=source))
+            self._invalidate(target)
+            self._changed("symlink", target=target, source=source)
 
     def readlink(self, path):
         try:
             return str(self._get_child(path, Symlink).item)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
+            raise fuse.FuseOSError(self.fetch_errno)
 
     @rw
     def utimens(self, path, times=None):
@@ -286,19 +746,38 @@ class KiFuse(fuse.Operations):
         try:
             (mode, child) = self._get_child(path, File)
         except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        if times is None:
-            now = time.time()
-            child.mtime = child.atime = now
-        else:
-            child.atime = times[0]
-            child.mtime = times[1]
+            raise fuse.FuseOSError(self.fetch_errno)
+        with self._locked(child):
+            if times is None:
+                now = time.time()
+                child.mtime = child.atime = now
+            else:
+                child.atime = times[0]
+                child.mtime = times[1]
+            self._changed("utimens", path=path, times=[ child.atime, child.mtime ])
+        self._invalidate_attrs(path)
 
     def fsync(self, path, datasync, fh=None):
-        try:
-            (mode, child) = self._resolve(path, fh)
-        except FetchError:
-            raise fuse.FuseOSError(errno.EIO)
-        child.store()
+        # Changes are durable once in the journal: they get chunked and
+        # stored at commit time.
+        if self.box.is_writable:
+            self.box.journal.sync()
 
     fsyncdir = fsync
+
+    def statfs(self, path, block_size=4096):
+        """Return the usage of the box from its counters, and the space
+        left on the file system holding the storage."""
+        usage = self.box.usage()
+        used = (usage["bytes"] + usage["dirty_bytes"] + block_size - 1) // block_size
+        st = os.statvfs(self.box.storage.path)
+        free = st.f_bavail * st.f_frsize // block_size
+        entries = usage["files"] + usage["directories"] + usage["symlinks"]
+        return { 'f_bsize': block_size,
+                 'f_frsize': block_size,
+                 'f_blocks': used + free,
+                 'f_bfree': free,
+                 'f_bavail': free,
+                 'f_files': entries + st.f_favail,
+                 'f_ffree': st.f_favail,
+                 'f_favail': st.f_favail }
@@ -253,6 +253,25 @@ def fuse_get_context():
     return ctx.uid, ctx.gid, ctx.pid
 
 
+def fuse_get_handle():
+    """Returns the struct fuse pointer of the calling file system.
+       Only valid when called from an operation."""
+    return _libfuse.fuse_get_context().contents.fuse
+
+
+def fuse_can_invalidate():
+    """Returns True if libfuse can invalidate kernel caches by path."""
+    return hasattr(_libfuse, 'fuse_invalidate_path')
+
+
+def fuse_invalidate_path(handle, path):
+    """Asks the kernel to drop its cached entry, attributes and data for
+       path. Returns False if it is not supported."""
+    if handle is None or not fuse_can_invalidate():
+        return False
+    return _libfuse.fuse_invalidate_path(c_voidp(handle), path) == 0
+
+
 class FuseOSError(OSError):
     def __init__(self, errno):
         super(FuseOSError, self).__init__(errno, strerror(errno))
@@ -425,7 +444,7 @@ class FUSE(object):
     
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path, fip.contents.fh):
+        for item in self.operations('readdir', path, fip.contents.fh, offset):
             if isinstance(item, str):
                 name, st, offset = item, None, 0
             else:
@@ -587,13 +606,23 @@ class Operations(object):
         """Returns a string containing the data requested."""
         raise FuseOSError(EIO)
     
-    def readdir(self, path, fh):
+    def readdir(self, path, fh, offset=0):
         """Can return either a list of names, or a list of (name, attrs, offset)
-           tuples. attrs is a dict as in getattr."""
+           tuples. attrs is a dict as in getattr.
+           When returning offsets, the listing must start at offset, and
+           offset is the one of the last entry returned by the previous
+           call; otherwise offset can be ignored."""
         return ['.', '..']
     
     def readlink(self, path):
         raise FuseOSError(ENOENT)
+
+    def copy_file_range(self, path_in, fh_in, offset_in, path_out, fh_out,
+                        offset_out, length, flags=0):
+        """Returns the number of bytes copied.
+           libfuse 2 has no such operation and never calls this: it is
+           only reachable by calling the operations directly."""
+        raise FuseOSError(EOPNOTSUPP)
     
     def release(self, path, fh):
         return 0
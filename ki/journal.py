@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.journal -- Write-ahead journal
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import struct
+import threading
+import zlib
+
+
+class Journal(object):
+    """An append-only journal of the changes made to a box since its last
+    commit.
+
+    Each record is a header, then a JSON dict describing the operation,
+    then the raw data of the operation. The header holds the CRC32 of the
+    JSON and the data, and their lengths."""
+
+    _header = struct.Struct("!III")
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        self.lock = threading.Lock()
+        self._file = open(path, "ab")
+
+    @staticmethod
+    def _encode(value):
+        # Paths are bytes, keep them as is in JSON
+        if isinstance(value, str):
+            return value.decode('latin-1')
+        return value
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, unicode):
+            return value.encode('latin-1')
+        return value
+
+    def append(self, op, data="", **args):
+        """Add an operation to the journal.
+        It is only durable once sync() is called."""
+        args["op"] = op
+        header = json.dumps(dict([ (key, self._encode(value)) for key, value in args.iteritems() ]))
+        crc = zlib.crc32(data, zlib.crc32(header)) & 0xffffffff
+        with self.lock:
+            self._file.write(self._header.pack(crc, len(header), len(data)))
+            self._file.write(header)
+            self._file.write(data)
+
+    def sync(self):
+        """Make all appended operations durable."""
+        with self.lock:
+            self._file.flush()
+            os.fdatasync(self._file.fileno())
+
+    def reset(self):
+        """Empty the journal, once its operations got committed."""
+        with self.lock:
+            self._file.flush()
+            self._file.truncate(0)
+            os.fdatasync(self._file.fileno())
+
+    def __iter__(self):
+        """Iterate over (args, data) of each operation in the journal.
+        A record which got partially written, because we crashed while
+        writing it, ends the journal and is removed."""
+        with self.lock:
+            self._file.flush()
+        valid = 0
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(self._header.size)
+                if len(header) < self._header.size:
+                    break
+                (crc, header_len, data_len) = self._header.unpack(header)
+                header = f.read(header_len)
+                data = f.read(data_len)
+                if len(header) < header_len or len(data) < data_len \
+                        or zlib.crc32(data, zlib.crc32(header)) & 0xffffffff != crc:
+                    break
+                valid = f.tell()
+                args = json.loads(header)
+                yield (dict([ (str(key), self._decode(value)) for key, value in args.iteritems() ]),
+                       data)
+        with self.lock:
+            if os.path.getsize(self.path) > valid:
+                self._file.truncate(valid)
+
+    def close(self):
+        with self.lock:
+            self._file.close()
@@ -27,9 +27,11 @@ import time
 import socket
 import os
 import pwd
+import bisect
 import collections
 import json
-from cStringIO import StringIO
+import weakref
+import threading
 from .merge import *
 
 
@@ -56,31 +58,77 @@ class Storable(object):
 
     _object_type = ShaFile
 
+    # A mounted box can hold millions of these, so do not give them a
+    # __dict__.
+    __slots__ = ('storage', '_object', '_dirty', '_holders', '__weakref__')
+
     def __init__(self, storage, obj=None):
         """Initialize an storable object."""
         self.storage = storage
+        # Directories holding this object, to tell them when we change.
+        # This is None, a weakref to the only holder, or a dict of
+        # weakrefs indexed by holder id().
+        self._holders = None
         if obj is None:
             self._object = self._object_type()
+            self._dirty = True
         elif isinstance(obj, basestring):
             self._object = storage[obj]
             if not isinstance(self._object, self._object_type):
                 raise BadObjectType(self._object)
+            self._dirty = False
         elif isinstance(obj, type(self)):
             # Store the object, because if we copy the object and access one
             # of its attribute later without having it stored, it will fail.
 
             self._object = storage[obj.store()]
+            self._dirty = False
         elif isinstance(obj, ShaFile):
             self._object = obj
+            self._dirty = obj.id not in storage.object_store
         else:
             raise BadObjectType(obj)
 
     def copy(self):
         return self.__class__(self.storage, self)
 
+    @property
+    def dirty(self):
+        """Whether this object changed since it has been stored."""
+        return self._dirty
+
+    def mark_dirty(self):
+        """Flag this object as modified, and propagate that to the
+        directories holding it."""
+        if not self._dirty:
+            self._dirty = True
+            if self._holders is None:
+                holders = []
+            elif isinstance(self._holders, dict):
+                holders = self._holders.values()
+            else:
+                holders = [ self._holders ]
+            for holder in holders:
+                directory = holder()
+                if directory is not None:
+                    directory._child_dirtied(self)
+
+    def _attach(self, directory):
+        """Register directory as holding this object."""
+        if self._holders is None:
+            self._holders = weakref.ref(directory)
+        elif isinstance(self._holders, dict):
+            self._holders[id(directory)] = weakref.ref(directory)
+        elif self._holders() is not directory:
+            holder = self._holders()
+            self._holders = { id(directory): weakref.ref(directory) }
+            if holder is not None:
+                self._holders[id(holder)] = weakref.ref(holder)
+
     @property
     def object(self):
-        self._update(self._update_id)
+        if self.dirty:
+            self._update(self._update_id)
         return self._object
 
     @staticmethod
@@ -98,14 +146,17 @@ class Storable(object):
     def store(self):
         """Store object into its storage.
         Return the object SHA1."""
-        self._update(self._update_store)
-        self.storage.object_store.add_object(self._object)
+        if self.dirty:
+            self._update(self._update_store)
+            self.storage.object_store.add_object(self._object)
+            self._dirty = False
         return self._object.id
 
     def id(self):
         """Return the object SHA1 id.
         Note that this id can changed anytime, since data change all the time."""
-        self._update(self._update_id)
+        if self.dirty:
+            self._update(self._update_id)
         return self._object.id
 
     def __len__(self):
@@ -140,31 +191,121 @@ class UnknownChangeType(Exception):
 
 DirectoryEntry = collections.namedtuple('DirectoryEntry', ['mode', 'item'])
 
+TreeEntry = collections.namedtuple('TreeEntry', ['path', 'mode', 'sha', 'chunks'])
+
+
+def read_chunks(storage, sha):
+    """Return the list of (size, sha) chunks of the file descriptor sha.
+    Holes have no sha: it is None."""
+    data = storage[sha].data
+    if not data:
+        return []
+    return [ (size, chunk and str(chunk)) for size, chunk in json.loads(data)["blocks"] ]
+
+
+def _walk_subtree((storage, sha, path)):
+    return list(walk_tree(storage, sha, path))
+
+
+def walk_tree(storage, sha, path="", pool=None):
+    """Walk the Tree sha and its subtrees, yielding a TreeEntry for every
+    entry found. Chunks are only listed for files.
+
+    This only reads raw objects: no Storable is built and nothing gets
+    cached, so it is safe to use on the tree of a mounted box.
+    If pool is a thread pool, subtrees are walked in parallel and their
+    entries are yielded in no particular order."""
+    subtrees = []
+    for name, mode, child_sha in storage[sha].iteritems():
+        if path:
+            child_path = "%s/%s" % (path, name)
+        else:
+            child_path = name
+        if stat.S_ISDIR(mode):
+            subtrees.append((storage, child_sha, child_path))
+            yield TreeEntry(child_path, mode, child_sha, [])
+        elif stat.S_ISREG(mode):
+            yield TreeEntry(child_path, mode, child_sha, read_chunks(storage, child_sha))
+        else:
+            yield TreeEntry(child_path, mode, child_sha, [])
+
+    if pool is None:
+        for subtree in subtrees:
+            for entry in _walk_subtree(subtree):
+                yield entry
+    else:
+        for entries in pool.imap_unordered(_walk_subtree, subtrees):
+            for entry in entries:
+                yield entry
+
+
+# Protects the creation of Directory._pending sets, since children can be
+# modified concurrently.
+_pending_lock = threading.Lock()
+
+
 class Directory(Storable):
     """A directory."""
 
     _object_type = Tree
 
+    __slots__ = ('local_tree', '_pending', 'mtime')
+
     def __init__(self, storage, obj=None):
         super(Directory, self).__init__(storage, obj)
         # This is locally modified/added files which will belong to our tree
         # when we will dump ourselves.
         self.local_tree = {}
+        # Names set in local_tree and id() of the modified children since
+        # we were last stored: only those need to be added to our tree.
+        # Most directories never change, so this is only created on demand.
+        self._pending = None
+
+    def _add_pending(self, key):
+        if self._pending is None:
+            with _pending_lock:
+                if self._pending is None:
+                    self._pending = set()
+        self._pending.add(key)
+
+    def _child_dirtied(self, child):
+        self._add_pending(id(child))
+        self.mark_dirty()
 
     def _update(self, action):
-        for name, (mode, child) in self.local_tree.iteritems():
-            self._object.add(name, int(mode), action(child))
+        if self._pending:
+            for name, (mode, child) in self.local_tree.iteritems():
+                if name in self._pending or id(child) in self._pending:
+                    self._object.add(name, int(mode), action(child))
+        if action == self._update_store:
+            self._pending = None
 
     def __iter__(self):
-        yielded_path = []
-        for path, (mode, child) in self.local_tree.iteritems():
-            yielded_path.append(path)
+        # Iterate on a copy: local_tree can grow while we yield
+        for path, (mode, child) in self.local_tree.items():
             yield path, mode
 
         for path, mode, sha in self._object.iteritems():
-            if path not in yielded_path:
+            if path not in self.local_tree:
                 yield path, mode
 
+    def iterentries(self):
+        """Iterate over (name, mode, child) for every entry.
+        child is the loaded object, or the entry sha if it is not loaded.
+        Entries of our tree come first in tree order, so this order does
+        not change unless entries are added or removed."""
+        local_tree = self.local_tree
+        for name, mode, sha in self._object.iteritems():
+            try:
+                (mode, child) = local_tree[name]
+            except KeyError:
+                yield name, mode, sha
+            else:
+                yield name, mode, child
+        for name, (mode, child) in local_tree.items():
+            if name not in self._object:
+                yield name, mode, child
+
     def __getitem__(self, path):
         """Get the child of that directory that is at path."""
         path = Path(path)
@@ -184,7 +325,7 @@ class Directory(Storable):
         except KeyError:
             # Otherwise try to fetch from local Tree object
             try:
-                (mode, child_sha) = self.object[name]
+                (mode, child_sha) = self._object[name]
             except KeyError:
                 raise NoChild(name)
             # Check permission right now, this avoids to call make_object
@@ -193,14 +334,16 @@ class Directory(Storable):
             if not stat.S_ISDIR(mode) and len(path) > 1:
                 raise NotDirectory(child)
             try:
-                self.local_tree[name] = DirectoryEntry(mode, make_object(self.storage, mode, child_sha))
+                child = make_object(self.storage, mode, child_sha)
             except FetchError as e:
                 # Store the mode since this is the only thing we can get,
                 # and re-raise the exception.
                 e.mode = mode
                 raise e
-
-        entry = self.local_tree[name]
+            child._attach(self)
+            # Another thread may have loaded that child in the meantime: in
+            # that case, use its copy.
+            entry = self.local_tree.setdefault(intern(name), DirectoryEntry(mode, child))
 
         # Last item of the path, return it.
         if len(path) == 1:
@@ -222,25 +365,32 @@ class Directory(Storable):
             # The file was not in local_tree, try in self.object and raises
             # if it raises.
             try:
-                del subdir.object[name]
+                del subdir._object[name]
             except KeyError:
                 raise NoChild(name)
         else:
             # We succeeded to delete in local_tree, just try to delete in
             # self.object to be sure we deleted definitively.
             try:
-                del subdir.object[name]
+                del subdir._object[name]
             except KeyError:
                 pass
 
+        if subdir._pending is not None:
+            subdir._pending.discard(name)
         subdir.mtime = time.time()
+        subdir.mark_dirty()
 
     def __setitem__(self, path, value):
         """Add a file with name and mode attributes to directory."""
         path = Path(path)
         subdir = self.mkdir(path[:-1])
-        subdir.local_tree[path[-1]] = DirectoryEntry(value[0], value[1])
+        name = intern(path[-1])
+        subdir.local_tree[name] = DirectoryEntry(value[0], value[1])
+        value[1]._attach(subdir)
+        subdir._add_pending(name)
         subdir.mtime = time.time()
+        subdir.mark_dirty()
 
     def mkdir(self, path, directory=None):
         """Create a directory name with dir_object being the Directory object.
@@ -268,16 +418,27 @@ class Directory(Storable):
                 blobs.update(obj.blocks)
         return blobs
 
-    def list_blobs_recursive(self):
+    def list_blobs_recursive(self, pool=None):
         """Return the list of blobs referenced by this Directory and its
-        subdirectories."""
+        subdirectories.
+        Children that have not been loaded yet are walked using walk_tree,
+        so this does not populate local_tree."""
         blobs = set()
-        for path, mode in self:
-            obj = self[path].item
-            if isinstance(obj, File):
-                blobs.update(obj.blocks)
-            elif isinstance(obj, Directory):
-                blobs.update(obj.list_blobs_recursive())
+        for name, (mode, child) in self.local_tree.items():
+            if isinstance(child, File):
+                blobs.update(child.blocks)
+            elif isinstance(child, Directory):
+                blobs.update(child.list_blobs_recursive(pool))
+        for name, mode, sha in self._object.iteritems():
+            if name in self.local_tree:
+                continue
+            if stat.S_ISREG(mode):
+                blobs.update([ chunk for size, chunk in read_chunks(self.storage, sha)
+                               if chunk is not None ])
+            elif stat.S_ISDIR(mode):
+                for entry in walk_tree(self.storage, sha, pool=pool):
+                    blobs.update([ chunk for size, chunk in entry.chunks
+                                   if chunk is not None ])
         return blobs
 
     def merge_tree_changes(self, changes):
@@ -399,54 +560,124 @@ class FileBlock(Storable):
 
     _object_type = Blob
 
+    # The sha of the block, until its data is loaded
+    __slots__ = ('_sha',)
+
+    def __init__(self, storage, obj=None):
+        if isinstance(obj, basestring):
+            # Files hold a lot of blocks they may never read, so only
+            # load the data when it is needed.
+            self.storage = storage
+            self._holders = None
+            self._object = None
+            self._dirty = False
+            self._sha = obj
+        else:
+            super(FileBlock, self).__init__(storage, obj)
+
+    def _load(self):
+        if self._object is None:
+            obj = self.storage[self._sha]
+            if not isinstance(obj, self._object_type):
+                raise BadObjectType(obj)
+            self._object = obj
+        return self._object
+
+    @property
+    def object(self):
+        return self._load()
+
+    def id(self):
+        if self._object is None:
+            return self._sha
+        return super(FileBlock, self).id()
+
     @property
     def data(self):
-        return self._object.data
+        return self._load().data
 
     @data.setter
     def data(self, value):
-        self._object.data = value
+        self._load().data = value
+        self.mark_dirty()
 
     def __str__(self):
-        return str(self._object.data)
+        return str(self._load().data)
 
     def __getitem__(self, key):
-        return self.object.data[key]
+        return self._load().data[key]
 
     def _update(self, action):
         pass
 
     def store(self):
+        if not self.dirty:
+            return self.id()
         # Store
         oid = super(FileBlock, self).store()
         # Generate a tag with the sha1 that points to the sha1
         # That way, our blob object is not unreachable and cannot be garbage
         # collected
-        self.storage.refs['refs/blobs/%s' % oid ] = oid
+        ref = 'refs/blobs/%s' % oid
+        if ref not in self.storage.refs:
+            self.storage.refs[ref] = oid
+            self.storage.usage.add_chunk(self._object.raw_length())
+            self.storage.cache.add(oid, self._object.raw_length())
         return oid
 
 
 class Symlink(FileBlock):
     """A symlink."""
 
+    __slots__ = ()
+
     def __init__(self, storage, obj=None, target="/"):
         super(Symlink, self).__init__(storage, obj)
-        self._object.data = target
+        if obj is None:
+            self.data = target
 
     target = FileBlock.data
 
 
+class Hole(object):
+    """A run of zeros in a file.
+    Holes are not stored: file descriptors list them as blocks with no sha."""
+
+    __slots__ = ('length',)
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return "\0" * self.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.length
+            key = slice(key, key + 1)
+        start, stop, step = key.indices(self.length)
+        return Hole(len(xrange(start, stop, step)))
+
+
 class File(Storable):
     """A file."""
 
     _object_type = Blob
 
+    __slots__ = ('_chunks', '_lazy_data', 'lmo', 'stored', 'mtime', 'atime')
+
     def __init__(self, storage, obj=None):
         super(File, self).__init__(storage, obj)
+        # The (size, sha) list of our blocks, as found in our descriptor
         if obj is None or len(self._object.data) == 0:
-            self._desc = { "blocks": [] }
+            self._chunks = []
         else:
-            self._desc = json.loads(self._object.data)
+            self._chunks = [ (size, sha and str(sha)) \
+                                 for size, sha in json.loads(self._object.data)["blocks"] ]
         self._lazy_data = None
         self.lmo = None
         self.stored = False
@@ -455,8 +686,8 @@ class File(Storable):
     def _data(self):
         """Lazy data initializer. We only try to read the data when we have to."""
         if self._lazy_data == None:
-            self._lazy_data =  lrope([ (size, FileBlock(self.storage, str(sha))) \
-                                           for size, sha in self._desc["blocks"] ])
+            self._lazy_data =  lrope([ (size, Hole(size) if sha is None else FileBlock(self.storage, sha)) \
+                                           for size, sha in self._chunks ])
         return self._lazy_data
 
     def _update_lmo(self, offset):
@@ -465,30 +696,86 @@ class File(Storable):
         if self.lmo is None or offset < self.lmo:
             self.lmo = offset
 
+    @property
+    def size(self):
+        """Size of the file. Unlike len(), this does not load the blocks."""
+        if self._lazy_data is None:
+            return sum([ size for size, sha in self._chunks ])
+        return len(self._lazy_data)
+
     @property
     def blocks(self):
         """Get blobs list of this file."""
         self._update(self._update_id)
-        return [ str(v[1]) for v in self._desc["blocks"] ]
+        return [ sha for size, sha in self._chunks if sha is not None ]
 
     def __len__(self):
         return len(self._data)
 
     def __str__(self):
+        self.prefetch()
         return str(self._data)
 
     def __getitem__(self, key):
+        if isinstance(key, slice):
+            self.prefetch(key.start, key.stop)
         return self._data[key]
 
+    def prefetch(self, start=None, stop=None):
+        """Fetch at once the blocks holding the data from start to stop
+        which are not in the storage, rather than one by one as they are
+        read."""
+        shas = self.unloaded_blocks(start, stop)
+        if shas:
+            self.storage.fetch_sha1s(shas)
+
+    def unloaded_blocks(self, start=None, stop=None):
+        """Return the shas of the blocks holding the data from start to
+        stop which are not loaded."""
+        data = self._data
+        start, stop, step = slice(start, stop).indices(len(data))
+        if start >= stop:
+            return []
+        blocks = data.blocks
+        shas = []
+        for index in xrange(data.block_index_for_offset(start), len(blocks)):
+            offset, block = blocks[index]
+            if offset >= stop:
+                break
+            if isinstance(block, FileBlock) and block._object is None:
+                shas.append(block._sha)
+        return shas
+
     def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            offset = key.start or 0
+        else:
+            offset = key
+        if offset > len(self._data):
+            # Writing past the end leaves a hole
+            self.truncate(offset)
         self._data[key] = value
         self.mtime = time.time()
         self._update_lmo(key)
+        self.mark_dirty()
+
+    def truncate(self, length):
+        """Cut the file at length bytes, or extend it up to length bytes
+        with a hole."""
+        size = len(self._data)
+        if length < size:
+            del self[length:]
+        elif length > size:
+            self._data.splice(size, [ (length - size, Hole(length - size)) ])
+            self.mtime = time.time()
+            self._update_lmo(size)
+            self.mark_dirty()
 
     def __delitem__(self, key):
         del self._data[key]
         self.mtime = time.time()
         self._update_lmo(key)
+        self.mark_dirty()
 
     def _update(self, action):
         # If the data never got modified, do nothing!
@@ -497,44 +784,122 @@ class File(Storable):
             blocks = []
             # Lowest modified block index
             lmb_index = self._data.block_index_for_offset(self.lmo)
+            # Blocks cut by the modification start before it
+            while lmb_index > 0 \
+                    and not isinstance(self._data.blocks[lmb_index - 1][1], (FileBlock, Hole)):
+                lmb_index -= 1
+            # So that a hole before can be merged with new ones
+            if lmb_index > 0 and isinstance(self._data.blocks[lmb_index - 1][1], Hole):
+                lmb_index -= 1
 
             try:
-                offset = self._data.blocks[lmb_index][0]
+                self._data.blocks[lmb_index]
             except IndexError:
                 # File is empty
                 del self._data.blocks[:]
             else:
-                # Seek to where we should restart the rolling,
-                # i.e. the offset of the lowest modified block
-                for block in split(StringIO(self._data[offset:])):
-                    fb = FileBlock(self.storage)
-                    fb.data = str(block)
-                    blocks.append((offset, fb))
-                    offset += len(block)
-
-                # Delete what we just re-split
-                del self._data.blocks[lmb_index:]
-                # And replace with the new blocks
-                self._data.blocks.extend(blocks)
+                # Split again the data written since the lowest modified
+                # block. The FileBlock-s found on the way, e.g. shared with
+                # another file, are kept as is.
+                run_start = None
+                for offset, block in self._data.blocks[lmb_index:]:
+                    if isinstance(block, (FileBlock, Hole)):
+                        if run_start is not None:
+                            blocks.extend(self._split(run_start, offset))
+                            run_start = None
+                        blocks.append((offset, block))
+                    elif run_start is None:
+                        run_start = offset
+                if run_start is not None:
+                    blocks.extend(self._split(run_start, len(self._data)))
+
+                # Replace what we just re-split with the new blocks
+                self._data.blocks.replace(lmb_index, len(self._data.blocks),
+                                          self._merge_holes(blocks))
 
             # Reset LMO
             self.lmo = None
 
             # Replace the FileBlock-s by their id using `action'
-            self._desc["blocks"] = [ (len(block), action(block)) \
-                                         for offset, block in self._data.blocks ]
+            self._chunks = self._chunks_of_data(action)
 
-            self._object.set_raw_string(json.dumps(self._desc))
+            self._object.set_raw_string(json.dumps({ "blocks": self._chunks }))
 
             self.stored = action == self._update_store
         elif action == self._update_store and not self.stored:
 
             # Replace the FileBlock-s by their id using `action'
-            self._desc["blocks"] = [ (len(block), action(block)) \
-                                         for offset, block in self._data.blocks ]
+            self._chunks = self._chunks_of_data(action)
             self.stored = True
 
-            self._object.set_raw_string(json.dumps(self._desc))
+            self._object.set_raw_string(json.dumps({ "blocks": self._chunks }))
+
+        if self.stored:
+            # Our blocks are in the storage now, do not keep them in memory
+            self._lazy_data = None
+
+    def _split(self, start, stop):
+        """Split the data from start to stop in new FileBlock-s, and return
+        them as a [ (offset, FileBlock), … ] list. Blocks of zeros become
+        Hole-s."""
+        blocks = []
+        offset = start
+        for block in split(self._data.open(start, stop)):
+            data = str(block)
+            if data.strip("\0"):
+                fb = FileBlock(self.storage)
+                fb.data = data
+            else:
+                fb = Hole(len(data))
+            blocks.append((offset, fb))
+            offset += len(data)
+        return blocks
+
+    @staticmethod
+    def _merge_holes(blocks):
+        """Merge the consecutive Hole-s of a [ (offset, block), … ] list."""
+        merged = []
+        for offset, block in blocks:
+            if isinstance(block, Hole) and merged and isinstance(merged[-1][1], Hole):
+                hole_offset, hole = merged[-1]
+                merged[-1] = (hole_offset, Hole(offset + len(block) - hole_offset))
+            else:
+                merged.append((offset, block))
+        return merged
+
+    def _chunks_of_data(self, action):
+        """Return the (size, sha) list of our blocks, getting the sha of
+        FileBlock-s using `action'."""
+        return [ (self._data.block_size_at(index),
+                  None if isinstance(block, Hole) else action(block)) \
+                     for index, (offset, block) in enumerate(self._data.blocks) ]
+
+    def copy_range(self, src, src_offset, offset, length):
+        """Copy length bytes of the File src from src_offset to offset.
+        The blocks of src are shared, not copied, so this only costs as
+        much as the number of blocks. Return the number of bytes copied."""
+        pieces = src._data.slice_blocks(src_offset, src_offset + length)
+        if offset > len(self._data):
+            self.truncate(offset)
+        self._data.splice(offset, pieces)
+        self.mtime = time.time()
+        self._update_lmo(offset)
+        self.mark_dirty()
+        return sum([ size for size, block in pieces ])
+
+    def spill(self, staging):
+        """Move the data written to this file since it was last split to
+        the StagingArea staging. Return the number of bytes moved."""
+        if self._lazy_data is None:
+            return 0
+        spilled = 0
+        blocks = self._lazy_data.blocks
+        for index, (offset, block) in enumerate(blocks):
+            # Written data is kept as strings in the rope
+            if isinstance(block, str) and block:
+                blocks[index] = (offset, staging.stage(block))
+                spilled += len(block)
+        return spilled
 
     def merge(self, base, other):
         """Do a 3-way merge of other using base."""
@@ -548,6 +913,8 @@ class Record(Storable):
 
     _object_type = Commit
 
+    __slots__ = ('_parents', 'root')
+
     def __init__(self, storage, commit=None):
         """Create a new Record. If commit is None, we create a Record based
         on a new empty Commit, i.e. a new commit with a new empty Tree."""
@@ -568,6 +935,10 @@ class Record(Storable):
     def parents(self):
         return self._parents
 
+    @property
+    def dirty(self):
+        return self._dirty or self.root.dirty
+
     @property
     def commit_time(self):
         return self._object.commit_time
@@ -581,6 +952,7 @@ class Record(Storable):
         self._object.author_timezone = \
             self._object.commit_timezone = \
             - time.timezone
+        self.mark_dirty()
 
     def _update(self, action):
         """Update commit information."""
@@ -626,20 +998,20 @@ class Record(Storable):
         return commits
 
     @staticmethod
-    def records_blob_list(records):
+    def records_blob_list(records, pool=None):
         """Return the set of all blobs referenced by all records in list."""
         # Build the blob set of all records
-        return reduce(set.union, [ record.root.list_blobs_recursive() \
+        return reduce(set.union, [ record.root.list_blobs_recursive(pool) \
                                        for record in records ],
                       set())
 
-    def determine_blobs(self):
+    def determine_blobs(self, pool=None):
         """Return a list of all blobs referenced by this record."""
         # Merge all records
-        records = reduce(set.union, self.history())
+        records = reduce(set.union, self.history(), set())
         # Add self to history!
         records.add(self)
-        return self.records_blob_list(records)
+        return self.records_blob_list(records, pool)
 
     def find_common_ancestors(self, other):
         """Find the first common ancestors with another Record.
@@ -711,6 +1083,7 @@ class Record(Storable):
         print changes
         self.root.merge_tree_changes(changes)
         self.parents.append(other)
+        self.mark_dirty()
 
     # These operators works like that: r1 > r2 is True if r2 is a parent of
     # r1. It's easy: look at the the > like an arrow in the DAG toward the
@@ -727,3 +1100,54 @@ class Record(Storable):
 
     def __le__(self, other):
         return self == other or not self.is_child_of(other)
+
+
+class CommitTimeIndex(object):
+    """The commits reachable from a head, sorted by commit time, to find
+    which one was current at a given time using a binary search.
+    Only the raw commits are read, and only once."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.Lock()
+        self._times = []
+        self._shas = []
+        self._known = set()
+
+    def __len__(self):
+        return len(self._shas)
+
+    def update(self, head):
+        """Index the commits reachable from the commit head which are not
+        indexed yet."""
+        with self.lock:
+            new = []
+            todo = [ head ]
+            while todo:
+                sha = todo.pop()
+                if sha in self._known:
+                    continue
+                self._known.add(sha)
+                commit = self.storage[sha]
+                new.append((commit.commit_time, sha))
+                todo.extend(commit.parents)
+            if not new:
+                return
+            # History is walked from the newest commits: inserting each one
+            # in the sorted lists would move them all every time. Sort the
+            # new ones instead, and merge both sorted runs in one sort.
+            new.reverse()
+            new.sort(key=lambda entry: entry[0])
+            entries = zip(self._times, self._shas) + new
+            entries.sort(key=lambda entry: entry[0])
+            self._times = [ commit_time for commit_time, sha in entries ]
+            self._shas = [ sha for commit_time, sha in entries ]
+
+    def find(self, timestamp):
+        """Return the sha of the last commit made at or before timestamp,
+        or None if there is none."""
+        with self.lock:
+            index = bisect.bisect_right(self._times, timestamp)
+            if index == 0:
+                return None
+            return self._shas[index - 1]
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.pack -- Deltified packs
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+from dulwich.objects import Blob, Tree, Commit, Tag, hex_to_sha
+import dulwich.pack
+from dulwich.pack import SHA1Writer, write_pack_header, write_pack_object, OFS_DELTA, REF_DELTA
+
+# Length of the pieces of the base indexed to find matches
+_DELTA_BLOCK = 16
+# Longest data a delta copy or insert instruction can carry
+_DELTA_MAX_COPY = 0x10000
+_DELTA_MAX_INSERT = 0x7f
+
+
+def _encode_size(size):
+    ret = ''
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        ret += chr(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    return ret + chr(c)
+
+
+def _match_length(a, a_offset, b, b_offset):
+    """Return the length of the common prefix of a[a_offset:] and b[b_offset:]."""
+    length = 0
+    step = 4096
+    while step:
+        while True:
+            piece = a[a_offset + length:a_offset + length + step]
+            if len(piece) != step or piece != b[b_offset + length:b_offset + length + step]:
+                break
+            length += step
+        step //= 2
+    return length
+
+
+def _insert(out, data):
+    for offset in xrange(0, len(data), _DELTA_MAX_INSERT):
+        piece = data[offset:offset + _DELTA_MAX_INSERT]
+        out.append(chr(len(piece)))
+        out.append(piece)
+
+
+def _copy(out, offset, length):
+    while length:
+        size = min(length, _DELTA_MAX_COPY)
+        op = 0x80
+        scratch = ''
+        for i in range(4):
+            if offset & (0xff << i * 8):
+                scratch += chr((offset >> i * 8) & 0xff)
+                op |= 1 << i
+        # A size of 0x10000 is written as no size at all
+        for i in range(2):
+            if size & (0xff << i * 8):
+                scratch += chr((size >> i * 8) & 0xff)
+                op |= 1 << (4 + i)
+        out.append(chr(op))
+        out.append(scratch)
+        offset += size
+        length -= size
+
+
+def create_delta(base, target):
+    """Return a git delta turning base into target.
+
+    Unlike dulwich's, this does not use difflib: pieces of base are indexed
+    in a dict and looked up along target, which keeps deltas of big trees
+    and file descriptors fast to compute."""
+    index = {}
+    for offset in xrange(0, len(base) - _DELTA_BLOCK + 1, _DELTA_BLOCK):
+        index.setdefault(base[offset:offset + _DELTA_BLOCK], offset)
+    out = [ _encode_size(len(base)), _encode_size(len(target)) ]
+    inserted = 0
+    position = 0
+    while position + _DELTA_BLOCK <= len(target):
+        offset = index.get(target[position:position + _DELTA_BLOCK])
+        if offset is None:
+            position += 1
+            continue
+        length = _match_length(base, offset, target, position)
+        # Take back what matches before, if we were going to insert it
+        while position > inserted and offset > 0 \
+                and base[offset - 1] == target[position - 1]:
+            position -= 1
+            offset -= 1
+            length += 1
+        _insert(out, target[inserted:position])
+        _copy(out, offset, length)
+        position += length
+        inserted = position
+    _insert(out, target[inserted:])
+    return ''.join(out)
+
+
+class PackContents(object):
+    """The objects to put in a pack, deltified when it is written.
+
+    Trees and file descriptors are deltified against the window previous
+    objects of the same type, sorted by path, with delta chains at most
+    depth long. Objects are also deltified against the object at the same
+    path in base_trees, trees the receiver already has: this makes a thin
+    pack. Chunks, which have no path, are sent as is.
+
+    report_activity is called with the size of each object written, as
+    dulwich does not report writing packs."""
+
+    def __init__(self, object_store, objects, base_trees=(), window=10, depth=50,
+                 report_activity=None):
+        self.object_store = object_store
+        self.report_activity = report_activity
+        # The (sha, path) of the objects
+        self.objects = list(objects)
+        self._shas = set([ sha for sha, path in self.objects ])
+        self.base_trees = base_trees
+        # The shas at each path in base_trees, looked up once per pack
+        self._bases = None
+        self.window = window
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __iter__(self):
+        for sha, path in self.objects:
+            yield self.object_store[sha], path
+
+    def _thin_bases(self):
+        """Return the shas at the paths of the objects in base_trees, by
+        path, in the order of base_trees.
+
+        Only the directories leading to those paths are read, and each
+        version of them once, however many base trees share it."""
+        paths = set([ path for sha, path in self.objects if path is not None ])
+        dirs = set()
+        for path in paths:
+            while path:
+                path = path.rpartition("/")[0]
+                dirs.add(path)
+        bases = collections.defaultdict(list)
+        seen = set()
+        for tree in self.base_trees:
+            stack = [ ("", tree) ]
+            while stack:
+                path, sha = stack.pop()
+                if (path, sha) in seen:
+                    continue
+                seen.add((path, sha))
+                if path in paths:
+                    bases[path].append(sha)
+                if path not in dirs:
+                    continue
+                try:
+                    obj = self.object_store[sha]
+                except KeyError:
+                    continue
+                if isinstance(obj, Tree):
+                    for name, mode, child in obj.iteritems():
+                        child_path = path + "/" + name if path else name
+                        if child_path in paths or child_path in dirs:
+                            stack.append((child_path, child))
+        return bases
+
+    def _thin_base(self, path, type_num):
+        """Return the object at path in base_trees, if it has type type_num."""
+        if self._bases is None:
+            self._bases = self._thin_bases()
+        for sha in self._bases.get(path, ()):
+            try:
+                obj = self.object_store[sha]
+            except KeyError:
+                continue
+            # A base sent in the pack would be there twice
+            if obj.type_num == type_num and obj.id not in self._shas:
+                return obj
+
+    def records(self):
+        """Yield the (type_num, sha, delta_base, raw) records of the pack."""
+        for record in self._records():
+            yield record
+            if self.report_activity is not None:
+                self.report_activity(len(record[3]), 'write')
+
+    def _records(self):
+        deltifiable = []
+        for sha, path in self.objects:
+            type_num, raw = self.object_store.get_raw(sha)
+            if path is None or self.window == 0 \
+                    or type_num not in (Blob.type_num, Tree.type_num):
+                yield type_num, hex_to_sha(sha), None, raw
+            else:
+                deltifiable.append((type_num, path, -len(raw), sha))
+        # Put versions of a same path next to each other, biggest first
+        deltifiable.sort()
+        window = collections.deque()
+        for type_num, path, neg_length, sha in deltifiable:
+            raw = self.object_store.get_raw(sha)[1]
+            best, best_base, best_depth = raw, None, 0
+            bases = list(window)
+            thin_base = self._thin_base(path, type_num)
+            if thin_base is not None:
+                bases.insert(0, (thin_base.type_num, thin_base.sha().digest(),
+                                 thin_base.as_raw_string(), 0))
+            for base_type_num, base_sha, base_raw, base_depth in bases:
+                if base_type_num != type_num or base_depth >= self.depth:
+                    continue
+                delta = create_delta(base_raw, raw)
+                if len(delta) < len(best):
+                    best, best_base, best_depth = delta, base_sha, base_depth + 1
+            yield type_num, hex_to_sha(sha), best_base, best
+            window.appendleft((type_num, hex_to_sha(sha), raw, best_depth))
+            while len(window) > self.window:
+                window.pop()
+
+
+def write_pack_data(f, num_records, records):
+    """Write a pack of num_records records to f, like
+    dulwich.pack.write_pack_data, but with offset deltas pointing to their
+    base relatively to themselves, as git reads them."""
+    entries = {}
+    f = SHA1Writer(f)
+    write_pack_header(f, num_records)
+    for type_num, object_id, delta_base, raw in records:
+        offset = f.offset()
+        if delta_base is not None:
+            try:
+                base_offset, base_crc32 = entries[delta_base]
+            except KeyError:
+                # Not in the pack, the receiver has it
+                type_num = REF_DELTA
+                raw = (delta_base, raw)
+            else:
+                type_num = OFS_DELTA
+                raw = (offset - base_offset, raw)
+        crc32 = write_pack_object(f, type_num, raw)
+        entries[object_id] = (offset, crc32)
+    return entries, f.write_sha()
+
+
+def write_pack_objects(f, objects, window=10, num_objects=None):
+    """Write a pack of objects to f, like dulwich.pack.write_pack_objects,
+    which it replaces so dulwich clients send deltified packs: objects
+    given as PackContents get deltified."""
+    if isinstance(objects, PackContents):
+        return write_pack_data(f, len(objects), objects.records())
+    return _write_pack_objects(f, objects, window, num_objects)
+
+_write_pack_objects = dulwich.pack.write_pack_objects
+
+
+def is_commit_or_tag(object_store, sha):
+    """Check that sha is a commit or a tag in object_store."""
+    try:
+        return object_store.get_raw(sha)[0] in (Commit.type_num, Tag.type_num)
+    except KeyError:
+        return False
@@ -18,25 +18,450 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
+import stat
+import time
+import Queue
+import collections
 import threading
+import subprocess
+import traceback
 from .config import Configurable, Config, BUS_INTERFACE
 from .objects import FileBlock, FetchError
-from dulwich.client import get_transport_and_path
-from dulwich.errors import HangupException
+from .pack import PackContents, write_pack_objects, is_commit_or_tag
+import dulwich.client
+from dulwich.client import get_transport_and_path, SubprocessSSHVendor, SubprocessWrapper
+from dulwich.errors import HangupException, GitProtocolError, UpdateRefsError
+from dulwich.protocol import ZERO_SHA
+from dulwich.objects import Commit
 import dbus.service
 import uuid
 
 
+class SSHVendor(SubprocessSSHVendor):
+    """Run ssh sharing one master connection per host, which is kept open
+    for control_persist seconds after its last use. Transfers to a host
+    then skip the SSH connection and authentication once the first one
+    is done.
+
+    The sockets of the master connections are in $XDG_RUNTIME_DIR/ki, or
+    ~/.ssh/ki. Whoever can reach them can use the connections, so they
+    are not shared if that directory is not ours only."""
+
+    control_persist = 600
+
+    def __init__(self):
+        self.control_dir = self._control_dir()
+
+    @staticmethod
+    def _control_dir():
+        """Return the directory of the master connection sockets, or None
+        if there is none safe to use."""
+        path = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~/.ssh"),
+                            "ki")
+        try:
+            os.makedirs(path, 0700)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            print "> Not sharing SSH connections: %s" % str(e)
+            return None
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+                or stat.S_IMODE(st.st_mode) != 0700:
+            print "> Not sharing SSH connections: %s is not a directory of ours only" % path
+            return None
+        return path
+
+    def run_command(self, host, command, username=None, port=None):
+        args = [ 'ssh', '-x' ]
+        if self.control_dir is not None:
+            args.extend([ '-o', 'ControlMaster=auto',
+                          '-o', 'ControlPath=%s' % os.path.join(self.control_dir, "%r@%h:%p"),
+                          '-o', 'ControlPersist=%d' % self.control_persist ])
+        if port is not None:
+            args.extend(['-p', str(port)])
+        if username is not None:
+            host = '%s@%s' % (username, host)
+        args.append(host)
+        proc = subprocess.Popen(args + command,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        return SubprocessWrapper(proc)
+
+dulwich.client.get_ssh_vendor = SSHVendor
+dulwich.client.write_pack_objects = write_pack_objects
+
+
+class RemoteTimeout(HangupException):
+    """A remote did not answer in time."""
+
+    def __init__(self, remote, reason):
+        Exception.__init__(self, "Remote %s %s" % (remote.name, reason))
+
+
+class RemoteStats(object):
+    """Moving estimates of how a remote performs: its latency, the time it
+    takes to start answering; its throughput once it answered; and the
+    rate of the transfers with it which fail. Each transfer moves them by
+    alpha times the difference with what it measured. The last samples
+    latencies are also kept, to compute percentiles."""
+
+    alpha = 0.2
+    samples = 64
+    # Transfers smaller than that say more about latency than throughput
+    min_throughput_bytes = 64 * 1024
+
+    def __init__(self):
+        self.latency = None
+        self.throughput = None
+        self.failure_rate = 0.0
+        self._latencies = collections.deque(maxlen=self.samples)
+        self._lock = threading.Lock()
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.alpha * (value - average)
+
+    def record(self, latency, nbytes=0, duration=0):
+        """Account for a transfer which succeeded, after latency seconds,
+        transferring nbytes in duration seconds."""
+        with self._lock:
+            self.latency = self._average(self.latency, latency)
+            self._latencies.append(latency)
+            if nbytes >= self.min_throughput_bytes and duration > 0:
+                self.throughput = self._average(self.throughput, nbytes / duration)
+            self.failure_rate = self._average(self.failure_rate, 0.0)
+
+    def record_failure(self, latency=None):
+        """Account for a transfer which failed. latency is the time it
+        waited in vain for the remote to answer, if it did not."""
+        with self._lock:
+            if latency is not None:
+                self.latency = self._average(self.latency, latency)
+                self._latencies.append(latency)
+            self.failure_rate = self._average(self.failure_rate, 1.0)
+
+    def percentile(self, p):
+        """Return the latency not exceeded by a fraction p of the samples,
+        or None if there are none."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    def expected_time(self, nbytes=0):
+        """Return the expected number of seconds to transfer nbytes, counting
+        the transfers to retry after failures. Remotes never measured are
+        expected to be instant, so they get tried."""
+        with self._lock:
+            seconds = self.latency or 0
+            if self.throughput:
+                seconds += nbytes / self.throughput
+            return seconds / max(1 - self.failure_rate, 0.01)
+
+    def as_dict(self):
+        """Return the estimates known, by name."""
+        stats = { "failure_rate": self.failure_rate }
+        if self.latency is not None:
+            stats["latency"] = self.latency
+        if self.throughput is not None:
+            stats["throughput"] = self.throughput
+        return stats
+
+
+class CircuitBreaker(object):
+    """The health of a remote, to skip it while it is known to be down.
+
+    It is closed while transfers with the remote work. Once
+    failure_threshold transfers in a row failed, it opens: no transfer is
+    started with the remote for open_interval seconds. It is then
+    half-open: transfers are tried again, the first one to end closes it
+    if it succeeded, or opens it again for twice as long, up to
+    max_open_interval seconds, if it failed."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    failure_threshold = 3
+    min_open_interval = 30
+    max_open_interval = 600
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_interval = self.min_open_interval
+        self.retry_time = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a transfer can be started with the remote."""
+        with self._lock:
+            if self.state == self.OPEN and time.time() >= self.retry_time:
+                self.state = self.HALF_OPEN
+            return self.state != self.OPEN
+
+    @property
+    def probe_due(self):
+        """Whether the remote is down, and should be tried again."""
+        with self._lock:
+            return self.state == self.OPEN and time.time() >= self.retry_time
+
+    def succeeded(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.open_interval = self.min_open_interval
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.open_interval = min(self.open_interval * 2, self.max_open_interval)
+            elif self.state == self.CLOSED and self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.retry_time = time.time() + self.open_interval
+
+
+class Transfer(object):
+    """An operation with a remote, run in a thread of its own so it can be
+    given up on when the remote does not answer in time.
+
+    The remote has connect_timeout seconds to start answering, then
+    transfer_timeout seconds each time it stalls. The time spent in local
+    callbacks, like determine_wants, does not count.
+
+    The latency and throughput measured, or the failure, are accounted in
+    the stats and the health of the remote when the transfer ends."""
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.client, self.path = get_transport_and_path(remote.url,
+                                                        report_activity=self.activity)
+        self.done = False
+        self._result = None
+        self._error = None
+        self._started = False
+        self._local = 0
+        self._local_time = 0
+        self._given_up = False
+        self._start_time = self._last_activity = time.time()
+        self._first_activity = None
+        self._nbytes = 0
+        self._cond = threading.Condition()
+        self._watchers = []
+
+    def _changed(self):
+        for queue in self._watchers:
+            queue.put(self)
+
+    def activity(self, nbytes, direction):
+        with self._cond:
+            self._started = True
+            self._last_activity = time.time()
+            if self._first_activity is None:
+                self._first_activity = self._last_activity
+            self._nbytes += nbytes
+
+    def local(self, function):
+        """Wrap function so the time spent in it does not count against the
+        deadlines of the transfer."""
+        if function is None:
+            return None
+        def wrapper(*args, **kwargs):
+            with self._cond:
+                self._local += 1
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._cond:
+                    self._local -= 1
+                    self._last_activity = time.time()
+                    self._local_time += self._last_activity - start
+                    self._changed()
+        return wrapper
+
+    @property
+    def deadline(self):
+        """Return the time at which the transfer misses its deadline, or
+        None if it has none right now."""
+        with self._cond:
+            if self.done or self._local:
+                return None
+            if self._started:
+                return self._last_activity + self.remote.transfer_timeout
+            return self._last_activity + self.remote.connect_timeout
+
+    def _account(self, error):
+        if self._given_up:
+            return
+        now = time.time()
+        if error is None or isinstance(error, UpdateRefsError):
+            # The remote answered, even if only to refuse
+            first_activity = self._first_activity or now
+            self.remote.stats.record(first_activity - self._start_time, self._nbytes,
+                                     now - first_activity - self._local_time)
+            self.remote.health.succeeded()
+        elif isinstance(error, (GitProtocolError, EnvironmentError)):
+            self.remote.stats.record_failure(None if self._started
+                                             else now - self._start_time)
+            self.remote.health.failed()
+
+    def start(self, function, *args):
+        """Run function with args in a new thread."""
+        def run():
+            try:
+                result, error = function(*args), None
+            except Exception:
+                result, error = None, sys.exc_info()
+            with self._cond:
+                self.done = True
+                self._result = result
+                self._error = error
+                self._account(error and error[1])
+                self._changed()
+        thread = threading.Thread(target=run, name="Transfer with %s" % self.remote.name)
+        thread.daemon = True
+        thread.start()
+
+    def watch(self, queue):
+        """Put the transfer in queue whenever its deadline may change."""
+        with self._cond:
+            self._watchers.append(queue)
+            if self.done:
+                queue.put(self)
+
+    def get(self):
+        """Return the result of the transfer, or raise its error.
+        Raise RemoteTimeout if the transfer is not done: it missed its
+        deadline, and is given up on."""
+        with self._cond:
+            if not self.done:
+                with self.remote.transfers_lock:
+                    self.remote.hung.append(self)
+                self._give_up()
+                if self._started:
+                    raise RemoteTimeout(self.remote, "stalled for %d seconds"
+                                        % self.remote.transfer_timeout)
+                raise RemoteTimeout(self.remote, "did not answer within %d seconds"
+                                    % self.remote.connect_timeout)
+            if self._error is not None:
+                raise self._error[0], self._error[1], self._error[2]
+            return self._result
+
+    def _give_up(self):
+        if not self._given_up:
+            self._account(RemoteTimeout(self.remote, "was given up on"))
+            self._given_up = True
+
+    def expire(self):
+        """Give up on the transfer if it missed its deadline, and return
+        whether it did."""
+        deadline = self.deadline
+        if deadline is not None and deadline <= time.time():
+            with self._cond:
+                self._give_up()
+            return True
+        return False
+
+    def abandon(self):
+        """Stop waiting for the transfer, which is not needed anymore. It
+        goes on until it ends, and its stats are accounted then; if it
+        misses its deadline, the remote is considered hanging."""
+        with self._cond:
+            if not self.done:
+                with self.remote.transfers_lock:
+                    self.remote.abandoned.append(self)
+
+    def result(self):
+        """Wait for the transfer to end, and return its result."""
+        for transfer in as_completed([ self ]):
+            return transfer.get()
+
+
+def as_completed(transfers, timeout=None):
+    """Yield transfers as they end or miss their deadline, for at most
+    timeout seconds if it is not None."""
+    events = Queue.Queue()
+    pending = list(transfers)
+    for transfer in pending:
+        transfer.watch(events)
+    end = None if timeout is None else time.time() + timeout
+    while pending:
+        now = time.time()
+        deadlines = []
+        for transfer in pending[:]:
+            deadline = transfer.deadline
+            if transfer.done or (deadline is not None and deadline <= now):
+                pending.remove(transfer)
+                yield transfer
+            elif deadline is not None:
+                deadlines.append(deadline)
+        if end is not None and end <= time.time():
+            return
+        if end is not None:
+            deadlines.append(end)
+        if deadlines:
+            timeout = max(0, min(deadlines) - time.time())
+        else:
+            timeout = None
+        if pending:
+            try:
+                events.get(True, timeout)
+            except Queue.Empty:
+                pass
+
+
 class Remote(dbus.service.Object, Configurable):
 
     _id_ref = "refs/tags/id"
 
+    # Seconds given to a remote to start answering, and to go on when it
+    # stalls in the middle of a transfer
+    connect_timeout = 30
+    transfer_timeout = 120
+
+    # Seconds during which the refs advertised by the remote are reused
+    refs_ttl = 60
+
+    # Number of objects each pushed object is deltified against, and
+    # longest delta chain allowed; thin packs also use the objects the
+    # remote has as delta bases.
+    delta_window = 10
+    delta_depth = 50
+    thin_packs = True
+
+    # Percentile of the latencies of the remote after which an on-demand
+    # fetch is also asked to the next remote, and the delay used until
+    # the latency of the remote is known
+    hedge_percentile = 0.95
+    default_hedge_delay = 1
+
     def __init__(self, storage, name, url, weight=100):
         self.url = url
         self.weight = weight
         self.storage = storage
         self.name = name
-        self.client, self.path = get_transport_and_path(url)
+        # Reject bad URLs now rather than at the first transfer
+        get_transport_and_path(url)
+        # Transfers given up on which did not end yet
+        self.hung = []
+        # Transfers not waited for anymore which did not end yet
+        self.abandoned = []
+        # Transfers of several threads add to these
+        self.transfers_lock = threading.Lock()
+        self.stats = RemoteStats()
+        self.health = CircuitBreaker()
+        self._refs = None
+        self._refs_time = 0
+        self._refs_lock = threading.Lock()
         super(Remote, self).__init__(storage.bus,
                                      "%s/remotes/%s" % (storage.__dbus_object_path__, name))
 
@@ -60,6 +485,37 @@ class Remote(dbus.service.Object, Configurable):
     def GetWeight(self):
         return self.weight
 
+    @dbus.service.method(dbus_interface="%s.Remote" % BUS_INTERFACE,
+                         out_signature='a{sd}')
+    def GetStats(self):
+        """Return the latency in seconds, the throughput in bytes per
+        second and the failure rate measured on the remote, and the hedge
+        delay of on-demand fetches."""
+        stats = self.stats.as_dict()
+        stats["hedge_delay"] = self.hedge_delay()
+        return stats
+
+    @dbus.service.method(dbus_interface="%s.Remote" % BUS_INTERFACE,
+                         out_signature='s')
+    def GetHealth(self):
+        """Return whether the remote is considered up ("closed"), down
+        ("open"), or being tried again ("half-open")."""
+        return self.health.state
+
+    def expected_time(self, nbytes=0):
+        """Return the expected number of seconds to fetch nbytes."""
+        return self.stats.expected_time(nbytes)
+
+    def hedge_delay(self, nbytes=0):
+        """Return the number of seconds to wait for the remote to send
+        nbytes before asking another remote too."""
+        delay = self.stats.percentile(self.hedge_percentile)
+        if delay is None:
+            return self.default_hedge_delay
+        if self.stats.throughput:
+            delay += nbytes / self.stats.throughput
+        return delay
+
     @dbus.service.method(dbus_interface="%s.Remote" % BUS_INTERFACE,
                          out_signature='s')
     def GetID(self):
@@ -105,30 +561,134 @@ class Remote(dbus.service.Object, Configurable):
 
     @property
     def refs(self):
-        """Connect to the remote and returns all the refs it has."""
+        """Return all the refs the remote has.
+        They are cached for refs_ttl seconds, and updated by every transfer
+        with the remote."""
+        with self._refs_lock:
+            if self._refs is not None and time.time() - self._refs_time < self.refs_ttl:
+                return self._refs.copy()
         return self.fetch(lambda refs: [])
 
+    def _remember_refs(self, refs):
+        with self._refs_lock:
+            if refs is None:
+                self._refs = None
+            else:
+                self._refs = dict([ (ref, sha) for ref, sha in refs.iteritems()
+                                    if sha != ZERO_SHA ])
+                self._refs_time = time.time()
+
     @dbus.service.signal(dbus_interface="%s.Remote" % BUS_INTERFACE,
                          signature='as')
     def FetchProgress(self, status):
         pass
 
+    def _transfer(self):
+        """Return a new Transfer with the remote, unless one given up on
+        is still hanging, or the remote is known to be down."""
+        # Abandoned transfers are not waited for: give up on the ones
+        # which missed their deadline here. Transfers lock themselves
+        # before the remote, so do not hold its lock meanwhile.
+        with self.transfers_lock:
+            abandoned = list(self.abandoned)
+        expired = [ transfer for transfer in abandoned if transfer.expire() ]
+        with self.transfers_lock:
+            self.abandoned = [ transfer for transfer in self.abandoned
+                               if not transfer.done and transfer not in expired ]
+            self.hung = [ transfer for transfer in self.hung + expired if not transfer.done ]
+            hanging = bool(self.hung)
+        if hanging:
+            raise RemoteTimeout(self, "is still hanging")
+        if not self.health.allow():
+            raise RemoteTimeout(self, "is down, next try in %d seconds"
+                                % max(0, self.health.retry_time - time.time()))
+        return Transfer(self)
+
     def fetch(self, determine_wants=None):
         """Fetch data from the remote.
         The function passed in determine_wats is called with the refs dict as first and only argument:
         { "refs/heads/master": "08a1c9f9742bcbd27c44fb84b662c68fabd995e1",
         … }
         The determine_wants function should returns a list of SHA1 to fetch."""
-        return self.client.fetch(self.path, self.storage, determine_wants, self.FetchProgress)
+        return self.start_fetch(determine_wants).result()
+
+    def start_fetch(self, determine_wants=None):
+        """Start fetching data from the remote, and return the Transfer."""
+        if determine_wants is None:
+            determine_wants = self.storage.object_store.determine_wants_all
+
+        def remember_and_determine_wants(refs):
+            self._remember_refs(refs)
+            return determine_wants(refs)
+
+        transfer = self._transfer()
+        transfer.start(transfer.client.fetch, transfer.path, self.storage,
+                       transfer.local(remember_and_determine_wants), self.FetchProgress)
+        return transfer
+
+    def start_probe(self):
+        """Start fetching the refs of the remote only, to check whether it
+        answers, and return the Transfer."""
+        return self.start_fetch(lambda refs: [])
 
     def push(self, determine_wants):
         """Push data to the remote.
         The function passed in determine_wants is called with the refs dict as first and only argument:
         { "refs/heads/master": "08a1c9f9742bcbd27c44fb84b662c68fabd995e1",
         … } """
-        return self.client.send_pack(self.path,
-                                     determine_wants,
-                                     self.storage.object_store.generate_pack_contents)
+        return self.start_push(determine_wants).result()
+
+    def start_push(self, determine_wants):
+        """Start pushing data to the remote, and return the Transfer."""
+        transfer = self._transfer()
+
+        def push():
+            # Forget the refs while they change
+            self._remember_refs(None)
+            refs = transfer.client.send_pack(transfer.path,
+                                             transfer.local(determine_wants),
+                                             transfer.local(lambda have, want:
+                                                                self.generate_pack_contents(have, want, transfer.activity)))
+            self._remember_refs(refs)
+            return refs
+
+        transfer.start(push)
+        return transfer
+
+    def generate_pack_contents(self, have, want, report_activity=None):
+        """Return the PackContents to send to the remote, which has the
+        objects of have and wants the ones of want. report_activity is
+        called as the pack gets written."""
+        object_store = self.storage.object_store
+        # Only commits and tags can be walked: chunks are wanted and had
+        # through their refs, and are sent as is. Known chunks are skipped
+        # without reading them to check their type.
+        chunks = set(self.storage.refs.as_dict("refs/blobs").itervalues())
+        have_commits = [ sha for sha in have
+                         if sha not in chunks and is_commit_or_tag(object_store, sha) ]
+        want_commits = [ sha for sha in want
+                         if sha not in chunks and is_commit_or_tag(object_store, sha) ]
+        objects = list(object_store.find_missing_objects(have_commits, want_commits))
+        sent = set(have).union([ sha for sha, path in objects ])
+        for sha in set(want).difference(want_commits):
+            if sha not in sent:
+                objects.append((sha, None))
+                sent.add(sha)
+        base_trees = []
+        if self.thin_packs:
+            # The previous records of the pushed heads make the best bases,
+            # then any record the remote has
+            heads = set(self.storage.refs.as_dict("refs/storages").itervalues())
+            for sha in heads.intersection(want_commits):
+                for parent in object_store[sha].parents:
+                    if parent in have_commits:
+                        base_trees.append(object_store[parent].tree)
+            for sha in have_commits:
+                obj = object_store[sha]
+                if isinstance(obj, Commit) and obj.tree not in base_trees:
+                    base_trees.append(obj.tree)
+        return PackContents(object_store, objects, base_trees,
+                            self.delta_window, self.delta_depth, report_activity)
 
     def __le__(self, other):
         if isinstance(other, Remote):
@@ -152,35 +712,112 @@ class Remote(dbus.service.Object, Configurable):
 
 
 class Syncer(threading.Thread):
+    """Keep a storage in sync with its remotes.
+
+    The storage is pushed when its refs moved since the last push which
+    succeeded, e.g. because a box committed. It is fetched every
+    fetch_interval seconds: the interval doubles up to max_fetch_interval
+    each time a fetch brings nothing new, and goes back to
+    min_fetch_interval as soon as refs move, here or on a remote. Blobs
+    are only fetched, and boxes only updated, once refs moved or
+    replication policies changed."""
+
+    min_fetch_interval = 5
+    max_fetch_interval = 300
 
     def __init__(self, storage):
         self.storage = storage
         super(Syncer, self).__init__()
         self.daemon = True
         self.name = "Syncer for %s" % self.storage.path
+        self.fetch_interval = self.min_fetch_interval
+        self.next_fetch = 0
+        self._pushed_refs = None
+        # The refs of the storage at the previous sync
+        self._local_refs = None
+        self._refs_moved = True
 
     def run(self):
         while True:
-            # XXX configure timeout
-            print "WAIT"
-            self.storage.must_be_sync.wait(5)
+            self.storage.must_be_sync.wait(max(0, self.wakeup_time() - time.time()))
             self.storage.must_be_sync.clear()
-            print "END WAIT"
-            print "PUSH"
             try:
-                self.storage.push()
-            except HangupException as e:
-                print "> Unable to push: %s" % str(e)
-            print "FETCH"
+                self.sync()
+            except Exception:
+                traceback.print_exc()
+                # Do not retry right away
+                self.next_fetch = max(self.next_fetch, time.time() + self.fetch_interval)
+
+    def wakeup_time(self):
+        """Return the time of the next sync: the next fetch, or the next
+        probe of a remote known to be down. Remotes still hanging cannot
+        be probed, and are left out."""
+        wakeup = self.next_fetch
+        for remote in self.storage.remotes.values():
+            with remote.transfers_lock:
+                hanging = [ transfer for transfer in remote.hung if not transfer.done ]
+            if remote.health.state == CircuitBreaker.OPEN and not hanging:
+                wakeup = min(wakeup, remote.health.retry_time)
+        return wakeup
+
+    def policies_changed(self):
+        """Fetch blobs at the next sync, as the replication policies changed."""
+        self._refs_moved = True
+        self.storage.must_be_sync.set()
+
+    def probe(self):
+        """Probe the remotes known to be down which are due to be tried
+        again. Return True if one of them is back."""
+        transfers = []
+        for remote in self.storage.remotes.values():
+            if remote.health.probe_due:
+                try:
+                    transfers.append(remote.start_probe())
+                except HangupException as e:
+                    # Still hanging: try again later, not at once
+                    print "> Remote %s is still down: %s" % (remote.name, str(e))
+                    remote.health.failed()
+        back = False
+        for transfer in as_completed(transfers):
             try:
-                self.storage.fetch()
-            except HangupException as e:
-                print "> Unable to fetch: %s" % str(e)
+                transfer.get()
+            except (HangupException, EnvironmentError) as e:
+                print "> Remote %s is still down: %s" % (transfer.remote.name, str(e))
+            else:
+                print "> Remote %s is back" % transfer.remote.name
+                back = True
+        return back
+
+    def sync(self):
+        """Push, fetch and update what needs to be."""
+        if self.probe():
+            self._pushed_refs = None
+            self.next_fetch = 0
+        refs = self.storage.refs.as_dict("refs/storages")
+        if refs != self._local_refs:
+            # Refs moved here, not only a push to retry
+            self.fetch_interval = self.min_fetch_interval
+            self._local_refs = refs
+        if refs != self._pushed_refs:
+            print "PUSH"
+            if self.storage.push():
+                self._pushed_refs = refs
+        if time.time() >= self.next_fetch:
+            print "FETCH"
+            if self.storage.fetch():
+                self.fetch_interval = self.min_fetch_interval
+                self._refs_moved = True
+            else:
+                self.fetch_interval = min(self.fetch_interval * 2, self.max_fetch_interval)
+            self.next_fetch = time.time() + self.fetch_interval
+        if self._refs_moved:
             print "FETCH BLOBS"
             try:
                 self.storage.fetch_blobs()
             except FetchError as e:
                 print "> Unable to fetch blobs: %s" % str(e)
+            else:
+                self._refs_moved = False
             print "UPDATE FROM REMOTES"
             self.storage.update_from_remotes()
-
+        self.storage.evict_chunks()
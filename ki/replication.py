@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.replication -- Which chunks of a box a storage keeps
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+from .objects import Record, walk_tree
+from .utils import parse_size
+
+
+class ReplicationPolicy(object):
+    """Which chunks of a box a storage fetches from the remotes ahead of
+    their use. The policy is one of:
+
+      "full":        the chunks of every record of the box,
+      "head":        the chunks of its last record only,
+      "last N days": the chunks of the records of the last N days, and of
+                     the last record,
+      "max N GB":    the chunks of the most recent records, up to N GB
+                     (or KB, MB, TB),
+      "on demand":   no chunk.
+
+    The chunks not fetched ahead are fetched when they are read."""
+
+    FULL = "full"
+    HEAD = "head"
+    DAYS = "days"
+    SIZE = "size"
+    ON_DEMAND = "on demand"
+
+    def __init__(self, spec=FULL):
+        self.spec = spec
+        self.days = None
+        self.max_bytes = None
+        spec = " ".join(spec.lower().split())
+        if spec == self.FULL:
+            self.kind = self.FULL
+        elif spec in (self.HEAD, "head only"):
+            self.kind = self.HEAD
+        elif spec in (self.ON_DEMAND, "on-demand"):
+            self.kind = self.ON_DEMAND
+        else:
+            days = re.match(r"^last (\d+(?:\.\d+)?) days?$", spec)
+            if days:
+                self.kind = self.DAYS
+                self.days = float(days.group(1))
+            elif spec.startswith("max "):
+                self.kind = self.SIZE
+                try:
+                    self.max_bytes = parse_size(spec[4:])
+                except ValueError:
+                    raise ValueError("Unknown replication policy: %s" % self.spec)
+            else:
+                raise ValueError("Unknown replication policy: %s" % self.spec)
+
+    def __str__(self):
+        return self.spec
+
+    def _commits(self, storage, head):
+        """Return the commit head, then the commits reachable from it, the
+        most recent first."""
+        commits = {}
+        todo = list(storage[head].parents)
+        while todo:
+            sha = todo.pop()
+            if sha not in commits:
+                commits[sha] = storage[sha]
+                todo.extend(commits[sha].parents)
+        return [ storage[head] ] + sorted(commits.itervalues(),
+                                         key=lambda commit: -commit.commit_time)
+
+    def blobs(self, storage, head, pool=None):
+        """Return the set of the chunks to fetch ahead for the commit head
+        of a box."""
+        if self.kind == self.FULL:
+            return Record(storage, storage[head]).determine_blobs(pool)
+        if self.kind == self.ON_DEMAND:
+            return set()
+        if self.kind == self.HEAD:
+            commits = [ storage[head] ]
+        else:
+            commits = self._commits(storage, head)
+        if self.kind == self.DAYS:
+            since = time.time() - self.days * 24 * 3600
+            commits = [ commits[0] ] + [ commit for commit in commits[1:]
+                                         if commit.commit_time >= since ]
+        blobs = set()
+        size = 0
+        for commit in commits:
+            for entry in walk_tree(storage, commit.tree, pool=pool):
+                for chunk_size, chunk in entry.chunks:
+                    if chunk is None or chunk in blobs:
+                        continue
+                    if self.max_bytes is not None and size + chunk_size > self.max_bytes:
+                        return blobs
+                    blobs.add(chunk)
+                    size += chunk_size
+        return blobs
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.staging -- Bound the memory used by uncommitted data
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import time
+import tempfile
+import threading
+
+
+class DirtyBudget(object):
+    """Account for the data written and not committed yet.
+
+    resident is the number of dirty bytes held in memory, used the number
+    of dirty bytes held in memory or in a staging area. Going over the soft
+    limit of resident bytes means data should be spilled to disk, going
+    over the hard limit of used bytes means writers should wait for a
+    commit.
+
+    A budget can have a parent, e.g. the budget of a storage for the
+    budget of a box: everything charged to a budget is charged to its
+    parent too."""
+
+    def __init__(self, soft_limit, hard_limit, parent=None):
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.parent = parent
+        self.resident = 0
+        self.used = 0
+        # The whole hierarchy shares one condition, so waiters on a budget
+        # wake up when any of its children releases data.
+        if parent is None:
+            self._cond = threading.Condition()
+        else:
+            self._cond = parent._cond
+
+    def _add(self, resident, used):
+        budget = self
+        while budget is not None:
+            budget.resident = max(0, budget.resident + resident)
+            budget.used = max(0, budget.used + used)
+            budget = budget.parent
+
+    def charge(self, nbytes):
+        """Account for nbytes bytes of new dirty data in memory."""
+        with self._cond:
+            self._add(nbytes, nbytes)
+
+    def spilled(self, nbytes):
+        """Account for nbytes bytes of dirty data moved out of memory."""
+        with self._cond:
+            self._add(-nbytes, 0)
+
+    def reset(self):
+        """Forget about all the dirty data of this budget, e.g. because it
+        got committed."""
+        with self._cond:
+            self._add(-self.resident, -self.used)
+            self._cond.notify_all()
+
+    @property
+    def over_soft(self):
+        """Whether this budget or one of its parents has too much dirty
+        data in memory."""
+        budget = self
+        while budget is not None:
+            if budget.resident > budget.soft_limit:
+                return True
+            budget = budget.parent
+        return False
+
+    @property
+    def over_hard(self):
+        """Whether this budget or one of its parents has too much dirty
+        data overall."""
+        budget = self
+        while budget is not None:
+            if budget.used > budget.hard_limit:
+                return True
+            budget = budget.parent
+        return False
+
+    def wait(self, timeout):
+        """Wait for at most timeout seconds for the budget to go back under
+        its hard limit. Return True if it did."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.over_hard:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @property
+    def stats(self):
+        with self._cond:
+            return { "dirty_resident_bytes": self.resident,
+                     "dirty_used_bytes": self.used }
+
+
+class StagingArea(object):
+    """An append-only scratch file, mapped in memory, holding dirty data
+    until it gets committed. The file shrinks back once no block uses its
+    content anymore."""
+
+    def __init__(self, directory=None, initial_size=1024 * 1024):
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        self._file = tempfile.TemporaryFile(prefix="staging-", dir=directory)
+        self._initial_size = initial_size
+        # StagedBlock-s can be garbage collected while we hold the lock
+        self._lock = threading.RLock()
+        self._map = None
+        self._capacity = 0
+        self._end = 0
+        self._blocks = 0
+
+    def __len__(self):
+        """Return the number of bytes staged."""
+        return self._end
+
+    def _grow(self, size):
+        capacity = max(self._capacity * 2, self._initial_size)
+        while capacity < size:
+            capacity *= 2
+        if self._map is not None:
+            self._map.close()
+        os.ftruncate(self._file.fileno(), capacity)
+        self._map = mmap.mmap(self._file.fileno(), capacity)
+        self._capacity = capacity
+
+    def stage(self, data):
+        """Copy data in the staging area and return a StagedBlock for it."""
+        with self._lock:
+            offset = self._end
+            if offset + len(data) > self._capacity:
+                self._grow(offset + len(data))
+            self._map[offset:offset + len(data)] = data
+            self._end += len(data)
+            self._blocks += 1
+        return StagedBlock(self, offset, len(data))
+
+    def read(self, offset, length):
+        with self._lock:
+            return self._map[offset:offset + length]
+
+    def _release(self):
+        with self._lock:
+            self._blocks -= 1
+            if self._blocks == 0 and self._map is not None:
+                # Nothing points to our content anymore, start over
+                self._map.close()
+                self._map = None
+                os.ftruncate(self._file.fileno(), 0)
+                self._capacity = 0
+                self._end = 0
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+
+
+class StagedBlock(object):
+    """A piece of data stored in a StagingArea.
+    This behaves like a read-only string, so it can be stored in a rope."""
+
+    __slots__ = ('area', 'offset', 'length')
+
+    def __init__(self, area, offset, length):
+        self.area = area
+        self.offset = offset
+        self.length = length
+
+    def __del__(self):
+        self.area._release()
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.area.read(self.offset, self.length)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            if key < 0:
+                key += self.length
+            key = slice(key, key + 1)
+        start, stop, step = key.indices(self.length)
+        if stop <= start:
+            return ""
+        data = self.area.read(self.offset + start, stop - start)
+        if step != 1:
+            return data[::step]
+        return data
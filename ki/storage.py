@@ -18,22 +18,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from .fuse import FUSE
+from .fuse import FUSE, fuse_can_invalidate
 from .utils import *
 from .config import Configurable, Config, BUS_INTERFACE
-from .objects import Record, FileBlock, FetchError
-from .remote import Remote, Syncer
-from .commiter import TimeCommiter
+from .objects import Record, FileBlock, FetchError, CommitTimeIndex, walk_tree, read_chunks
+from .remote import Remote, RemoteTimeout, Syncer, as_completed
+from .commiter import CommitScheduler
+from .journal import Journal
+from .staging import DirtyBudget, StagingArea
+from .usage import Usage
+from .replication import ReplicationPolicy
+from .cache import ChunkCache
 from .fs import KiFuse
 from dulwich.repo import Repo, BASE_DIRECTORIES, OBJECTDIR, DiskObjectStore
 from dulwich.client import UpdateRefsError
 from dulwich.objects import Commit, Blob
-from dulwich.errors import HangupException
+from dulwich.errors import GitProtocolError
+from dulwich.object_store import tree_lookup_path
 import os
+import stat
+import time
 import uuid
+import errno
 import xdg.BaseDirectory
 import threading
 import dbus.service
+from multiprocessing.pool import ThreadPool
 
 BUS_PATH = "/org/naquadah/Ki"
 
@@ -85,12 +95,36 @@ class StorageManager(dbus.service.Object):
 class Storage(Repo, dbus.service.Object, Configurable):
     """Storage based on a repository."""
 
+    # Limits of uncommitted data for all the boxes of the storage
+    dirty_soft_limit = 128 * 1024 * 1024
+    dirty_hard_limit = 1024 * 1024 * 1024
+
+    # Number of objects asked for in one negotiation with a remote, and
+    # number of such negotiations running at once
+    fetch_batch_size = 10000
+    fetch_batches_in_flight = 4
+
+    # Typical size of a chunk, used to rank remotes for on-demand fetches
+    fetch_object_size = 8192
+    # Seconds an on-demand fetch waits for the remotes before failing
+    fetch_timeout = 10
+    # Number of objects asked for in one on-demand fetch
+    fetch_demand_size = 64
+    # Seconds between two evictions while the chunks exceed the cache size
+    evict_interval = 300
+
     def __init__(self, bus, path):
         self.bus = bus
         self.remotes = {}
         self._boxes = {}
         self.must_be_sync = threading.Event()
+        self.dirty_budget = DirtyBudget(self.dirty_soft_limit, self.dirty_hard_limit)
         Repo.__init__(self, path)
+        self.usage = Usage(self, os.path.join(self.controldir(), "usage"))
+        self.cache = ChunkCache(self, os.path.join(self.controldir(), "chunks"))
+        # When chunks were last evicted, and the bytes of chunks then
+        self._evict_time = 0
+        self._evict_bytes = 0
         dbus.service.Object.__init__(self, bus,
                                      "%s/%s_%s" % (BUS_PATH,
                                                    dbus_clean_name(os.path.splitext(os.path.basename(path))[0]),
@@ -107,6 +141,24 @@ class Storage(Repo, dbus.service.Object, Configurable):
             self.refs[Remote._id_ref] = f.store()
             return str(f)
 
+    @property
+    def walk_pool(self):
+        """Thread pool used to walk trees in parallel."""
+        try:
+            return self._walk_pool
+        except AttributeError:
+            self._walk_pool = ThreadPool(4)
+        return self._walk_pool
+
+    @property
+    def fetch_pool(self):
+        """Thread pool used to fetch batches of objects in parallel."""
+        try:
+            return self._fetch_pool
+        except AttributeError:
+            self._fetch_pool = ThreadPool(self.fetch_batches_in_flight)
+        return self._fetch_pool
+
     @property
     def config(self):
         try:
@@ -149,9 +201,27 @@ class Storage(Repo, dbus.service.Object, Configurable):
         return dict([ ("refs/blobs/%s" % blob, blob) for blob in blobs ])
 
     def push(self):
-        """Push all boxes to all remotes."""
+        """Push all boxes to all remotes, in parallel.
+        Return True if every remote got pushed."""
+        # The blobs of each head, computed once for all the remotes
+        head_blobs = {}
+        head_blobs_lock = threading.Lock()
+
+        def blobs_of(head):
+            with head_blobs_lock:
+                try:
+                    return head_blobs[head]
+                except KeyError:
+                    blobs = self.refs.as_dict("refs/blobs")
+                    # XXX implements and use history(Ndays)
+                    head_blobs[head] = self.blobs_list_dict(filter(blobs.has_key,
+                                                                   Record(self, head).determine_blobs(self.walk_pool)))
+                return head_blobs[head]
+
+        pushed = True
+        transfers = []
         for remote in self.iterremotes():
-            def determine_wants(oldrefs):
+            def determine_wants(oldrefs, remote=remote):
                 """Determine wants for a remote having refs.
                 Return a dict { ref: sha } used to update the remote when pushing."""
                 newrefs = oldrefs.copy()
@@ -160,32 +230,239 @@ class Storage(Repo, dbus.service.Object, Configurable):
                     # Do NOT push the storage stuff it's the remote ones!
                     if branch_name.split('/', 1)[0] != remote.id:
                         newrefs["refs/storages/%s" % branch_name] = head
-                        # XXX implements and use history(Ndays)
-                        newrefs.update(self.blobs_list_dict(filter(lambda blob:
-                                                                       self.refs.as_dict("refs/blobs").has_key(blob),
-                                                                   Record(self, head).determine_blobs())))
+                        newrefs.update(blobs_of(head))
                 return newrefs
 
             try:
-                remote.push(determine_wants)
+                transfers.append(remote.start_push(determine_wants))
+            except RemoteTimeout as e:
+                print "> Unable to push: %s" % str(e)
+                pushed = False
+
+        for transfer in as_completed(transfers):
+            try:
+                transfer.get()
             except UpdateRefsError as e:
                 print "> Update ref error"
                 print e.ref_status
+                pushed = False
+            except (GitProtocolError, EnvironmentError) as e:
+                # Accounted as a failure of the remote: go on with the others
+                print "> Unable to push: %s" % str(e)
+                pushed = False
+
+        return pushed
 
     def fetch(self):
-        """Fetch all boxes from all remotes."""
+        """Fetch all boxes from all remotes, in parallel.
+        Return True if refs moved."""
+        transfers = []
         for remote in self.iterremotes():
-            refs = self._fetch_determine_refs(remote.fetch(lambda refs:
-                                                               self._fetch_determine_refs(refs).values()))
-            for ref, sha in refs.iteritems():
-                # Store fetched refs: refs["refs/storages/REMOTE_ID/…"] = sha
-                self.refs[ref] = sha
+            try:
+                transfers.append(remote.start_fetch(lambda refs:
+                                                        self._fetch_determine_refs(refs).values()))
+            except RemoteTimeout as e:
+                print "> Unable to fetch: %s" % str(e)
+
+        fetched = {}
+        for transfer in as_completed(transfers):
+            try:
+                fetched[transfer] = self._fetch_determine_refs(transfer.get())
+            except (GitProtocolError, EnvironmentError) as e:
+                print "> Unable to fetch: %s" % str(e)
+
+        # Store fetched refs in the order of the remotes:
+        # refs["refs/storages/REMOTE_ID/…"] = sha
+        refs = dict([ ("refs/storages/%s" % ref, sha)
+                      for ref, sha in self.refs.as_dict("refs/storages").iteritems() ])
+        moved = False
+        for transfer in transfers:
+            for ref, sha in fetched.get(transfer, {}).iteritems():
+                if refs.get(ref) != sha:
+                    self.refs[ref] = refs[ref] = sha
+                    moved = True
+        return moved
+
+    def replication_policy(self, box_name):
+        """Return the ReplicationPolicy of the box box_name.
+        It is set in the config as config["boxes"][box_name]["replication"],
+        the default being config["replication"], then "full"."""
+        config = self.config
+        try:
+            spec = config["boxes"][box_name]["replication"]
+        except KeyError:
+            try:
+                spec = config["replication"]
+            except KeyError:
+                spec = ReplicationPolicy.FULL
+        try:
+            return ReplicationPolicy(spec)
+        except ValueError as e:
+            print "> %s, replicating box %s fully" % (str(e), box_name)
+            return ReplicationPolicy()
 
     def fetch_blobs(self):
-        """Fetch all needed blobs."""
-        for head in self.refs.as_dict("refs/storages").itervalues():
-            for blob in self.blobs_list_dict(Record(self, head).determine_blobs()).itervalues():
-                self[blob]
+        """Fetch the blobs the replication policy of each box asks for.
+        The others get fetched when they are read."""
+        blobs = set()
+        policies = {}
+        for branch_name, head in self.refs.as_dict("refs/storages").iteritems():
+            box_name = branch_name.split('/', 1)[1]
+            if box_name not in policies:
+                policies[box_name] = self.replication_policy(box_name)
+            blobs.update(policies[box_name].blobs(self, head, self.walk_pool))
+        # Evicted chunks only come back when read, pinned ones always do
+        blobs = set([ blob for blob in blobs if not self.cache.evicted(blob) ])
+        blobs.update(self.pinned_chunks())
+        try:
+            self._fetch_in_batches(blobs)
+        finally:
+            self.usage.save()
+
+    def fetch_sha1s(self, sha1s):
+        """Fetch the objects of sha1s missing from the storage, which are
+        needed now, e.g. to be read. They are asked for fetch_demand_size
+        at a time from the remotes expected to send them the soonest,
+        within fetch_timeout, rather than queued behind the batches of
+        fetch_blobs. Raise FetchError if some could not be fetched."""
+        missing = [ sha1 for sha1 in set(sha1s) if sha1 not in self.object_store ]
+        for i in xrange(0, len(missing), self.fetch_demand_size):
+            self._fetch_sha1s(missing[i:i + self.fetch_demand_size])
+
+    def _fetch_in_batches(self, sha1s):
+        """Fetch the objects of sha1s missing from the storage.
+        They are asked for fetch_batch_size at a time, so a few negotiations
+        with the remotes fetch them all, several batches being fetched at
+        once. Raise FetchError if some could not be fetched."""
+        missing = [ sha1 for sha1 in set(sha1s) if sha1 not in self.object_store ]
+        if missing:
+            batches = [ missing[i:i + self.fetch_batch_size]
+                        for i in xrange(0, len(missing), self.fetch_batch_size) ]
+            not_found = []
+            for batch_not_found in self.fetch_pool.imap_unordered(self._fetch_batch, batches):
+                not_found.extend(batch_not_found)
+            if not_found:
+                raise FetchError(not_found[0])
+
+    def _fetch_batch(self, sha1s):
+        """Fetch sha1s, asking each remote in turn for the ones it has and
+        the previous ones did not. Return the list of the ones not found."""
+        for remote in self.iterremotes():
+            def determine_wants(refs):
+                advertised = set(refs.itervalues())
+                return [ sha1 for sha1 in sha1s if sha1 in advertised ]
+            try:
+                remote.fetch(determine_wants)
+            except (GitProtocolError, EnvironmentError) as e:
+                print "> Unable to fetch from %s: %s" % (remote.name, str(e))
+            still_missing = []
+            for sha1 in sha1s:
+                if sha1 in self.object_store:
+                    self._fetched(sha1)
+                else:
+                    still_missing.append(sha1)
+            sha1s = still_missing
+            if not sha1s:
+                break
+        return sha1s
+
+    def _fetched(self, sha1):
+        """Account for the object sha1 just fetched, and keep it from being
+        garbage collected if it is a chunk."""
+        type_num, raw = self.object_store.get_raw(sha1)
+        if type_num == Blob.type_num and "refs/blobs/%s" % sha1 not in self.refs:
+            self.refs["refs/blobs/%s" % sha1] = sha1
+            self.usage.add_chunk(len(raw))
+            self.cache.add(sha1, len(raw))
+
+    def pinned_chunks(self):
+        """Return the set of the chunks of the pinned paths, which are
+        always kept local. Paths are pinned per box in the config, as
+        config["cache"]["pins"] = { box_name: [ path, … ] }."""
+        try:
+            pins = self.config["cache"]["pins"]
+        except KeyError:
+            return set()
+        chunks = set()
+        for branch_name, head in self.refs.as_dict("refs/storages").iteritems():
+            for path in pins.get(branch_name.split('/', 1)[1], []):
+                path = path.strip('/').encode('utf-8')
+                if path:
+                    try:
+                        mode, sha = tree_lookup_path(self.__getitem__, self[head].tree, path)
+                    except KeyError:
+                        continue
+                else:
+                    mode, sha = stat.S_IFDIR, self[head].tree
+                if stat.S_ISDIR(mode):
+                    for entry in walk_tree(self, sha, pool=self.walk_pool):
+                        chunks.update([ chunk for size, chunk in entry.chunks if chunk is not None ])
+                elif stat.S_ISREG(mode):
+                    chunks.update([ chunk for size, chunk in read_chunks(self, sha) if chunk is not None ])
+        return chunks
+
+    def evict_chunks(self):
+        """Evict the chunks read the longest ago until the chunks of the
+        storage fit in its cache size, if it has one. Only the chunks
+        stored on enough remotes, and not pinned, are evicted. The cache
+        is set in the config, as
+        config["cache"] = { "max_size": "10 GB", "replicas": 2 }.
+        While the chunks stay too big, e.g. because they are all pinned,
+        this is only tried again every evict_interval seconds, or once
+        they grew."""
+        try:
+            config = self.config["cache"]
+            max_bytes = parse_size(config["max_size"])
+        except KeyError:
+            self.cache.save()
+            return
+        except ValueError as e:
+            print "> Not evicting chunks: %s" % str(e)
+            self.cache.save()
+            return
+        chunk_bytes = self.usage.chunk_bytes
+        excess = chunk_bytes - max_bytes
+        if excess <= 0 or (chunk_bytes <= self._evict_bytes
+                           and time.time() < self._evict_time + self.evict_interval):
+            self.cache.save()
+            return
+        self._evict_time = time.time()
+        self._evict_bytes = chunk_bytes
+        replicas = config.get("replicas", 2)
+        pinned = self.pinned_chunks()
+        # The id of the storage is read all the time
+        try:
+            pinned.add(self.refs[Remote._id_ref])
+        except KeyError:
+            pass
+        # Listed once a chunk could be evicted, if any
+        remote_chunks = []
+
+        def evictable(sha):
+            if sha in pinned:
+                return False
+            if not remote_chunks:
+                remote_chunks.append(self._remote_chunks())
+            return len([ chunks for chunks in remote_chunks[0] if sha in chunks ]) >= replicas
+
+        chunks, nbytes = self.cache.evict(excess, evictable)
+        print "> Evicted %d chunks (%d bytes)" % (chunks, nbytes)
+
+    def _remote_chunks(self):
+        """Return the set of the chunks of each remote which answered."""
+        remote_chunks = []
+        for remote in self.iterremotes():
+            try:
+                # Not the cached refs: a chunk the remote dropped since
+                # would be evicted with no copy left. A remote with no
+                # refs at all gives None.
+                refs = remote.fetch(lambda refs: []) or {}
+            except (GitProtocolError, EnvironmentError) as e:
+                print "> Unable to list the chunks of %s: %s" % (remote.name, str(e))
+                continue
+            remote_chunks.append(set([ sha for ref, sha in refs.iteritems()
+                                       if ref.startswith("refs/blobs/") ]))
+        return remote_chunks
 
     def update_from_remotes(self):
         for box in self._boxes.itervalues():
@@ -193,30 +470,85 @@ class Storage(Repo, dbus.service.Object, Configurable):
 
     def __getitem__(self, key):
         try:
-            return super(Storage, self).__getitem__(key)
+            obj = super(Storage, self).__getitem__(key)
         except KeyError:
             # SHA1 not found, try to fetch it
-            return super(Storage, self).__getitem__(self._fetch_sha1(key))
+            self._fetch_sha1s([ key ])
+            obj = super(Storage, self).__getitem__(key)
+        if isinstance(obj, Blob):
+            self.cache.read(key)
+        return obj
 
     def iterremotes(self):
         """Iterate over remotes, honoring weight."""
         for remote in sorted(self.remotes.values()):
             yield remote
 
-    def _fetch_sha1(self, sha1):
-        for remote in self.iterremotes():
-            # Try to fetch and return the sha1 if ok
-            try:
-                print "> Trying to fetch %s on remote %s" % (sha1, remote)
-                remote.fetch_sha1s([ sha1 ])
-                if isinstance(self[sha1], Blob):
-                    self.refs["refs/blobs/%s" % sha1] = sha1
-                return sha1
-            # If fetch failed, continue to next remote
-            except HangupException:
-                pass
-        # We were unable to fetch
-        raise FetchError(sha1)
+    def ranked_remotes(self, nbytes=0):
+        """Return the remotes, the ones expected to send nbytes the soonest
+        first, then honoring weight."""
+        return sorted(self.remotes.values(),
+                      key=lambda remote: (remote.expected_time(nbytes), remote.weight))
+
+    def _fetch_sha1s(self, sha1s):
+        """Fetch sha1s from the remote expected to send them the soonest.
+        When a remote did not send them within its hedge delay, or failed
+        to, the next remote is asked too, for the ones still missing: the
+        first one to send them wins. The others are abandoned, and
+        cancelled: they do not want them anymore once they get to them.
+        Raise FetchError if no remote sent them within fetch_timeout
+        seconds, right away if all the remotes are known to be down."""
+        def missing():
+            return [ sha1 for sha1 in sha1s if sha1 not in self.object_store ]
+
+        def determine_wants(refs):
+            wants = missing()
+            if len(wants) > 1:
+                # A want the remote does not have would fail the others
+                advertised = set(refs.itervalues())
+                wants = [ sha1 for sha1 in wants if sha1 in advertised ]
+            return wants
+
+        nbytes = self.fetch_object_size * len(sha1s)
+        remotes = self.ranked_remotes(nbytes)
+        pending = []
+        end = time.time() + self.fetch_timeout
+        while missing() and time.time() < end:
+            hedge_delay = None
+            while remotes:
+                remote = remotes.pop(0)
+                print "> Trying to fetch %s%s on remote %s" % (
+                    sha1s[0], len(sha1s) > 1 and " and %d more" % (len(sha1s) - 1) or "",
+                    remote.name)
+                try:
+                    pending.append(remote.start_fetch(determine_wants))
+                except RemoteTimeout:
+                    continue
+                if remotes:
+                    hedge_delay = remote.hedge_delay(nbytes)
+                break
+            if not pending:
+                break
+            timeout = max(0, end - time.time())
+            if hedge_delay is not None:
+                timeout = min(timeout, hedge_delay)
+            for transfer in as_completed(pending, timeout):
+                pending.remove(transfer)
+                try:
+                    transfer.get()
+                except (GitProtocolError, EnvironmentError) as e:
+                    print "> Unable to fetch from %s: %s" % (transfer.remote.name, str(e))
+                # Ask the next remote right away for what is still missing
+                break
+        for transfer in pending:
+            transfer.abandon()
+        not_found = missing()
+        for sha1 in sha1s:
+            if sha1 not in not_found:
+                self._fetched(sha1)
+        if not_found:
+            # We were unable to fetch
+            raise FetchError(not_found[0])
 
     def get_box(self, name, create=False):
         try:
@@ -260,6 +592,13 @@ class Storage(Repo, dbus.service.Object, Configurable):
     def ListRemotes(self):
         return [ r.__dbus_object_path__ for r in  self.iterremotes() ]
 
+    @dbus.service.method(dbus_interface="%s.Storage" % BUS_INTERFACE,
+                         out_signature='a{sd}')
+    def GetUsage(self):
+        """Return the number of chunks stored and their size in bytes."""
+        return { "chunks": self.usage.chunks,
+                 "chunk_bytes": self.usage.chunk_bytes }
+
     @dbus.service.method(dbus_interface="%s.Storage" % BUS_INTERFACE,
                          out_signature='s')
     def GetPath(self):
@@ -286,8 +625,23 @@ class NoRecord(Exception):
 
 class Box(threading.Thread, dbus.service.Object):
 
+    # Default options of the FUSE mount
+    default_mount_options = { "entry_timeout": 1.0,
+                              "attr_timeout": 1.0,
+                              "kernel_cache": False,
+                              "fetch_errno": errno.EIO }
+
+    # Above the soft limit of uncommitted data in memory, it gets spilled
+    # to disk and committed early. Above the hard limit of uncommitted
+    # data, writers wait for the commit.
+    dirty_soft_limit = 32 * 1024 * 1024
+    dirty_hard_limit = 256 * 1024 * 1024
+
     def __init__(self, storage, name, create=False):
         self.head_lock = threading.RLock()
+        # Held shared by file system operations, and exclusively when the
+        # tree gets stored or replaced.
+        self.tree_lock = RWLock()
         self.config = {}
         self.storage = storage
         self.box_name = name
@@ -298,10 +652,25 @@ class Box(threading.Thread, dbus.service.Object):
         threading.Thread.__init__(self, name="Box %s on Storage %s" % (name, storage.path))
         self.daemon = True
         self.fuse = KiFuse(self)
+        self.mount_options = dict(self.default_mount_options)
+        self.commit_scheduler = CommitScheduler(self)
+        self.journal = Journal(os.path.join(storage.controldir(), "journal", name))
+        self.dirty_budget = DirtyBudget(self.dirty_soft_limit, self.dirty_hard_limit,
+                                        storage.dirty_budget)
+        self.staging = StagingArea(os.path.join(storage.controldir(), "staging"))
+        # Past records of this box, by commit time, and where they are mounted
+        self.commit_index = CommitTimeIndex(storage)
+        self.record_boxes = {}
         if create:
             self.head = Record(self.storage)
         else:
             self.update_from_remotes()
+        try:
+            self.storage.usage.update_box(name, self.head.object.tree)
+        except NoRecord:
+            pass
+        # Get back what was not committed when we stopped
+        self.fuse.replay(self.journal)
 
     @property
     def root(self):
@@ -321,6 +690,17 @@ class Box(threading.Thread, dbus.service.Object):
         except ValueError:
             raise NoRecord
 
+    def holds_record(self, sha):
+        """Return whether the head is the record sha, or a child of it."""
+        if sha not in self.storage.object_store:
+            return False
+        try:
+            head = self.head
+        except NoRecord:
+            return False
+        record = Record(self.storage, sha)
+        return head == record or head.is_child_of(record)
+
     def update_from_remotes(self):
         try:
             print "> Update from remote…"
@@ -344,10 +724,14 @@ class Box(threading.Thread, dbus.service.Object):
                 self._next_record.parents.append(self.head)
             return self._next_record
 
+    @property
+    def head_ref(self):
+        return "refs/storages/%s/%s" % (self.storage.id, self.box_name)
+
     @property
     def head(self):
         try:
-            return Record(self.storage, self.storage.refs["refs/storages/%s/%s" % (self.storage.id, self.box_name)])
+            return Record(self.storage, self.storage.refs[self.head_ref])
         except KeyError:
             raise NoRecord
 
@@ -357,19 +741,19 @@ class Box(threading.Thread, dbus.service.Object):
             value = self.storage[value]
         if isinstance(value, Commit):
             value = Record(self.storage, value)
-        with self.head_lock:
+        with self.tree_lock.exclusive(), self.head_lock:
             try:
                 head = self.head
             except NoRecord:
-                self.storage.refs["refs/storages/%s/%s" % (self.storage.id, self.box_name)] = value.store()
+                self.storage.refs[self.head_ref] = value.store()
             else:
                 # Nothing to do (the easy case)
                 if head == value:
                     pass
                 elif value.is_child_of(head):
                     # If it's a child, it's ok
-                    self.storage.refs["refs/storages/%s/%s" % (self.storage.id, self.box_name)] = value.store()
-                    self.fuse.fds.reset()
+                    self.storage.refs[self.head_ref] = value.store()
+                    self.fuse.head_changed(head.object.tree, value.object.tree)
                 elif head.is_child_of(value):
                     # Trying to go back in time?
                     raise NoPlutoniumInDeLoreanError
@@ -381,52 +765,174 @@ class Box(threading.Thread, dbus.service.Object):
                     merge_record.parents.clear()
                     merge_record.parents.append(head)
                     merge_record.merge_commit(value)
-                    self.storage.refs["refs/storages/%s/%s" % (self.storage.id, self.box_name)] = merge_record.store()
-                    self.fuse.fds.reset()
+                    self.storage.refs[self.head_ref] = merge_record.store()
+                    self.fuse.head_changed(head.object.tree, merge_record.object.tree)
                 else:
                     # This is only raised if they got not common ancestor, so
                     # they are totally unrelated. This is abnormal.
                     raise NotFastForward
+            self.storage.usage.update_box(self.box_name, self.head.object.tree)
 
     @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE)
     def Commit(self):
         """Commit modification to the storage, if needed."""
-        with self.head_lock:
-            if self._next_record is not None:
-                print "The next record root tree id: ",
-                print self._next_record.root.id()
-                # Check that there's changes in that next record by
-                # comparing its root tree id against head's one and its
-                # parents one. If it's not different that these ones,
-                # committing is useless.
-                #
-                # if commit's tree is different than current head's one \
-                #         and different than its parents ones
-                if self._next_record.root != self.head.root \
-                        and self._next_record.root not in [ p.root for p in self._next_record.parents ]:
-                    print " Next record root tree is different"
-                    self._next_record.update_timestamp()
-                    self.head = self._next_record
-                    self.Commited()
-                # If _next_record did not change (no root tree change), we just
-                # reset in case head would have changed under our feet while
-                # we were away.
-                # If _next_record changed, we still reset it to make a new one
-                # as soon as someone will need.
-                self._next_record = None
+        with self.tree_lock.exclusive(), self.head_lock:
+            start = time.time()
+            self._commit()
+            # Everything is in the record now
+            self.journal.reset()
+            self.dirty_budget.reset()
+            self.commit_scheduler.committed(time.time() - start)
+
+    def _commit(self):
+        record = self._next_record
+        if record is None:
+            return
+        if record.root.dirty:
+            # Only the modified path from the changed entries to the
+            # root gets serialized here.
+            tree = record.root.id()
+            print "The next record root tree id: %s" % tree
+            # Check that there's changes in that next record by
+            # comparing its root tree id against head's one and its
+            # parents one. If it's not different that these ones,
+            # committing is useless.
+            head_tree = self.storage[self.storage.refs[self.head_ref]].tree
+            if tree != head_tree and tree not in [ p.root.id() for p in record.parents ]:
+                print " Next record root tree is different"
+                record.update_timestamp()
+                # The journal is reset once the head is set: if we stop in
+                # between, this tells that what it holds got committed
+                self.journal.append("commit", sha=record.store())
+                self.journal.sync()
+                self.head = record
+                self.Commited()
+            # Reset _next_record to make a new one as soon as someone
+            # will need.
+            self._next_record = None
+        elif [ p.id() for p in record.parents ] != [ self.storage.refs[self.head_ref] ]:
+            # Nothing changed, but head moved under our feet while we
+            # were away: restart from it.
+            self._next_record = None
 
     @dbus.service.signal(dbus_interface="%s.Box" % BUS_INTERFACE)
     def Commited(self):
         self.storage.must_be_sync.set()
 
+    def _fuse_options(self):
+        """Return the FUSE options to mount with."""
+        options = { "entry_timeout": self.mount_options["entry_timeout"],
+                    "attr_timeout": self.mount_options["attr_timeout"] }
+        if self.mount_options["kernel_cache"]:
+            if fuse_can_invalidate():
+                options["kernel_cache"] = True
+            else:
+                # We cannot tell the kernel what changed when the head
+                # moves, so let it check the mtime and size of files.
+                options["auto_cache"] = True
+        return options
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         out_signature='a{sd}')
+    def GetCommitStats(self):
+        """Return statistics about commits and dirty data of this box."""
+        stats = self.commit_scheduler.stats
+        stats.update(self.dirty_budget.stats)
+        stats["staged_bytes"] = len(self.staging)
+        return stats
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         out_signature='a{sd}')
+    def GetUsage(self):
+        """Return the size in bytes of the files of this box, and how many
+        files, directories and symlinks it has, as of its last commit.
+        dirty_bytes is the amount of data written since."""
+        return self.usage()
+
+    def usage(self):
+        usage = self.storage.usage.box(self.box_name)
+        usage["dirty_bytes"] = self.dirty_budget.used
+        return usage
+
+    def find_record(self, what):
+        """Return the Record what, which is either the sha of a commit, or a
+        timestamp: then this is the last record made at or before it."""
+        try:
+            timestamp = float(what)
+        except ValueError:
+            return Record(self.storage, str(what))
+        with self.head_lock:
+            self.commit_index.update(self.storage.refs[self.head_ref])
+        sha = self.commit_index.find(timestamp)
+        if sha is None:
+            raise NoRecord
+        return Record(self.storage, sha)
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         in_signature='ss', out_signature='s')
+    def MountRecord(self, what, mountpoint):
+        """Mount a past record of this box read-only on mountpoint.
+        what is the sha of the record, or a timestamp to mount the last
+        record made at or before it. Return the sha of the record."""
+        for path, record_box in self.record_boxes.items():
+            if not record_box.is_alive():
+                del self.record_boxes[path]
+        if mountpoint in self.record_boxes:
+            raise ValueError("A record is already mounted on %s" % mountpoint)
+        record = self.find_record(what)
+        record_box = RecordBox(self, record, mountpoint)
+        self.record_boxes[mountpoint] = record_box
+        record_box.start()
+        return record.id()
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         out_signature='s')
+    def GetReplication(self):
+        """Return the replication policy of the box."""
+        return str(self.storage.replication_policy(self.box_name))
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         in_signature='s')
+    def SetReplication(self, policy):
+        """Set the replication policy of the box in the storage config."""
+        # Check it first
+        ReplicationPolicy(policy)
+        config = self.storage.config
+        # Copy, not to modify the default config
+        boxes = dict(config["boxes"])
+        boxes[self.box_name] = dict(boxes.get(self.box_name, {}), replication=policy)
+        config["boxes"] = boxes
+        self.storage.syncer.policies_changed()
+
+    @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
+                         in_signature='ss', out_signature='t')
+    def CopyFile(self, source, target):
+        """Copy the file at path source to path target inside this box.
+        Blocks are shared, so this does not depend on the file size.
+        Return the number of bytes copied."""
+        return self.fuse("copy", source, target)
+
     def run(self):
-        TimeCommiter(self, 300).start()
-        FUSE(self.fuse, self.mountpoint, nothreads=True, debug=True)
+        self.commit_scheduler.start()
+        FUSE(self.fuse, self.mountpoint, debug=True, use_ino=True, **self._fuse_options())
         self.Commit()
 
     @dbus.service.method(dbus_interface="%s.Box" % BUS_INTERFACE,
-                         in_signature='s')
-    def Mount(self, mountpoint):
+                         in_signature='sa{sv}')
+    def Mount(self, mountpoint, options):
+        """Mount the box on mountpoint.
+        options can set entry_timeout, attr_timeout (in seconds),
+        kernel_cache, and fetch_errno, the error returned when data cannot
+        be fetched from the remotes."""
+        for key, value in options.iteritems():
+            if key not in self.default_mount_options:
+                raise ValueError("Unknown mount option %s" % key)
+            if key == "kernel_cache":
+                self.mount_options[key] = bool(value)
+            elif key == "fetch_errno":
+                self.mount_options[key] = self.fuse.fetch_errno = int(value)
+            else:
+                self.mount_options[key] = float(value)
         if not self.is_alive():
             self.mountpoint = mountpoint
             self.start()
@@ -438,3 +944,36 @@ class Box(threading.Thread, dbus.service.Object):
         return [ (commit.id(), commit.object.commit_time)
                  for commit_set in self.record.history()
                  for commit in commit_set ]
+
+
+class RecordBox(threading.Thread):
+    """A past record of a box, mounted read-only.
+    It reads the objects of the storage of its box, so everything they
+    share is only loaded once."""
+
+    is_writable = False
+
+    def __init__(self, box, record, mountpoint):
+        threading.Thread.__init__(self, name="Record %s of box %s" % (record.id(), box.box_name))
+        self.daemon = True
+        self.box = box
+        self.storage = box.storage
+        self.box_name = box.box_name
+        self.record = record
+        self.mountpoint = mountpoint
+        self.head_lock = threading.RLock()
+        self.tree_lock = RWLock()
+        self.fuse = KiFuse(self)
+
+    @property
+    def root(self):
+        return self.record.root
+
+    def usage(self):
+        # Only the heads of boxes are counted
+        return { "bytes": 0, "files": 0, "directories": 0, "symlinks": 0,
+                 "dirty_bytes": 0 }
+
+    def run(self):
+        FUSE(self.fuse, self.mountpoint, debug=True, use_ino=True, ro=True,
+             **self.box._fuse_options())
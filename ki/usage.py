@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ki.usage -- Space usage counters
+#
+#    Copyright © 2011  Julien Danjou <julien@danjou.info>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import stat
+import threading
+from dulwich.diff_tree import walk_trees
+from .objects import read_chunks, FetchError
+
+
+class Usage(object):
+    """Counters of the space used by a storage and its boxes.
+
+    They are kept up to date as chunks get stored or fetched and as box
+    heads move, and saved in a file, so nothing ever has to walk a whole
+    tree to know them, except the first time."""
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(path) as f:
+                counters = json.load(f)
+        except (IOError, ValueError):
+            counters = None
+        if counters is None:
+            self.chunks, self.chunk_bytes = self._count_chunks()
+            self.boxes = {}
+            self._dirty = True
+        else:
+            self.chunks = counters["chunks"]
+            self.chunk_bytes = counters["chunk_bytes"]
+            self.boxes = {}
+            for name, box in counters["boxes"].iteritems():
+                box = dict([ (str(k), v) for k, v in box.iteritems() ])
+                box["tree"] = str(box["tree"])
+                self.boxes[str(name)] = box
+
+    def _count_chunks(self):
+        """Count the chunks of the storage, the slow way."""
+        chunks = 0
+        chunk_bytes = 0
+        for ref, sha in self.storage.refs.as_dict("refs/blobs").iteritems():
+            try:
+                chunk_bytes += len(self.storage.object_store.get_raw(sha)[1])
+            except KeyError:
+                # Not here, only referenced
+                continue
+            chunks += 1
+        return chunks, chunk_bytes
+
+    def add_chunk(self, size):
+        """Account for a new chunk of size bytes in the storage."""
+        with self.lock:
+            self.chunks += 1
+            self.chunk_bytes += size
+            self._dirty = True
+
+    def remove_chunk(self, size):
+        """Account for a chunk of size bytes removed from the storage."""
+        with self.lock:
+            self.chunks -= 1
+            self.chunk_bytes -= size
+            self._dirty = True
+
+    def _entry_usage(self, entry):
+        if entry.mode is None:
+            return 0, None
+        if stat.S_ISDIR(entry.mode):
+            return 0, "directories"
+        if stat.S_ISLNK(entry.mode):
+            return 0, "symlinks"
+        try:
+            return sum([ size for size, sha in read_chunks(self.storage, entry.sha) ]), "files"
+        except FetchError:
+            return 0, "files"
+
+    def update_box(self, name, tree):
+        """Update the counters of the box name, whose root tree is now tree.
+        Only the trees which changed since the last update are read."""
+        with self.lock:
+            box = self.boxes.get(name)
+            if box is None or box["tree"] not in self.storage.object_store:
+                box = { "tree": None, "bytes": 0, "files": 0,
+                        "directories": 0, "symlinks": 0 }
+            elif box["tree"] == tree:
+                return
+            for old, new in walk_trees(self.storage.object_store, box["tree"], tree,
+                                       prune_identical=True):
+                # Skip the root and what did not change
+                if not (old.path or new.path) or old == new:
+                    continue
+                for entry, sign in ((old, -1), (new, 1)):
+                    size, kind = self._entry_usage(entry)
+                    if kind is not None:
+                        box["bytes"] += sign * size
+                        box[kind] += sign
+            box["tree"] = tree
+            self.boxes[name] = box
+            self._dirty = True
+        self.save()
+
+    def box(self, name):
+        """Return the counters of the box name."""
+        with self.lock:
+            box = self.boxes.get(name)
+            if box is None:
+                return { "bytes": 0, "files": 0, "directories": 0, "symlinks": 0 }
+            return dict([ (k, v) for k, v in box.iteritems() if k != "tree" ])
+
+    def save(self):
+        """Save the counters if they changed."""
+        with self.lock:
+            if not self._dirty:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({ "chunks": self.chunks,
+                            "chunk_bytes": self.chunk_bytes,
+                            "boxes": self.boxes }, f)
+            os.rename(tmp, self.path)
+            self._dirty = False
@@ -23,11 +23,15 @@ import threading
 import uuid
 import bisect
 import collections
+import contextlib
+import re
 
 class Path(object):
     """Magical path object.
     This allow to manipulate path very easily."""
 
+    __slots__ = ('components',)
+
     def __init__(self, path):
         """Create a new path object.
         You can build it using a string, a Path, or a list."""
@@ -183,6 +187,12 @@ class SortedList(list):
         self._update_keys()
         return where
 
+    def replace(self, i, j, items):
+        """Replace the items from index i to j by items, which must be sorted
+        and fit between the items around them."""
+        super(SortedList, self).__setitem__(slice(i, j), items)
+        self._update_keys()
+
     def insert_at(self, where, value):
         # XXX check if value is between -1 and +1 items
         super(SortedList, self).insert(where, value)
@@ -281,61 +291,29 @@ class lrope(collections.MutableSequence):
         if step != 1:
             raise ValueError("steps other than 1 are not supported")
 
-        # if start != stop: this is replacement
-        # else: this is insertion
-        if start != stop:
-            first_block_index = self._blocks.index_le(start)
-            last_block_index = self._blocks.index_le(stop - 1)
-
-            if first_block_index == -1:
-                # -1? This happens when the object has been created empty
-                if start != 0:
-                    raise IndexError("Trying to insert at index %d but this rope is empty" % start)
-                self._blocks.insert((0, value[0:stop]))
-            elif first_block_index == last_block_index:
-                offset, block = self._blocks[first_block_index]
-                self._blocks[first_block_index] = \
-                    (offset, block[:start - offset] + value + block[stop - offset:])
-            else:
-                first_block_offset, first_block = self._blocks[first_block_index]
-                last_block_offset, last_block = self._blocks[last_block_index]
-
-                # Delete block between them
-                if last_block_index - first_block_offset > 1:
-                    del self._blocks[first_block_index + 1:last_block_index]
-
-                if start == first_block_offset:
-                    del self._blocks[first_block_index]
-                    first_block_index -= 1
-                else:
-                    self._blocks[first_block_index] = (first_block_offset, first_block[:start - first_block_offset])
+        # Cut the blocks at both ends of the range, rather than
+        # concatenating value with what is left of them: blocks may be
+        # large, or not even hold their data.
+        start_index = self._cut(start)
+        if stop < self._length:
+            stop_index = self._cut(stop)
+        else:
+            stop_index = len(self._blocks)
 
-                if stop >= last_block_offset + len(last_block):
-                    # Truncate the first block end
-                    del self._blocks[first_block_index + 1]
-                    # Insert the value with its offset
-                    self._blocks.insert((start, value))
-                else:
-                    # Truncate the last block beginning
-                    self._blocks[last_block_index] = (stop, last_block[stop - last_block_offset:])
-                    # Insert the value with its offset
-                    self._blocks.insert((start, value))
-        elif start == 0 or start == len(self):
-            # Insertion at the beginning/ending, easy case, we handle it.
-            # insert (start, value[0:requested stop offset - start offset])
-            if key.stop != None:
-                value_length = key.stop - start
-            else:
-                value_length = None
-            where = self._blocks.insert((start, value[0:value_length]))
-            for idx, (oldoffset, block) in enumerate(self._blocks[where + 1:], where + 1):
-                self._blocks[idx] = (oldoffset + len(value), block)
+        if len(value):
+            blocks = [ (start, value) ]
         else:
-            raise RuntimeError("that should not happens")
+            blocks = []
+
+        # If the length changes, move the following blocks
+        delta = len(value) - (stop - start)
+        if delta:
+            blocks.extend([ (offset + delta, block) \
+                                for offset, block in self._blocks[stop_index:] ])
+            stop_index = len(self._blocks)
 
-        # Recompute length
-        offset, block = self._blocks[len(self._blocks) - 1]
-        self._length = offset + len(block)
+        self._blocks.replace(start_index, stop_index, blocks)
+        self._length += delta
 
     def __getitem__(self, key):
         if not isinstance(key, slice):
@@ -345,29 +323,22 @@ class lrope(collections.MutableSequence):
 
         start, stop, step = key.indices(len(self))
 
-        if start == stop:
+        if start >= stop:
             return ""
 
         index = self._blocks.index_le(start)
-        data = ""
-        offset, block = self._blocks[index]
-        block_start = start - offset
+        data = []
 
-        while stop > offset:
-            try:
-                next_offset, next_block = self._blocks[index + 1]
-            except IndexError:
-                # Last element!
-                next_offset = offset + len(block)
-                next_block = ""
-
-            block_end = min(next_offset, stop) - offset
-            data += self._blocks[index][1][block_start:block_end:step]
-            block_start = 0
+        while start < stop:
+            offset, block = self._blocks[index]
+            end = min(self._block_end(index), stop)
+            data.append(str(block[start - offset:end - offset]))
+            start = end
             index += 1
-            offset = next_offset
-            block = next_block
 
+        data = "".join(data)
+        if step != 1:
+            return data[::step]
         return data
 
     @property
@@ -376,13 +347,233 @@ class lrope(collections.MutableSequence):
 
     def block_size_at(self, index):
         """Return size of block at index."""
-        if index < len(self) - 1:
-            return self._blocks[index + 1][0] - self._blocks[index][0]
-        return self._blocks[index + 1][0] - len(self)
+        return self._block_end(index) - self._blocks[index][0]
 
     def block_index_for_offset(self, offset):
         return self._blocks.index_le(offset)
 
+    def open(self, offset=0, stop=None):
+        """Return a file-like object reading the rope from offset to stop,
+        without copying all of it in memory."""
+        return lropeReader(self, offset, stop)
+
+    def _block_end(self, index):
+        """Return the offset where the block at index ends.
+        Unlike len(), this does not need to load the block."""
+        try:
+            return self._blocks[index + 1][0]
+        except IndexError:
+            return self._length
+
+    def _cut(self, offset):
+        """Make a block start at offset, and return its index."""
+        index = self._blocks.index_le(offset)
+        if index == -1:
+            return 0
+        block_offset, block = self._blocks[index]
+        if block_offset == offset:
+            return index
+        if offset >= self._block_end(index):
+            return index + 1
+        self._blocks.replace(index, index + 1,
+                             [ (block_offset, block[:offset - block_offset]),
+                               (offset, block[offset - block_offset:]) ])
+        return index + 1
+
+    def slice_blocks(self, start, stop):
+        """Return the [ (size, object), … ] list making the rope from start
+        to stop. Objects entirely in that range are returned as is, only
+        the ones at its edges are cut."""
+        start, stop, step = slice(start, stop).indices(len(self))
+        pieces = []
+        index = self._blocks.index_le(start)
+        while start < stop:
+            block_offset, block = self._blocks[index]
+            block_end = self._block_end(index)
+            piece_end = min(block_end, stop)
+            if piece_end > start:
+                if start == block_offset and piece_end == block_end:
+                    pieces.append((block_end - block_offset, block))
+                else:
+                    pieces.append((piece_end - start,
+                                   block[start - block_offset:piece_end - block_offset]))
+            start = piece_end
+            index += 1
+        return pieces
+
+    def splice(self, offset, pieces):
+        """Overwrite the rope from offset with the [ (size, object), … ] list
+        pieces. The objects are stored as is, not copied."""
+        if offset > len(self):
+            raise IndexError("Trying to splice at index %d but this rope is %d long"
+                             % (offset, len(self)))
+        stop = offset + sum([ size for size, obj in pieces ])
+        start_index = self._cut(offset)
+        if stop < self._length:
+            stop_index = self._cut(stop)
+        else:
+            stop_index = len(self._blocks)
+        blocks = []
+        for size, obj in pieces:
+            if size:
+                blocks.append((offset, obj))
+                offset += size
+        self._blocks.replace(start_index, stop_index, blocks)
+        self._length = max(self._length, stop)
+
+
+class lropeReader(object):
+    """A read-only file-like object on a lrope."""
+
+    def __init__(self, rope, offset=0, stop=None):
+        self.rope = rope
+        self.offset = offset
+        self.stop = stop
+
+    def read(self, size=-1):
+        if self.stop is None:
+            stop = len(self.rope)
+        else:
+            stop = self.stop
+        if size >= 0:
+            stop = min(stop, self.offset + size)
+        data = self.rope[self.offset:stop]
+        self.offset += len(data)
+        return data
+
+
+class LRUCache(object):
+    """A dict-like cache holding at most maxsize items.
+    When full, the least recently used items are evicted first.
+    This is safe to use from several threads."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            # Move the item to the end, i.e. mark it as the most recently used
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._items[key]
+
+    def discard(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class RWLock(object):
+    """A lock that can be held by several readers at once, or by one writer.
+
+    The writer can acquire it again, for reading or writing, and so can a
+    reader for reading. New readers wait for the writers that are waiting,
+    so a steady flow of readers cannot starve writers."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        # Thread -> number of times it holds the lock shared
+        self._readers = {}
+        self._writer = None
+        self._writer_count = 0
+        self._writers_waiting = 0
+
+    def acquire_shared(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writer_count += 1
+                return
+            # A reader acquiring it again must not wait for a writer
+            # waiting for it
+            if me not in self._readers:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_shared(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writer_count -= 1
+                return
+            self._readers[me] -= 1
+            if self._readers[me] == 0:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writer_count += 1
+                return
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def release_exclusive(self):
+        with self._cond:
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
 
 class SingletonType(type):
     """Singleton metaclass."""
@@ -407,3 +598,13 @@ def dbus_clean_name(s):
 def dbus_uuid():
     """Return an UUID usable in a D-Bus object path."""
     return "".join(map(lambda x: x == '-' and '_' or x, str(uuid.uuid4())))
+
+_size_units = { "": 1, "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3, "t": 1000 ** 4 }
+
+def parse_size(s):
+    """Return the number of bytes of a size like "10 GB" or "1.5MB".
+    Raise ValueError if s is not a size."""
+    size = re.match(r"^(\d+(?:\.\d+)?) ?([kmgt]?)b$", " ".join(str(s).lower().split()))
+    if size is None:
+        raise ValueError("Invalid size: %s" % s)
+    return int(float(size.group(1)) * _size_units[size.group(2)])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import unittest
+import time
+from ki.objects import *
+from ki.cache import *
+from dulwich.objects import Blob
+
+from TestStorage import TestUsingStorage
+
+class TestCache(TestUsingStorage):
+
+    def _chunk(self, data):
+        f = FileBlock(self.storage)
+        f.data = data
+        return f.store()
+
+    def test_ChunkCache_evict(self):
+        cache = self.storage.cache
+        old = self._chunk("a" * 100)
+        pinned = self._chunk("b" * 100)
+        new = self._chunk("c" * 100)
+        cache.read(old)
+        cache.read(pinned)
+        cache.read(new)
+        chunks = self.storage.usage.chunks
+        ours = set([ old, pinned, new ])
+        self.assert_(cache.evict(150, lambda sha: sha in ours and sha != pinned) == (2, 200))
+        self.assert_(old not in self.storage.object_store)
+        self.assert_(new not in self.storage.object_store)
+        self.assert_(pinned in self.storage.object_store)
+        self.assert_("refs/blobs/%s" % old not in self.storage.refs)
+        self.assert_(self.storage.usage.chunks == chunks - 2)
+        self.assert_(cache.evicted(old))
+        self.assert_(not cache.evicted(pinned))
+        # The least recently read go first
+        first = self._chunk("d" * 100)
+        second = self._chunk("e" * 100)
+        third = self._chunk("f" * 100)
+        for sha in (first, second, third, first):
+            cache.read(sha)
+            time.sleep(0.01)
+        ours = set([ first, second, third ])
+        self.assert_(cache.evict(50, lambda sha: sha in ours) == (1, 100))
+        self.assert_(second not in self.storage.object_store)
+        self.assert_(cache.evict(50, lambda sha: sha in ours) == (1, 100))
+        self.assert_(third not in self.storage.object_store)
+        self.assert_(first in self.storage.object_store)
+
+    def test_ChunkCache_evict_packed(self):
+        cache = self.storage.cache
+        blobs = [ Blob.from_string(str(i) * 100) for i in range(3) ]
+        self.storage.object_store.add_objects([ (blob, None) for blob in blobs ])
+        for blob in blobs:
+            self.storage._fetched(blob.id)
+        self.assert_(cache.evict(100, lambda sha: sha == blobs[1].id) == (1, 100))
+        self.assert_(blobs[0].id in self.storage.object_store)
+        self.assert_(blobs[1].id not in self.storage.object_store)
+        self.assert_(blobs[2].id in self.storage.object_store)
+        self.assert_(len(self.storage.object_store.packs) == 1)
+        # Fetched again, it is local again
+        self.storage.object_store.add_object(blobs[1])
+        self.storage._fetched(blobs[1].id)
+        self.assert_(not cache.evicted(blobs[1].id))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import unittest
+import time
+from ki.commiter import *
+
+
+class FakeBox(object):
+
+    box_name = "test"
+
+    def __init__(self):
+        self.commits = 0
+
+    def Commit(self):
+        self.commits += 1
+        self.commit_scheduler.committed(0.01)
+
+
+class TestCommiter(unittest.TestCase):
+
+    def setUp(self):
+        self.box = FakeBox()
+
+    def start(self, **kwargs):
+        self.box.commit_scheduler = CommitScheduler(self.box, **kwargs)
+        self.box.commit_scheduler.start()
+        return self.box.commit_scheduler
+
+    def tearDown(self):
+        self.box.commit_scheduler.stop()
+
+    def test_CommitScheduler_idle(self):
+        scheduler = self.start(idle=0.2)
+        for i in range(10):
+            scheduler.touch(100)
+            time.sleep(0.05)
+        # Still busy, so nothing committed
+        self.assert_(self.box.commits == 0)
+        time.sleep(0.4)
+        self.assert_(self.box.commits == 1)
+        self.assert_(scheduler.dirty_bytes == 0)
+        time.sleep(0.3)
+        self.assert_(self.box.commits == 1)
+
+    def test_CommitScheduler_thresholds(self):
+        scheduler = self.start(idle=10, max_dirty_bytes=1000, max_dirty_entries=5)
+        scheduler.touch(999)
+        time.sleep(0.1)
+        self.assert_(self.box.commits == 0)
+        scheduler.touch(1)
+        time.sleep(0.1)
+        self.assert_(self.box.commits == 1)
+        for i in range(5):
+            scheduler.touch(entries=1)
+        time.sleep(0.1)
+        self.assert_(self.box.commits == 2)
+        stats = scheduler.stats
+        self.assert_(stats["commits"] == 2)
+        self.assert_(abs(stats["average_latency"] - 0.01) < 0.001)
+
+    def test_CommitScheduler_max_age(self):
+        scheduler = self.start(idle=10, max_age=0.3)
+        for i in range(8):
+            scheduler.touch(1)
+            time.sleep(0.05)
+        time.sleep(0.1)
+        self.assert_(self.box.commits == 1)
+
+if __name__ == '__main__':
+    unittest.main()
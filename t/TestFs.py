@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import unittest
+import threading
+import stat
+from ki.fuse import FuseOSError
+
+from TestStorage import TestUsingStorage
+
+class TestKiFuse(TestUsingStorage):
+
+    def setUp(self):
+        super(TestKiFuse, self).setUp()
+        self.fs = self.box.fuse
+
+    def _create(self, path, data=""):
+        fh = self.fs.create(path, stat.S_IFREG | 0644)
+        self.fs.write(path, data, 0, fh)
+        self.fs.release(path, fh)
+
+    def test_KiFuse_dentries(self):
+        self.assertRaises(FuseOSError, self.fs.getattr, "/a")
+        self.assert_("/a" in self.fs.negative_dentries)
+        self._create("/a", "data")
+        self.assert_("/a" not in self.fs.negative_dentries)
+        self.assert_(self.fs.getattr("/a")["st_size"] == 4)
+        self.assert_("/a" in self.fs.dentries)
+        self.fs.rename("/a", "/b")
+        self.assert_("/a" not in self.fs.dentries)
+        self.assertRaises(FuseOSError, self.fs.getattr, "/a")
+        self.assert_(self.fs.getattr("/b")["st_size"] == 4)
+        self.fs.unlink("/b")
+        self.assertRaises(FuseOSError, self.fs.getattr, "/b")
+
+    def _paused_lookup(self, path, change):
+        """Look path up in a thread, running change once the lookup
+        resolved it but did not cache it yet."""
+        root = self.box.root
+        cls = root.__class__
+        resolved = threading.Event()
+        resume = threading.Event()
+
+        class Paused(cls):
+            __slots__ = ()
+
+            def __getitem__(self, key):
+                try:
+                    return cls.__getitem__(self, key)
+                finally:
+                    if key == path:
+                        resolved.set()
+                        resume.wait()
+
+        def lookup():
+            try:
+                self.fs.getattr(path)
+            except FuseOSError:
+                pass
+
+        # Not in the lookup caches, so it gets resolved
+        self.fs.flush_dentries()
+        root.__class__ = Paused
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        try:
+            self.assert_(resolved.wait(5))
+            root.__class__ = cls
+            change()
+        finally:
+            root.__class__ = cls
+            resume.set()
+            thread.join()
+
+    def test_KiFuse_dentries_race(self):
+        # A lookup which found nothing before a create does not hide it
+        self._paused_lookup("/a", lambda: self._create("/a"))
+        self.fs.getattr("/a")
+        # nor does one which found it before an unlink show it
+        self._paused_lookup("/a", lambda: self.fs.unlink("/a"))
+        self.assertRaises(FuseOSError, self.fs.getattr, "/a")
+
+    def test_KiFuse_dentries_concurrent(self):
+        stop = threading.Event()
+
+        def lookup():
+            while not stop.is_set():
+                try:
+                    self.fs.getattr("/a")
+                except FuseOSError:
+                    pass
+
+        threads = [ threading.Thread(target=lookup) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(200):
+                self._create("/a")
+                self.fs.unlink("/a")
+            self._create("/a")
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        # Lookups which raced the changes did not cache what they found
+        self.assert_("/a" not in self.fs.negative_dentries)
+        self.fs.getattr("/a")
+
+    def test_KiFuse_fds(self):
+        fh = self.fs.create("/a", stat.S_IFREG | 0644)
+        self._create("/b", "new")
+        self.fs.rename("/b", "/a")
+        # An open file keeps its entry
+        self.assert_(self.fs.read("/a", 100, 0, fh) == "")
+        # until the head changes: it is looked up again then
+        self.fs.fds.reset()
+        self.assert_(self.fs.read("/a", 100, 0, fh) == "new")
+        self.assert_(self.fs.fds[fh][0] == self.fs.fds.generation)
+        self.fs.release("/a", fh)
+        self.assert_(self.fs.open("/a", 0) == fh)
+
+    def test_KiFuse_inodes(self):
+        self.fs.mkdir("/d", 0755)
+        self._create("/d/a")
+        ino = self.fs.getattr("/d/a")["st_ino"]
+        self.fs.rename("/d", "/e")
+        self.assert_(self.fs.getattr("/e/a")["st_ino"] == ino)
+        self.assert_("/d/a" not in self.fs.inodes)
+        self.fs.unlink("/e/a")
+        self._create("/e/a")
+        self.assert_(self.fs.getattr("/e/a")["st_ino"] != ino)
+
+    def test_KiFuse_readdir(self):
+        for name in "abcde":
+            self._create("/" + name)
+        fh = self.fs.opendir("/")
+        names = [ name for name, attrs, offset in self.fs.readdir("/", fh, 0) ]
+        self.assert_(sorted(names) == [ ".", ".." ] + list("abcde"))
+        # The kernel buffer gets full at the fourth entry: the next call
+        # resumes from it
+        entries = self.fs.readdir("/", fh, 0)
+        first = [ entries.next()[0] for i in range(4) ]
+        rest = [ name for name, attrs, offset in self.fs.readdir("/", fh, 3) ]
+        self.assert_(first[:3] + rest == names)
+        # Seeking elsewhere lists again from there
+        rest = [ name for name, attrs, offset in self.fs.readdir("/", fh, 1) ]
+        self.assert_(rest == names[1:])
+        self.fs.releasedir("/", fh)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import os
+from ki.journal import *
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.path, "journal", "box"))
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.path)
+
+    def test_Journal_append(self):
+        self.journal.append("write", "some data", path="/a/\xe9", offset=3)
+        self.journal.append("unlink", path="/b")
+        self.journal.sync()
+        records = list(self.journal)
+        self.assert_(records == [ ({ "op": "write", "path": "/a/\xe9", "offset": 3 }, "some data"),
+                                  ({ "op": "unlink", "path": "/b" }, "") ])
+        self.assert_(isinstance(records[0][0]["path"], str))
+        self.journal.reset()
+        self.assert_(list(self.journal) == [])
+        self.journal.append("unlink", path="/c")
+        self.assert_(list(self.journal) == [ ({ "op": "unlink", "path": "/c" }, "") ])
+
+    def test_Journal_torn_write(self):
+        self.journal.append("write", "some data", path="/a", offset=0)
+        self.journal.append("write", "other data", path="/a", offset=9)
+        self.journal.sync()
+        size = os.path.getsize(self.journal.path)
+        # Simulate a crash in the middle of the last record
+        with open(self.journal.path, "r+b") as f:
+            f.truncate(size - 3)
+        self.assert_(list(self.journal) == [ ({ "op": "write", "path": "/a", "offset": 0 }, "some data") ])
+        # The partial record got removed, so we can append again
+        self.journal.append("truncate", path="/a", length=2)
+        self.assert_(len(list(self.journal)) == 2)
+
+    def test_Journal_corrupted(self):
+        self.journal.append("write", "some data", path="/a", offset=0)
+        self.journal.sync()
+        with open(self.journal.path, "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write("XX")
+        self.assert_(list(self.journal) == [])
+
+if __name__ == '__main__':
+    unittest.main()
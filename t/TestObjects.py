@@ -4,9 +4,11 @@ import unittest
 import tempfile
 import os
 import shutil
+from multiprocessing.pool import ThreadPool
 from TestSplit import RandomizedDataFile
 from ki.storage import Storage
 from ki.objects import *
+from ki.staging import StagingArea
 from dulwich.objects import *
 
 from TestStorage import TestUsingStorage
@@ -158,6 +160,89 @@ class TestObjects(TestUsingStorage):
         d["arf/hep/file.txt"] = (0100644, f1)
         self.assert_(d.list_blobs_recursive() == set(f1.blocks + f2.blocks + f3.blocks))
 
+    def test_Directory_list_blobs_recursive_stored(self):
+        d = Directory(self.storage)
+        f1 = File(self.storage)
+        f1[0] = "some data"
+        f2 = File(self.storage)
+        f2[0] = "other data"
+        d["arf/bla.txt"] = (0100644, f1)
+        d["arf/bla/bla.txt"] = (0100644, f2)
+        d2 = Directory(self.storage, d.store())
+        self.assert_(d2.list_blobs_recursive() == set(f1.blocks + f2.blocks))
+        self.assert_(d2.local_tree == {})
+
+    def test_walk_tree(self):
+        d = Directory(self.storage)
+        f1 = File(self.storage)
+        f1[0] = "some data"
+        f2 = File(self.storage)
+        f2[0] = "did I write some data already"
+        d["a.txt"] = (0100644, f1)
+        d["x/b.txt"] = (0100644, f2)
+        d["x/y/c.txt"] = (0100644, f1)
+        d["z/s"] = (stat.S_IFLNK, Symlink(self.storage, None, "/a.txt"))
+        sha = d.store()
+        entries = dict([ (entry.path, entry) for entry in walk_tree(self.storage, sha) ])
+        self.assert_(sorted(entries.keys()) == [ "a.txt", "x", "x/b.txt", "x/y", "x/y/c.txt", "z", "z/s" ])
+        self.assert_([ chunk for size, chunk in entries["x/b.txt"].chunks ] == f2.blocks)
+        self.assert_(entries["x/y/c.txt"].sha == f1.id())
+        self.assert_(entries["z/s"].chunks == [])
+        pool = ThreadPool(2)
+        self.assert_(sorted(walk_tree(self.storage, sha, pool=pool)) == sorted(entries.values()))
+        pool.close()
+
+    def test_Storable_dirty(self):
+        d = Directory(self.storage)
+        f = File(self.storage)
+        f[0] = "some data"
+        d["a/b"] = (0100644, f)
+        self.assert_(d.dirty)
+        sha = d.store()
+        self.assert_(not d.dirty)
+        self.assert_(not f.dirty)
+        d2 = Directory(self.storage, sha)
+        f2 = d2["a/b"].item
+        self.assert_(not d2.dirty)
+        self.assert_(not f2.dirty)
+        f2[0] = "other data"
+        self.assert_(f2.dirty)
+        self.assert_(d2["a"].item.dirty)
+        self.assert_(d2.dirty)
+        # Storing the file alone must not lose it from its parents
+        f2.store()
+        sha2 = d2.store()
+        self.assert_(sha2 != sha)
+        self.assert_(Directory(self.storage, sha2)["a/b"].item.id() == f2.id())
+        self.assert_(d2.store() == sha2)
+
+    def test_Storable_slots(self):
+        d = Directory(self.storage)
+        f = File(self.storage)
+        f[0] = "some data"
+        d["dir/file"] = (0100644, f)
+        for obj in (d, f, d["dir"].item, FileBlock(self.storage), Record(self.storage)):
+            self.assert_(not hasattr(obj, "__dict__"))
+        # The same file held by two directories is tracked by both
+        d["other"] = (0100644, f)
+        d.store()
+        f[0] = "other data"
+        self.assert_(d.dirty)
+        self.assert_(d["dir"].item.dirty)
+        d2 = Directory(self.storage, d.store())
+        self.assert_(str(d2["dir/file"].item) == "other data")
+        self.assert_(str(d2["other"].item) == "other data")
+        name = "".join([ "fi", "le" ])
+        self.assert_(d2["dir"].item.local_tree.keys()[0] is intern(name))
+
+    def test_Record_dirty(self):
+        r = Record(self.storage, Record(self.storage).store())
+        self.assert_(not r.dirty)
+        r.root["a"] = (0100644, File(self.storage))
+        self.assert_(r.dirty)
+        r.store()
+        self.assert_(not r.dirty)
+
     def test_Directory_mkdir(self):
         directory = Directory(self.storage)
         directory.mkdir("a/b/c")
@@ -208,12 +293,100 @@ class TestObjects(TestUsingStorage):
 
     def test_File_write(self):
         f = File(self.storage)
+        # Slices get replaced as in a list: the length follows the value
         f[0:7] = "helloworld"
-        self.assert_(len(f) == 7)
+        self.assert_(f[:] == "helloworld")
         f[7:] = "heyohhe"
-        self.assert_(len(f) == 14)
+        self.assert_(f[:] == "hellowoheyohhe")
         del f[4:10]
-        self.assert_(len(f) == 10)
+        self.assert_(f[:] == "hellohhe")
+
+    def test_File_spill(self):
+        f = File(self.storage)
+        f[0:] = "helloworld"
+        staging = StagingArea()
+        self.assert_(f.spill(staging) == 10)
+        self.assert_(len(staging) == 10)
+        self.assert_(f.spill(staging) == 0)
+        self.assert_(f[:] == "helloworld")
+        f[5:10] = "there"
+        self.assert_(f[3:7] == "loth")
+        x = f.id()
+        f2 = File(self.storage)
+        f2[0:] = "hellothere"
+        self.assert_(f2.id() == x)
+
+    def test_File_copy_range(self):
+        data = RandomizedDataFile().read()
+        f = File(self.storage)
+        f[0:] = data
+        f.store()
+        blocks = f.blocks
+        f = File(self.storage, f.store())
+        g = File(self.storage)
+        g[0:] = "head"
+        self.assert_(g.copy_range(f, 0, 4, len(data)) == len(data))
+        self.assert_(len(g) == len(data) + 4)
+        self.assert_(g[:] == "head" + data)
+        g.store()
+        # Only the blocks touched by the copy are new
+        self.assert_(len(set(g.blocks) & set(blocks)) >= len(blocks) - 1)
+        self.assert_(str(File(self.storage, g.store())) == "head" + data)
+
+    def test_File_copy_range_into_stored(self):
+        data = RandomizedDataFile().read()
+        f = File(self.storage)
+        f[0:] = data
+        f = File(self.storage, f.store())
+        g = File(self.storage)
+        g[0:] = "hello world"
+        g = File(self.storage, g.store())
+        # Copy in the middle of the blocks of f
+        middle = len(data) // 2 + 1
+        self.assert_(f.copy_range(g, 0, middle, 5) == 5)
+        expected = data[:middle] + "hello" + data[middle + 5:]
+        self.assert_(str(File(self.storage, f.store())) == expected)
+
+    def test_File_prefetch(self):
+        data = RandomizedDataFile().read()
+        f = File(self.storage)
+        f[0:] = data
+        f = File(self.storage, f.store())
+        prefetched = []
+        self.storage.fetch_sha1s = prefetched.append
+        self.assert_(f[10:20] == data[10:20])
+        self.assert_(prefetched == [ [ f.blocks[0] ] ])
+        self.assert_(str(f) == data)
+        self.assert_(len(prefetched[-1]) == len(f.blocks) - 1)
+
+    def test_File_holes(self):
+        f = File(self.storage)
+        f[0:] = "abc"
+        f.truncate(10)
+        self.assert_(f[:] == "abc" + "\0" * 7)
+        f[20] = "z"
+        self.assert_(len(f) == 21)
+        self.assert_(f[18:] == "\0\0z")
+        f.truncate(1024 * 1024 * 1024)
+        f[512 * 1024 * 1024] = "middle"
+        self.assert_(f[512 * 1024 * 1024 - 1:512 * 1024 * 1024 + 7] == "\0middle\0")
+        f.store()
+        # Holes are not stored
+        self.assert_(len(f.blocks) == 3)
+        g = File(self.storage, f.store())
+        self.assert_(g.size == 1024 * 1024 * 1024)
+        self.assert_(g[512 * 1024 * 1024:512 * 1024 * 1024 + 6] == "middle")
+        self.assert_(g[1024:1034] == "\0" * 10)
+        g.truncate(2)
+        self.assert_(str(g) == "ab")
+
+    def test_File_zeros(self):
+        f = File(self.storage)
+        f[0:] = "a" * 100000 + "\0" * 1000000 + "b" * 100000
+        # Blocks of zeros are found when splitting, and stored as holes
+        chunks = read_chunks(self.storage, f.store())
+        self.assert_(sum([ size for size, sha in chunks if sha is None ]) > 500000)
+        self.assert_(str(File(self.storage, f.store())) == str(f))
 
     def test_File_merge(self):
         base = File(self.storage)
@@ -224,6 +397,25 @@ class TestObjects(TestUsingStorage):
         other[0] = "hello\nworld\nwhere are you?\n"
         self.assertRaises(MergeConflictError, f.merge, str(base), str(other))
 
+    def test_CommitTimeIndex(self):
+        records = []
+        for commit_time in (100, 300, 200):
+            r = Record(self.storage)
+            if records:
+                r.parents.append(records[-1])
+            r.object.commit_time = commit_time
+            r.store()
+            records.append(r)
+        index = CommitTimeIndex(self.storage)
+        index.update(records[1].id())
+        self.assert_(len(index) == 2)
+        index.update(records[2].id())
+        self.assert_(len(index) == 3)
+        self.assert_(index.find(50) is None)
+        self.assert_(index.find(100) == records[0].id())
+        self.assert_(index.find(250) == records[2].id())
+        self.assert_(index.find(1000) == records[1].id())
+
     def test_Symlink_target(self):
         s = Symlink(self.storage, None, "/")
         self.assert_(s.target == "/")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+from cStringIO import StringIO
+from ki.pack import *
+from dulwich.pack import apply_delta, PackData, write_pack_objects as dulwich_write_pack_objects
+from dulwich.objects import Blob, Tree, ShaFile, sha_to_hex
+from dulwich.object_store import MemoryObjectStore
+
+
+def unpack(data, bases={}):
+    """Return the objects of the pack data, by sha."""
+    pack = PackData.from_file(StringIO(data), len(data))
+    def get_ref(sha):
+        obj = bases[sha_to_hex(sha)]
+        return None, obj.type_num, obj.as_raw_string()
+    objects = {}
+    for offset, type_num, obj, crc32 in pack.iterobjects():
+        type_num, chunks = pack.resolve_object(offset, type_num, obj, get_ref)
+        if isinstance(chunks, str):
+            chunks = [ chunks ]
+        obj = ShaFile.from_raw_chunks(type_num, chunks)
+        objects[obj.id] = obj
+    return objects
+
+
+class TestPack(unittest.TestCase):
+
+    def test_create_delta(self):
+        base = os.urandom(200000)
+        for target in (base,
+                       base[:1000] + "hello" + base[1000:],
+                       base[100000:] + base[:100000],
+                       os.urandom(1000),
+                       "",
+                       base[:10]):
+            delta = create_delta(base, target)
+            self.assert_(''.join(apply_delta(base, delta)) == target)
+        self.assert_(len(create_delta(base, base[:1000] + "hello" + base[1000:])) < 100)
+
+    def test_PackContents(self):
+        store = MemoryObjectStore()
+        objects = []
+        base_tree = Tree()
+        for i in range(500):
+            blob = Blob.from_string("chunk %d" % i)
+            store.add_object(blob)
+            base_tree.add("file%d" % i, 0100644, blob.id)
+        store.add_object(base_tree)
+        tree = Tree.from_string(base_tree.as_raw_string())
+        blob = Blob.from_string("new chunk")
+        store.add_object(blob)
+        tree.add("file250", 0100644, blob.id)
+        store.add_object(tree)
+        objects = [ (tree.id, ""), (blob.id, None) ]
+
+        f = StringIO()
+        dulwich_write_pack_objects(f, [ (store[sha], path) for sha, path in objects ])
+        full = f.getvalue()
+
+        f = StringIO()
+        write_pack_objects(f, PackContents(store, objects))
+        self.assert_(set(unpack(f.getvalue()).keys()) == set([ tree.id, blob.id ]))
+
+        f = StringIO()
+        write_pack_objects(f, PackContents(store, objects, [ base_tree.id ]))
+        thin = f.getvalue()
+        self.assert_(set(unpack(thin, { base_tree.id: base_tree }).keys()) == set([ tree.id, blob.id ]))
+        self.assert_(len(thin) < len(full) / 5)
+
+        # Both versions in the pack: one is a delta of the other
+        objects = [ (base_tree.id, "dir"), (tree.id, "dir") ]
+        f = StringIO()
+        dulwich_write_pack_objects(f, [ (store[sha], path) for sha, path in objects ])
+        full = f.getvalue()
+        f = StringIO()
+        write_pack_objects(f, PackContents(store, objects))
+        self.assert_(set(unpack(f.getvalue()).keys()) == set([ base_tree.id, tree.id ]))
+        self.assert_(len(f.getvalue()) < len(full) * 0.6)
+
+    def test_PackContents_thin_base(self):
+        reads = []
+        class CountingObjectStore(MemoryObjectStore):
+            def __getitem__(self, sha):
+                reads.append(sha)
+                return MemoryObjectStore.__getitem__(self, sha)
+        store = CountingObjectStore()
+        other = Tree()
+        store.add_object(other)
+        base_trees = []
+        for i in range(50):
+            d = Tree()
+            d.add("version", 0100644, Blob.from_string("%d" % i).id)
+            store.add_object(d)
+            root = Tree()
+            root.add("d", 040000, d.id)
+            # A directory none of the objects is in
+            root.add("other", 040000, other.id)
+            store.add_object(root)
+            base_trees.append(root.id)
+        # The first base tree has the files elsewhere, only the last one
+        # has them where they are sent
+        blob = Blob.from_string("base")
+        store.add_object(blob)
+        d = Tree()
+        root = Tree()
+        for i in range(20):
+            d.add("file%d" % i, 0100644, blob.id)
+            root.add("file%d" % i, 0100644, blob.id)
+        store.add_object(d)
+        store.add_object(root)
+        base_trees.insert(0, root.id)
+        root = Tree()
+        root.add("d", 040000, d.id)
+        store.add_object(root)
+        base_trees.append(root.id)
+
+        objects = []
+        for i in range(20):
+            obj = Blob.from_string("new %d" % i)
+            store.add_object(obj)
+            objects.append((obj.id, "d/file%d" % i))
+        contents = PackContents(store, objects, base_trees)
+        for sha, path in objects:
+            self.assert_(contents._thin_base(path, Blob.type_num).id == blob.id)
+        # Each version of the directories leading to the objects got read
+        # once, and none of the others
+        self.assert_(other.id not in reads)
+        self.assert_(len(reads) < 3 * len(base_trees))
+
+if __name__ == '__main__':
+    unittest.main()
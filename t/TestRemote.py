@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+import unittest
+import errno
+import threading
+import time
+from ki.remote import *
+
+
+class FakeRemote(object):
+    name = "fake"
+    url = "/nonexistent"
+    connect_timeout = 0.2
+    transfer_timeout = 0.2
+
+    def __init__(self):
+        self.hung = []
+        self.abandoned = []
+        self.transfers_lock = threading.Lock()
+        self.stats = RemoteStats()
+        self.health = CircuitBreaker()
+
+
+class TestRemote(unittest.TestCase):
+
+    def test_Transfer_result(self):
+        t = Transfer(FakeRemote())
+        t.start(lambda x: x * 2, 21)
+        self.assert_(t.result() == 42)
+        t = Transfer(FakeRemote())
+        t.start(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, t.result)
+
+    def test_Transfer_timeout(self):
+        remote = FakeRemote()
+        hangup = threading.Event()
+        t = Transfer(remote)
+        t.start(hangup.wait)
+        self.assertRaises(RemoteTimeout, t.result)
+        self.assert_(remote.hung == [ t ])
+        hangup.set()
+
+    def test_Transfer_activity(self):
+        t = Transfer(FakeRemote())
+        def transfer():
+            for i in range(10):
+                time.sleep(0.05)
+                t.activity(1, 'read')
+            return True
+        t.start(transfer)
+        self.assert_(t.result())
+
+    def test_Transfer_local(self):
+        t = Transfer(FakeRemote())
+        t.start(t.local(time.sleep), 0.5)
+        t.result()
+
+    def test_as_completed(self):
+        remote = FakeRemote()
+        hangup = threading.Event()
+        slow = Transfer(remote)
+        slow.start(time.sleep, 0.1)
+        fast = Transfer(remote)
+        fast.start(lambda: None)
+        hung = Transfer(remote)
+        hung.start(hangup.wait)
+        self.assert_(list(as_completed([ hung, slow, fast ])) == [ fast, slow, hung ])
+        self.assertRaises(RemoteTimeout, hung.get)
+        hangup.set()
+
+    def test_as_completed_timeout(self):
+        hangup = threading.Event()
+        hung = Transfer(FakeRemote())
+        hung.start(hangup.wait)
+        start = time.time()
+        self.assert_(list(as_completed([ hung ], 0.05)) == [])
+        self.assert_(time.time() - start < 0.2)
+        hangup.set()
+
+    def test_Transfer_abandon(self):
+        remote = FakeRemote()
+        slow = threading.Event()
+        t = Transfer(remote)
+        def transfer():
+            slow.wait()
+            t.activity(1, 'read')
+        t.start(transfer)
+        t.abandon()
+        self.assert_(remote.abandoned == [ t ])
+        self.assert_(remote.hung == [])
+        slow.set()
+        t.result()
+        # Its latency still counts once it ends
+        self.assert_(remote.stats.latency is not None)
+
+    def test_Transfer_stats(self):
+        remote = FakeRemote()
+        t = Transfer(remote)
+        def transfer():
+            time.sleep(0.1)
+            t.activity(1024 * 1024, 'read')
+        t.start(transfer)
+        t.result()
+        self.assert_(0.1 <= remote.stats.latency < 0.2)
+        self.assert_(remote.stats.throughput > 1024 * 1024)
+        self.assert_(remote.stats.failure_rate == 0)
+        hangup = threading.Event()
+        t = Transfer(remote)
+        t.start(hangup.wait)
+        self.assertRaises(RemoteTimeout, t.result)
+        self.assert_(remote.stats.failure_rate == RemoteStats.alpha)
+        hangup.set()
+        # Failing late does not count twice
+        time.sleep(0.05)
+        self.assert_(remote.stats.failure_rate == RemoteStats.alpha)
+
+    def test_CircuitBreaker(self):
+        health = CircuitBreaker()
+        health.min_open_interval = 0.1
+        health.open_interval = 0.1
+        for i in range(CircuitBreaker.failure_threshold - 1):
+            health.failed()
+            self.assert_(health.allow())
+        health.failed()
+        self.assert_(health.state == CircuitBreaker.OPEN)
+        self.assert_(not health.allow())
+        self.assert_(not health.probe_due)
+        time.sleep(0.1)
+        self.assert_(health.probe_due)
+        self.assert_(health.allow())
+        self.assert_(health.state == CircuitBreaker.HALF_OPEN)
+        # A failed try keeps it open for longer
+        health.failed()
+        self.assert_(health.state == CircuitBreaker.OPEN)
+        self.assert_(health.open_interval == 0.2)
+        time.sleep(0.2)
+        self.assert_(health.allow())
+        health.succeeded()
+        self.assert_(health.state == CircuitBreaker.CLOSED)
+        self.assert_(health.open_interval == 0.1)
+        # Failures have to be in a row
+        health.failed()
+        health.succeeded()
+        health.failed()
+        self.assert_(health.allow())
+
+    def test_Transfer_health(self):
+        remote = FakeRemote()
+        def hangup():
+            raise HangupException()
+        for i in range(CircuitBreaker.failure_threshold):
+            t = Transfer(remote)
+            t.start(hangup)
+            self.assertRaises(HangupException, t.result)
+        self.assert_(remote.health.state == CircuitBreaker.OPEN)
+        # Errors which are not the remote's do not count
+        remote = FakeRemote()
+        for i in range(CircuitBreaker.failure_threshold):
+            t = Transfer(remote)
+            t.start(lambda: 1 / 0)
+            self.assertRaises(ZeroDivisionError, t.result)
+        self.assert_(remote.health.state == CircuitBreaker.CLOSED)
+
+    def test_Transfer_expire(self):
+        remote = FakeRemote()
+        hangup = threading.Event()
+        t = Transfer(remote)
+        t.start(hangup.wait)
+        t.abandon()
+        self.assert_(not t.expire())
+        self.assert_(remote.stats.failure_rate == 0)
+        time.sleep(0.25)
+        self.assert_(t.expire())
+        t.expire()
+        self.assert_(remote.stats.failure_rate == RemoteStats.alpha)
+        hangup.set()
+
+    def test_RemoteStats(self):
+        fast = RemoteStats()
+        slow = RemoteStats()
+        self.assert_(fast.expected_time(8192) == 0)
+        self.assert_(fast.percentile(0.95) is None)
+        for i in range(20):
+            fast.record(0.01 * (i % 10))
+            slow.record(1)
+        self.assert_(fast.percentile(0.95) == 0.09)
+        self.assert_(fast.expected_time(8192) < slow.expected_time(8192))
+        # A remote which fails gets expected to take longer
+        for i in range(5):
+            fast.record_failure()
+        self.assert_(fast.expected_time(8192) > 2 * fast.latency)
+        self.assert_(fast.as_dict()["failure_rate"] > 0.5)
+
+
+class FakeRefs(dict):
+
+    def as_dict(self, base):
+        return self.copy()
+
+
+class FakeStorage(object):
+    path = "/nonexistent"
+
+    def __init__(self):
+        self.remotes = {}
+        self.refs = FakeRefs()
+        self.remote_refs = {}
+        self.calls = []
+
+    def push(self):
+        self.calls.append("push")
+        return True
+
+    def fetch(self):
+        self.calls.append("fetch")
+        moved = [ ref for ref, sha in self.remote_refs.iteritems()
+                  if self.refs.get(ref) != sha ] != []
+        self.refs.update(self.remote_refs)
+        return moved
+
+    def fetch_blobs(self):
+        self.calls.append("fetch_blobs")
+
+    def update_from_remotes(self):
+        self.calls.append("update_from_remotes")
+
+    def evict_chunks(self):
+        pass
+
+
+class TestSyncer(unittest.TestCase):
+
+    def test_Syncer(self):
+        storage = FakeStorage()
+        storage.remote_refs["other"] = "1"
+        syncer = Syncer(storage)
+        syncer.sync()
+        self.assert_(storage.calls == [ "push", "fetch", "fetch_blobs", "update_from_remotes" ])
+        # Fetched refs get pushed to the other remotes, then nothing moved:
+        # nothing to do until the next fetch
+        syncer.sync()
+        storage.calls = []
+        syncer.sync()
+        self.assert_(storage.calls == [])
+        # Fetching nothing new backs off
+        syncer.next_fetch = 0
+        syncer.sync()
+        self.assert_(storage.calls == [ "fetch" ])
+        self.assert_(syncer.fetch_interval == 2 * Syncer.min_fetch_interval)
+        for i in range(10):
+            syncer.next_fetch = 0
+            syncer.sync()
+        self.assert_(syncer.fetch_interval == Syncer.max_fetch_interval)
+        # A commit gets pushed right away
+        storage.calls = []
+        storage.refs["box"] = "1"
+        syncer.sync()
+        self.assert_(storage.calls == [ "push" ])
+        self.assert_(syncer.fetch_interval == Syncer.min_fetch_interval)
+        # Refs moving on a remote gets everything updated
+        storage.calls = []
+        storage.remote_refs["other"] = "2"
+        syncer.next_fetch = 0
+        syncer.sync()
+        self.assert_(storage.calls == [ "fetch", "fetch_blobs", "update_from_remotes" ])
+
+    def test_Syncer_push_failed(self):
+        storage = FakeStorage()
+        def push():
+            storage.calls.append("push")
+            return False
+        storage.push = push
+        syncer = Syncer(storage)
+        syncer.sync()
+        # The push is retried at every sync, but fetches still back off
+        for i in range(3):
+            storage.calls = []
+            syncer.next_fetch = 0
+            syncer.sync()
+            self.assert_(storage.calls == [ "push", "fetch" ])
+        self.assert_(syncer.fetch_interval == 16 * Syncer.min_fetch_interval)
+
+    def test_Syncer_run_error(self):
+        storage = FakeStorage()
+        storage.must_be_sync = threading.Event()
+        synced = threading.Event()
+        def push():
+            storage.calls.append("push")
+            if len(storage.calls) == 1:
+                raise IOError(errno.EPIPE, "Broken pipe")
+            synced.set()
+            return True
+        storage.push = push
+        Syncer(storage).start()
+        # The error is reported, and the thread goes on syncing
+        for i in range(10):
+            storage.must_be_sync.set()
+            if synced.wait(0.1):
+                break
+        self.assert_(synced.is_set())
+
+    def test_Syncer_probe(self):
+        storage = FakeStorage()
+        remote = FakeRemote()
+        def start_probe():
+            transfer = Transfer(remote)
+            transfer.start(lambda: {})
+            return transfer
+        remote.start_probe = start_probe
+        storage.remotes["remote"] = remote
+        syncer = Syncer(storage)
+        syncer.sync()
+        storage.calls = []
+        for i in range(CircuitBreaker.failure_threshold):
+            remote.health.failed()
+        syncer.sync()
+        self.assert_(storage.calls == [])
+        # The remote is back: it gets pushed to and fetched from
+        remote.health.retry_time = 0
+        syncer.sync()
+        self.assert_(remote.health.state == CircuitBreaker.CLOSED)
+        self.assert_(storage.calls == [ "push", "fetch" ])
+
+    def test_Syncer_probe_hanging(self):
+        storage = FakeStorage()
+        remote = FakeRemote()
+        def start_probe():
+            raise RemoteTimeout(remote, "is still hanging")
+        remote.start_probe = start_probe
+        storage.remotes["remote"] = remote
+        syncer = Syncer(storage)
+        syncer.sync()
+        for i in range(CircuitBreaker.failure_threshold):
+            remote.health.failed()
+        remote.health.retry_time = 0
+        # A remote still hanging does not wake the syncer up
+        remote.hung.append(Transfer(remote))
+        self.assert_(syncer.wakeup_time() == syncer.next_fetch)
+        # A probe which cannot start puts the next one off
+        remote.hung = []
+        self.assert_(syncer.wakeup_time() == 0)
+        syncer.sync()
+        self.assert_(remote.health.state == CircuitBreaker.OPEN)
+        self.assert_(remote.health.retry_time > time.time())
+        self.assert_(syncer.wakeup_time() > time.time())
+
+
+if __name__ == '__main__':
+    unittest.main()
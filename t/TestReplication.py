@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import unittest
+import time
+from ki.objects import *
+from ki.replication import *
+
+from TestStorage import TestUsingStorage
+
+class TestReplication(TestUsingStorage):
+
+    def setUp(self):
+        super(TestReplication, self).setUp()
+        # Three records made 30, 20 and 10 days ago, each with a new 1000
+        # bytes file
+        self.records = []
+        self.chunks = []
+        for i in range(3):
+            r = Record(self.storage)
+            if self.records:
+                r.parents.append(self.records[-1])
+                for name, mode, sha in self.records[-1].root.iterentries():
+                    r.root[name] = (mode, sha)
+            f = File(self.storage)
+            f[0:] = str(i) * 1000
+            r.root["file%d" % i] = (0100644, f)
+            r.object.commit_time = int(time.time()) - (3 - i) * 10 * 24 * 3600
+            r.store()
+            self.chunks.append(f.blocks[0])
+            self.records.append(r)
+        self.head = self.records[-1].id()
+
+    def test_ReplicationPolicy(self):
+        self.assert_(ReplicationPolicy("Max 2.5 GB").max_bytes == 2500000000)
+        self.assert_(ReplicationPolicy("last 7  days").days == 7)
+        self.assert_(str(ReplicationPolicy("head only")) == "head only")
+        self.assertRaises(ValueError, ReplicationPolicy, "most of it")
+
+    def test_ReplicationPolicy_blobs(self):
+        def blobs(spec):
+            return ReplicationPolicy(spec).blobs(self.storage, self.head)
+        self.assert_(blobs("full") == set(self.chunks))
+        self.assert_(blobs("on demand") == set())
+        self.assert_(blobs("head") == set(self.chunks))
+        # Drop the first file from the head: the head does not need it
+        r = Record(self.storage)
+        r.parents.append(self.records[-1])
+        for name, mode, sha in self.records[-1].root.iterentries():
+            if name != "file0":
+                r.root[name] = (mode, sha)
+        r.store()
+        self.head = r.id()
+        self.assert_(blobs("full") == set(self.chunks))
+        self.assert_(blobs("head") == set(self.chunks[1:]))
+        self.assert_(blobs("last 5 days") == set(self.chunks[1:]))
+        self.assert_(blobs("last 15 days") == set(self.chunks))
+        self.assert_(len(blobs("max 2 KB")) == 2)
+        self.assert_(len(blobs("max 1.5 KB")) == 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import unittest
+import threading
+from ki.staging import *
+
+
+class TestStaging(unittest.TestCase):
+
+    def test_DirtyBudget(self):
+        storage = DirtyBudget(100, 200)
+        box = DirtyBudget(50, 150, storage)
+        other = DirtyBudget(50, 150, storage)
+        box.charge(60)
+        self.assert_(box.over_soft)
+        self.assert_(not other.over_soft)
+        self.assert_(storage.resident == 60)
+        box.spilled(60)
+        self.assert_(not box.over_soft)
+        self.assert_(box.used == 60)
+        other.charge(160)
+        self.assert_(other.over_hard)
+        # The storage is over its hard limit too
+        self.assert_(box.over_hard)
+        self.assert_(not box.wait(0.1))
+        t = threading.Thread(target=box.wait, args=(5,))
+        t.start()
+        other.reset()
+        t.join(1)
+        self.assert_(not t.is_alive())
+        self.assert_(storage.used == 60)
+        box.reset()
+        self.assert_(storage.used == 0 and storage.resident == 0)
+
+    def test_StagingArea(self):
+        area = StagingArea(initial_size=4)
+        a = area.stage("hello")
+        b = area.stage("world")
+        self.assert_(len(area) == 10)
+        self.assert_(str(a) == "hello")
+        self.assert_(b[1:3] == "or")
+        self.assert_(b[-1] == "d")
+        self.assert_(b[::2] == "wrd")
+        self.assert_(a[3:1] == "")
+        del a
+        self.assert_(len(area) == 10)
+        del b
+        # No block left, the area starts over
+        self.assert_(len(area) == 0)
+        self.assert_(str(area.stage("bye")) == "bye")
+        area.close()
+
+if __name__ == '__main__':
+    unittest.main()
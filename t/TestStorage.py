@@ -9,6 +9,7 @@ import dbus.mainloop.glib
 import dbus.service
 from ki.storage import *
 from ki.objects import File
+from ki.fuse import FuseOSError
 from dulwich.objects import *
 
 
@@ -27,6 +28,7 @@ class TestUsingStorage(unittest.TestCase):
         self.box = Box(self.storage, "master", create=True)
 
     def tearDown(self):
+        self.storage.cache.close()
         shutil.rmtree(self.storage.path)
 
 
@@ -38,6 +40,16 @@ class TestStorage(TestUsingStorage):
 
     def test_Storage_config(self):
         self.assert_(isinstance(self.storage.config, Config))
+        self.storage.config["some"] = "value"
+        self.assert_(self.storage.config["some"] == "value")
+
+    def test_Storage_replication_policy(self):
+        self.assert_(str(self.storage.replication_policy("master")) == "full")
+        self.storage.config["replication"] = "head"
+        self.box.SetReplication("last 7 days")
+        self.assert_(str(self.storage.replication_policy("master")) == "last 7 days")
+        self.assert_(str(self.storage.replication_policy("other")) == "head")
+        self.assertRaises(ValueError, self.box.SetReplication, "some")
 
     def test_Storage_remotes(self):
         self.storage.AddRemote("s2", "/tmp/sometest", 100)
@@ -73,6 +85,8 @@ class TestStorage(TestUsingStorage):
         self.assert_(all(map(s2.refs.as_dict("refs/blobs").has_key, f.blocks)))
         self.assert_(all(map(s3.refs.as_dict("refs/blobs").has_key, f.blocks)))
 
+        s2.cache.close()
+        s3.cache.close()
         shutil.rmtree(s2.path)
         shutil.rmtree(s3.path)
 
@@ -102,13 +116,120 @@ class TestStorage(TestUsingStorage):
         self.assert_(all(map(s1.refs.as_dict("refs/blobs").has_key, f.blocks)))
         self.assert_(all(map(s2.refs.as_dict("refs/blobs").has_key, f.blocks)))
 
+        s1.cache.close()
+        s2.cache.close()
         shutil.rmtree(s1.path)
         shutil.rmtree(s2.path)
 
+    def test_Storage_fetch_sha1s(self):
+        s1 = self.make_temp_storage()
+        s2 = self.make_temp_storage()
+        s1.AddRemote("s2", s2.path, 100)
+        box2 = s2.get_box("master", create=True)
+
+        f = File(s2)
+        f[:] = os.urandom(256 * 1024)
+        box2.root["a"] = (stat.S_IFREG | 644, f)
+        box2.Commit()
+        blocks = list(f.blocks)
+        self.assert_(len(blocks) > 2)
+
+        s1.fetch()
+        s1.fetch_demand_size = 16
+        s1.fetch_sha1s(blocks)
+        self.assert_(all(map(s1.object_store.__contains__, blocks)))
+        # The remote refuses it, and may hang up before being told all:
+        # either way it is not found
+        self.assertRaises(FetchError, s1.fetch_sha1s, [ "1" * 40 ])
+
+        s1.cache.close()
+        s2.cache.close()
+        shutil.rmtree(s1.path)
+        shutil.rmtree(s2.path)
+
+    def test_Storage_evict_chunks(self):
+        s2 = self.make_temp_storage()
+        self.storage.AddRemote("s2", s2.path, 100)
+        f = File(self.storage)
+        f[:] = "some content"
+        self.box.root["a"] = (stat.S_IFREG | 0644, f)
+        self.box.Commit()
+        self.assert_(self.storage.usage.chunk_bytes > 1)
+
+        remote = self.storage.remotes["s2"]
+        listed = []
+        fetch = remote.fetch
+        def listing(determine_wants=None):
+            listed.append(determine_wants)
+            return fetch(determine_wants)
+        remote.fetch = listing
+
+        # All chunks are pinned: the remotes are not even asked
+        self.storage.config["cache"] = { "max_size": "1 B", "replicas": 1,
+                                         "pins": { "master": [ "/" ] } }
+        self.storage.evict_chunks()
+        self.assert_(listed == [])
+        # Nothing changed: it is too soon to try again
+        self.storage.config["cache"] = { "max_size": "1 B", "replicas": 1 }
+        self.storage.evict_chunks()
+        self.assert_(listed == [])
+        self.storage._evict_time = 0
+        self.storage.evict_chunks()
+        self.assert_(len(listed) == 1)
+        # The remote has none of them, so they are all kept
+        self.assert_(all(map(self.storage.object_store.__contains__, f.blocks)))
+        self.storage.evict_chunks()
+        self.assert_(len(listed) == 1)
+
+        s2.cache.close()
+        shutil.rmtree(s2.path)
+
     def test_Box_root(self):
         self.assert_(self.box.root is not None)
         self.assert_(self.box.root is self.box.record.root)
         self.assert_(self.box.root is self.box._next_record.root)
 
+    def _reopen_box(self):
+        """Drop the box as if we crashed, and open it again."""
+        self.box.fuse.fsync("/", False)
+        self.box.journal.close()
+        self.box = Box(self.storage, "master")
+        return self.box.fuse
+
+    def test_Box_replay(self):
+        fs = self.box.fuse
+        fs.mkdir("/d", 0755)
+        fs.release("/d/a", fs.create("/d/a", stat.S_IFREG | 0644))
+        fs.write("/d/a", "some content", 0)
+        fs.rename("/d/a", "/d/b")
+        fs.chmod("/d/b", stat.S_IFREG | 0600)
+        fs.truncate("/d/b", 4)
+        fs.utimens("/d/b", (1, 2))
+        fs.symlink("/l", "/d/b")
+
+        fs = self._reopen_box()
+        self.assertRaises(FuseOSError, fs.getattr, "/d/a")
+        self.assert_(fs.read("/d/b", 100, 0) == "some")
+        attrs = fs.getattr("/d/b")
+        self.assert_(attrs["st_mode"] == stat.S_IFREG | 0600)
+        self.assert_(attrs["st_mtime"] == 2)
+        self.assert_(fs.readlink("/l") == "/d/b")
+
+    def test_Box_replay_committed(self):
+        fs = self.box.fuse
+        fs.release("/a", fs.create("/a", stat.S_IFREG | 0644))
+        fs.write("/a", "some content", 0)
+        fs.rename("/a", "/b")
+        fs.symlink("/a", "/b")
+        # Stop after the commit, before the journal got reset: replaying
+        # what got committed would make /b a symlink too
+        self.box._commit()
+        fs.chmod("/b", stat.S_IFREG | 0600)
+
+        fs = self._reopen_box()
+        self.assert_(fs.read("/b", 100, 0) == "some content")
+        self.assert_(fs.getattr("/b")["st_mode"] == stat.S_IFREG | 0600)
+        self.assert_(fs.readlink("/a") == "/b")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import shutil
+import stat
+import os
+from ki.objects import *
+from ki.usage import *
+
+from TestStorage import TestUsingStorage
+
+class TestUsage(TestUsingStorage):
+
+    def setUp(self):
+        super(TestUsage, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.usage = Usage(self.storage, os.path.join(self.path, "usage"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestUsage, self).tearDown()
+
+    def test_Usage_add_chunk(self):
+        chunks = self.storage.usage.chunks
+        chunk_bytes = self.storage.usage.chunk_bytes
+        f = FileBlock(self.storage)
+        f.data = "some chunk"
+        f.store()
+        f = FileBlock(self.storage)
+        f.data = "some chunk"
+        f.store()
+        self.assert_(self.storage.usage.chunks == chunks + 1)
+        self.assert_(self.storage.usage.chunk_bytes == chunk_bytes + len("some chunk"))
+
+    def test_Usage_update_box(self):
+        d = Directory(self.storage)
+        f1 = File(self.storage)
+        f1[0:] = "hello"
+        f2 = File(self.storage)
+        f2[0:] = "world!"
+        d["a"] = (0100644, f1)
+        d.mkdir("b/c")["x"] = (0100644, f2)
+        d["l"] = (stat.S_IFLNK, Symlink(self.storage, target="a"))
+        self.usage.update_box("box", d.store())
+        self.assert_(self.usage.box("box") == { "bytes": 11, "files": 2,
+                                                "directories": 2, "symlinks": 1 })
+        del d["b"]
+        f1[5:] = " there"
+        self.usage.update_box("box", d.store())
+        self.assert_(self.usage.box("box") == { "bytes": 11, "files": 1,
+                                                "directories": 0, "symlinks": 1 })
+        # The counters survive a restart
+        usage = Usage(self.storage, self.usage.path)
+        self.assert_(usage.box("box") == self.usage.box("box"))
+        self.assert_(usage.box("other") == { "bytes": 0, "files": 0,
+                                             "directories": 0, "symlinks": 0 })
+
+if __name__ == '__main__':
+    unittest.main()
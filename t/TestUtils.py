@@ -3,6 +3,7 @@
 import unittest
 import time
 import operator
+import threading
 from ki.utils import *
 
 class TestUtils(unittest.TestCase):
@@ -135,5 +136,98 @@ class TestUtils(unittest.TestCase):
         del x[0:]
         x[0:5] = "Hiworld"
 
+    def test_lrope_splice(self):
+        x = lrope.create_unknown_size([ "abc", "defg", "hijklm" ])
+        self.assert_(x.slice_blocks(0, 7) == [ (3, "abc"), (4, "defg") ])
+        self.assert_(x.slice_blocks(2, 9) == [ (1, "c"), (4, "defg"), (2, "hi") ])
+        self.assert_(x.slice_blocks(5, 6) == [ (1, "f") ])
+        y = lrope.create_unknown_size([ "0123456789" ])
+        y.splice(2, x.slice_blocks(2, 9))
+        self.assert_(str(y) == "01cdefghi9")
+        self.assert_(y.block_size_at(2) == 4)
+        y.splice(10, [ (3, "xyz") ])
+        self.assert_(str(y) == "01cdefghi9xyz")
+        self.assert_(len(y) == 13)
+        y.splice(9, [ (5, "ABCDE") ])
+        self.assert_(str(y) == "01cdefghiABCDE")
+        self.assertRaises(IndexError, y.splice, 20, [ (1, "a") ])
+        z = lrope([])
+        z.splice(0, [ (3, "abc") ])
+        self.assert_(str(z) == "abc")
+        self.assert_(z.open(1, 2).read() == "b")
+
+    def test_LRUCache(self):
+        c = LRUCache(2)
+        c["a"] = 1
+        c["b"] = 2
+        self.assert_(c["a"] == 1)
+        c["c"] = 3
+        self.assert_(len(c) == 2)
+        self.assert_("b" not in c)
+        self.assert_(c.get("b") is None)
+        self.assert_(c["a"] == 1)
+        self.assert_(c["c"] == 3)
+        c.discard("a")
+        c.discard("a")
+        self.assert_("a" not in c)
+        c.clear()
+        self.assert_(len(c) == 0)
+
+    def test_RWLock(self):
+        lock = RWLock()
+        events = []
+        def reader():
+            with lock.shared():
+                events.append("read")
+        def writer():
+            with lock.exclusive():
+                events.append("write")
+        with lock.shared():
+            # Readers do not exclude each others
+            t = threading.Thread(target=reader)
+            t.start()
+            t.join(1)
+            self.assert_(events == [ "read" ])
+            w = threading.Thread(target=writer)
+            w.start()
+            w.join(0.1)
+            self.assert_(events == [ "read" ])
+        w.join(1)
+        self.assert_(events == [ "read", "write" ])
+        # The writer can take the lock again
+        with lock.exclusive():
+            with lock.exclusive():
+                with lock.shared():
+                    pass
+        w = threading.Thread(target=writer)
+        w.start()
+        w.join(1)
+        self.assert_(events == [ "read", "write", "write" ])
+
+    def test_RWLock_writer_waiting(self):
+        lock = RWLock()
+        events = []
+        def reader():
+            with lock.shared():
+                events.append("read")
+        def writer():
+            with lock.exclusive():
+                events.append("write")
+        with lock.shared():
+            w = threading.Thread(target=writer)
+            w.start()
+            w.join(0.1)
+            # New readers wait for the waiting writer
+            r = threading.Thread(target=reader)
+            r.start()
+            r.join(0.1)
+            self.assert_(events == [])
+            # Readers can still acquire it again
+            with lock.shared():
+                pass
+        w.join(1)
+        r.join(1)
+        self.assert_(events == [ "write", "read" ])
+
 if __name__ == '__main__':
     unittest.main()